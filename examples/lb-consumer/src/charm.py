@@ -45,7 +45,7 @@ class RequiresOperatorCharm(CharmBase):
         if not self.lb_provider.is_available:
             self.unit.status = WaitingStatus("waiting on provider")
             return
-        response = self.lb_provider.get_response("lb-consumer")
+        response = self.lb_provider.get_response_view("lb-consumer")
         if not response:
             self.unit.status = WaitingStatus("waiting on provider response")
             return
@@ -24,9 +24,19 @@ class ProvidesOperatorCharm(CharmBase):
         self.unit.status = MaintenanceStatus("processing requests")
         for request in self.lb_consumers.new_requests:
             response = request.response
+            unsupported = [
+                field
+                for field in request.tuning_fields
+                if getattr(request, field) is not None
+            ]
             if not request.public:
                 response.error = response.error_types.unsupported
                 response.error_fields = {"public": "public only"}
+            elif unsupported:
+                response.error = response.error_types.unsupported
+                response.error_fields = {
+                    field: "not supported" for field in unsupported
+                }
             else:
                 try:
                     response.address = self._create_lb(request)
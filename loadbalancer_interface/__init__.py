@@ -1,2 +1,3 @@
 from .requires import LBProvider  # noqa
 from .provides import LBConsumers  # noqa
+from .render import ConfigRenderer  # noqa
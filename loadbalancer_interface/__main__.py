@@ -0,0 +1,5 @@
+from .analyze import main
+
+
+if __name__ == "__main__":
+    main()
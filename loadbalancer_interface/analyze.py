@@ -0,0 +1,344 @@
+"""Offline analysis of exported relation data.
+
+When a provider misbehaves in production, the relation data can be exported
+(e.g., with `juju show-unit <unit> --format json > snapshot.json`) and analyzed
+offline. For each relation of the interface, this reports the number of requests
+and responses, the size in bytes of each databag, and how long it takes to
+parse, validate, and hash them using the same schema code as the charms (in the
+schema version agreed on for the relation), and flags any which fail validation.
+
+Given a dump of the provider's `StoredState` as well (either its
+`.unit-state.db` file, or a JSON or YAML mapping of handle paths to snapshots,
+such as from `state-get`), it also replays the `LBConsumers` logic to report
+which requests the provider would see as new, changed, or removed.
+
+It can be run with:
+
+    python -m loadbalancer_interface snapshot.json --state .unit-state.db
+"""
+
+import argparse
+import json
+import warnings
+from time import perf_counter
+
+import yaml
+from marshmallow import ValidationError
+from ops.charm import CharmBase
+from ops.storage import SQLiteStorage
+from ops.testing import Harness
+
+from . import schemas
+from .base import TLS_PREFIX, content_hash
+from .provides import LBConsumers
+
+
+PHASES = ("parse", "validate", "hash")
+
+
+def load_units(path):
+    """Load the units from a `juju show-unit` snapshot, in JSON or YAML."""
+    with open(path) as f:
+        text = f.read()
+    try:
+        return json.loads(text)
+    except ValueError:
+        return yaml.safe_load(text)
+
+
+def load_state(path, endpoint=None):
+    """Load the `StoredState` snapshot of the `LBConsumers` for an endpoint.
+
+    The path can be an ops `.unit-state.db` file, or a JSON or YAML file of
+    either the snapshot itself or a mapping of handle paths to snapshots (which
+    may themselves be serialized as YAML, as with `state-get`).
+    """
+    with open(path, "rb") as f:
+        is_sqlite = f.read(16) == b"SQLite format 3\x00"
+    if is_sqlite:
+        storage = SQLiteStorage(path)
+        try:
+            snapshots = {
+                handle: storage.load_snapshot(handle)
+                for handle in storage.list_snapshots()
+            }
+        finally:
+            storage.close()
+    else:
+        snapshots = load_units(path)
+    if "known_requests" in snapshots:
+        return snapshots
+    for handle, snapshot in sorted(snapshots.items()):
+        if "LBConsumers[" not in handle or not handle.endswith("[state]"):
+            continue
+        if endpoint is not None and "[{}]".format(endpoint) not in handle:
+            continue
+        if isinstance(snapshot, str):
+            snapshot = yaml.safe_load(snapshot)
+        if isinstance(snapshot, dict) and "known_requests" in snapshot:
+            return snapshot
+    raise ValueError("No LBConsumers state found in {}".format(path))
+
+
+def interface_relations(units):
+    """Find the relations of the interface in a snapshot.
+
+    Yields `(unit, relation)` pairs for each relation whose remote application
+    data has any requests or responses in it.
+    """
+    for unit, info in sorted(units.items()):
+        for relation in info.get("relation-info", []):
+            keys = relation.get("application-data", {}).keys()
+            if any(key.startswith(("request_", "response_")) for key in keys):
+                yield unit, relation
+
+
+def remote_app(relation):
+    units = sorted(relation.get("related-units", {}))
+    if units:
+        return units[0].split("/")[0]
+    return "remote-{}".format(relation.get("relation-id"))
+
+
+def databag_bytes(data):
+    return sum(len((key + val).encode("utf8")) for key, val in data.items())
+
+
+def schema_version(data):
+    # Peers which predate versioning didn't send a version at all.
+    return min(int(data.get("version", 1)), schemas.max_version)
+
+
+def analyze_relation(unit, relation, repeat=1):
+    """Report on the requests and responses in a single relation.
+
+    Timings are in seconds, and are the best of `repeat` runs for each item.
+    """
+    app_data = relation.get("application-data", {})
+    version = schema_version(app_data)
+    schema = schemas.versions[version]
+    remote = remote_app(relation)
+    sizes = {remote: databag_bytes(app_data)}
+    local = relation.get("local-unit", {}).get("data", {})
+    sizes[unit] = databag_bytes(local)
+    for name, member in sorted(relation.get("related-units", {}).items()):
+        sizes[name] = databag_bytes(member.get("data", {}))
+    timings = {phase: {"total": 0.0, "max": 0.0} for phase in PHASES}
+    counts = {"requests": 0, "responses": 0}
+    invalid = []
+    for key, sdata in sorted(app_data.items()):
+        if key.startswith("request_"):
+            counts["requests"] += 1
+        elif key.startswith("response_"):
+            counts["responses"] += 1
+        else:
+            continue
+        try:
+            best = None
+            for _ in range(repeat):
+                times = _time_item(schema, key, sdata, app_data)
+                best = times if best is None else [min(t) for t in zip(best, times)]
+        except (ValueError, ValidationError) as e:
+            messages = getattr(e, "messages", None) or str(e)
+            invalid.append({"key": key, "error": messages})
+            continue
+        for phase, elapsed in zip(PHASES, best):
+            timings[phase]["total"] += elapsed
+            timings[phase]["max"] = max(timings[phase]["max"], elapsed)
+    return dict(
+        {
+            "unit": unit,
+            "endpoint": relation.get("endpoint"),
+            "relation_id": relation.get("relation-id"),
+            "remote_app": remote,
+            "version": version,
+            "databag_bytes": sizes,
+            "timings": timings,
+            "invalid": invalid,
+        },
+        **counts,
+    )
+
+
+def _time_item(schema, key, sdata, app_data):
+    kind, name = key.split("_", 1)
+    start = perf_counter()
+    data = json.loads(sdata)
+    parsed = perf_counter()
+    if kind == "request":
+        obj = schema.Request()
+    else:
+        request = schema.Request()
+        request.name = name
+        obj = schema.Response(request)
+    obj._load(data)
+    for field in getattr(obj, "tls_fields", ()):
+        ref = getattr(obj, field + "_ref", None)
+        material = app_data.get(TLS_PREFIX + ref) if ref else None
+        if ref and (material is None or content_hash(material) != ref):
+            raise ValidationError({field + "_ref": ["Unknown TLS material."]})
+    validated = perf_counter()
+    if obj.hash is None:
+        # The hash is None if the object can't be dumped, so get the reason.
+        obj.dump()
+    hashed = perf_counter()
+    return [parsed - start, validated - parsed, hashed - validated]
+
+
+class _ReplayCharm(CharmBase):
+    def __init__(self, *args):
+        super().__init__(*args)
+        (endpoint,) = self.meta.provides
+        self.lb_consumers = LBConsumers(self, endpoint)
+
+
+def replay(unit, relations, state):
+    """Replay the `LBConsumers` diff logic for a provider unit.
+
+    The given relations are recreated in a `Harness`, along with the `state`
+    snapshot, and the requests which the provider would see as new (never
+    responded to), changed, or removed are reported.
+    """
+    endpoint = relations[0]["endpoint"]
+    meta = {
+        "name": unit.split("/")[0],
+        "provides": {endpoint: {"interface": "loadbalancer"}},
+    }
+    with warnings.catch_warnings():
+        # The Harness warns about unrelated settings for testing workloads.
+        warnings.simplefilter("ignore")
+        harness = Harness(_ReplayCharm, meta=yaml.safe_dump(meta))
+    try:
+        harness.set_leader(True)
+        harness.begin()
+        lb_consumers = harness.charm.lb_consumers
+        known = dict(state.get("known_requests", {}))
+        lb_consumers.state.known_requests = known
+        for relation in relations:
+            app = remote_app(relation)
+            relation_id = harness.add_relation(endpoint, app)
+            for name, member in sorted(relation.get("related-units", {}).items()):
+                harness.add_relation_unit(relation_id, name)
+                harness.update_relation_data(relation_id, name, member.get("data", {}))
+            harness.update_relation_data(
+                relation_id, app, relation.get("application-data", {})
+            )
+        result = {"unit": unit, "new": [], "changed": [], "removed": []}
+        for request in lb_consumers.new_requests:
+            status = "changed" if known.get(request.id) else "new"
+            result[status].append(
+                {
+                    "app": request.relation.app.name,
+                    "name": request.name,
+                    "id": request.id,
+                }
+            )
+        result["removed"] = [request.id for request in lb_consumers.removed_requests]
+        return result
+    finally:
+        harness.cleanup()
+
+
+def analyze(units, state=None, unit=None, repeat=1):
+    """Analyze a snapshot, optionally replaying against a state snapshot."""
+    found = [
+        (name, relation)
+        for name, relation in interface_relations(units)
+        if unit is None or name == unit
+    ]
+    report = {
+        "relations": [
+            analyze_relation(name, relation, repeat) for name, relation in found
+        ],
+        "replay": None,
+    }
+    if state is not None:
+        providers = [
+            (name, relation)
+            for name, relation in found
+            if any(key.startswith("request_") for key in relation["application-data"])
+        ]
+        if providers:
+            provider, first = providers[0]
+            relations = [
+                relation
+                for name, relation in providers
+                if name == provider and relation["endpoint"] == first["endpoint"]
+            ]
+            report["replay"] = replay(provider, relations, state)
+    return report
+
+
+def format_report(report):
+    """Format an analysis report as text."""
+    row = "{:<20}{:>6}  {:<18}{:>3}{:>10}{:>11}{:>11}{:>11}{:>11}{:>9}"
+    lines = [
+        row.format(
+            "unit",
+            "rel",
+            "remote",
+            "v",
+            "requests",
+            "responses",
+            "parse",
+            "validate",
+            "hash",
+            "invalid",
+        )
+    ]
+    for rel in report["relations"]:
+        times = [
+            "{:.2f}ms".format(rel["timings"][phase]["total"] * 1000) for phase in PHASES
+        ]
+        lines.append(
+            row.format(
+                rel["unit"],
+                str(rel["relation_id"]),
+                rel["remote_app"],
+                rel["version"],
+                rel["requests"],
+                rel["responses"],
+                *times,
+                len(rel["invalid"]),
+            )
+        )
+    for rel in report["relations"]:
+        lines.append("")
+        lines.append(
+            "{} relation {} ({}):".format(
+                rel["unit"], rel["relation_id"], rel["remote_app"]
+            )
+        )
+        for name, size in rel["databag_bytes"].items():
+            lines.append("  {:<30}{:>10} bytes".format(name, size))
+        for item in rel["invalid"]:
+            lines.append("  INVALID {}: {}".format(item["key"], item["error"]))
+    replayed = report["replay"]
+    if replayed is not None:
+        lines.append("")
+        lines.append("Replay for {}:".format(replayed["unit"]))
+        for status in ("new", "changed"):
+            for request in replayed[status]:
+                lines.append(
+                    "  {:<8}{}:{} ({})".format(
+                        status, request["app"], request["name"], request["id"]
+                    )
+                )
+        for request_id in replayed["removed"]:
+            lines.append("  {:<8}{}".format("removed", request_id))
+    return "\n".join(lines)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("snapshot", help="Output of `juju show-unit`, as JSON or YAML")
+    parser.add_argument("--state", help="A dump of the provider's StoredState")
+    parser.add_argument("--endpoint", help="The endpoint to load the state for")
+    parser.add_argument("--unit", help="Only analyze the given unit")
+    parser.add_argument("--repeat", type=int, default=1, help="Best of N timings")
+    parser.add_argument("--json", action="store_true", help="Output the raw report")
+    opts = parser.parse_args(args)
+    units = load_units(opts.snapshot)
+    state = load_state(opts.state, opts.endpoint) if opts.state else None
+    report = analyze(units, state, opts.unit, opts.repeat)
+    print(json.dumps(report, indent=2) if opts.json else format_report(report))
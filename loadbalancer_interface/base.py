@@ -1,46 +1,375 @@
+import json
+import re
 import weakref
+from abc import ABCMeta, abstractmethod
+from collections import defaultdict
+from functools import partial
+from hashlib import md5
 from operator import attrgetter
 
-from cached_property import cached_property
+from marshmallow import ValidationError
 
+from ops.charm import RelationBrokenEvent
 from ops.framework import (
     Object,
 )
 
-from . import schemas
+from . import profiling, schemas
+from .unit_of_work import BackendCallCounter, UnitOfWork
 
 
-class VersionedInterface(Object):
-    def __init__(self, charm, relation_name):
+TLS_PREFIX = "tls_"
+DIGEST_PREFIX = "digest_"
+
+
+def content_hash(value):
+    """The key that content-addressed data, such as TLS material, is stored under."""
+    return md5(value.encode("utf8")).hexdigest()
+
+
+def digest_hash(sdata):
+    """A short hash of some raw relation data, for the digest shared with peers."""
+    if not sdata:
+        return ""
+    return md5(sdata.encode("utf8")).hexdigest()[:12]
+
+
+# Finds a top-level hash field (sent_hash or received_hash) in serialized data
+# without parsing it. A quote can't appear unescaped within a JSON string, so
+# this can only match a key, and none of the nested objects have these fields.
+_HASH_FIELD_RES = {
+    field: re.compile(r'[{,] ?"%s": ?"([0-9a-f]*)"' % field)
+    for field in ("sent_hash", "received_hash")
+}
+
+
+def scan_hash(sdata, field):
+    """Get the value of a top-level hash field from serialized data, or None."""
+    match = _HASH_FIELD_RES[field].search(sdata)
+    return match.group(1) if match else None
+
+
+def digest_entry(request_sdata, response_sdata):
+    """The digest entry for a request and its response, from the raw data.
+
+    The response only counts if it was made for the current request, which is
+    when its received_hash matches the request's sent_hash.
+    """
+    if response_sdata:
+        received_hash = scan_hash(response_sdata, "received_hash")
+        if received_hash != scan_hash(request_sdata, "sent_hash"):
+            response_sdata = None
+    return "{}:{}".format(digest_hash(request_sdata), digest_hash(response_sdata))
+
+
+class ViewCache:
+    """Cache for values derived from relation data.
+
+    Views (e.g., the list of all requests) are keyed by the generation of each
+    relation they were built from, and the entries they are made of (e.g., a
+    single parsed request) are keyed by the relation and request name. Any
+    relation event bumps the generation of that relation, dropping everything
+    built from it, while a local write only drops the entries for the name that
+    was written, so that rebuilding the views after a write only has to re-parse
+    what was actually changed.
+    """
+
+    def __init__(self):
+        self._epoch = 0
+        self._generations = defaultdict(int)
+        self._serials = defaultdict(int)
+        self._entries = {}
+        self._views = {}
+
+    def view(self, name, relations, factory, *extra):
+        """Get a cached view built from the given relations.
+
+        The view will be rebuilt with `factory()` if any of the relations have
+        changed or been written to, or if any of the `extra` values differ from
+        when the view was built.
+        """
+        key = (self._epoch, extra) + tuple(
+            (relation.id, self._serials[relation.id]) for relation in relations
+        )
+        cached = self._views.get(name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        value = factory()
+        self._views[name] = (key, value)
+        return value
+
+    def entry(self, relation, name, factory, *extra):
+        """Get a cached entry for a given name within a relation."""
+        generation = self._generations[relation.id]
+        slot = self._entries.get((relation.id, name))
+        if slot is None or slot[0] != generation:
+            slot = self._entries[(relation.id, name)] = (generation, {})
+        if extra not in slot[1]:
+            slot[1][extra] = factory()
+        return slot[1][extra]
+
+    def has_entry(self, relation, name, *extra):
+        """Whether there's a current cached entry for a given name."""
+        slot = self._entries.get((relation.id, name))
+        generation = self._generations[relation.id]
+        return slot is not None and slot[0] == generation and extra in slot[1]
+
+    def invalidate(self, relation=None, name=None):
+        """Invalidate cached data.
+
+        If no relation is given, everything is invalidated. If only a relation
+        is given, everything built from that relation is invalidated. If a name
+        is also given, only the entries for that name are dropped, but any view
+        built from the relation will be rebuilt from the remaining entries.
+        """
+        if relation is None:
+            self._epoch += 1
+            self._entries.clear()
+            self._views.clear()
+            return
+        self._serials[relation.id] += 1
+        if name is None:
+            self._generations[relation.id] += 1
+        else:
+            self._entries.pop((relation.id, name), None)
+
+
+class _InterfaceMeta(type(Object), ABCMeta):
+    pass
+
+
+class VersionedInterface(Object, metaclass=_InterfaceMeta):
+    def __init__(self, charm, relation_name, *, peer_relation=None, unit_of_work=False):
         super().__init__(charm, relation_name)
         self.charm = weakref.proxy(charm)
         self.relation_name = relation_name
+        self.peer_relation = peer_relation
+        self._unit_of_work = None
+        if unit_of_work:
+            self._unit_of_work = UnitOfWork(self.model)
+            # Count from the start, so that the counts cover the whole hook.
+            BackendCallCounter.get(charm)
+        if profiling.is_enabled(charm):
+            profiling.instrument(self)
+        self._cache = ViewCache()
+        # The remote data of a broken relation can't be read, but the relation
+        # is still present in the model during the relation-broken hook.
+        self._broken_relations = set()
+        # TLS material is shared between requests and keyed by its content, so
+        # it never goes stale and each distinct cert only has to be read once.
+        self._tls_material = {}
+
+        # Any change to the relation, whether remote data or membership, means
+        # that views built from it are stale. These are registered before any
+        # of the subclass handlers so that those always see fresh data.
+        for event in (
+            charm.on[relation_name].relation_created,
+            charm.on[relation_name].relation_joined,
+            charm.on[relation_name].relation_changed,
+            charm.on[relation_name].relation_departed,
+            charm.on[relation_name].relation_broken,
+        ):
+            self.framework.observe(event, self._invalidate_cache)
 
         # Future-proof against the need to evolve the relation protocol
         # by ensuring that we agree on a version number before starting.
         # This may or may not be made moot by a future feature in Juju.
         self._set_version()
+        # The charm isn't necessarily re-created for every hook (e.g., under
+        # the test harness), so relations created or leadership gained after
+        # that need to set it as well.
+        self.framework.observe(
+            charm.on[relation_name].relation_created, self._on_set_version
+        )
+        self.framework.observe(charm.on.leader_elected, self._on_set_version)
+
+        if peer_relation is not None:
+            # The leader publishes a digest of the requests and responses for
+            # the followers once per hook, after everything has been handled.
+            self.framework.observe(self.framework.on.pre_commit, self._publish_digest)
+            self.framework.observe(
+                charm.on[peer_relation].relation_changed, self._on_digest_changed
+            )
+        if unit_of_work:
+            # Registered last, so that it includes anything written on pre-commit.
+            self.framework.observe(self.framework.on.pre_commit, self._flush_writes)
+
+    def _invalidate_cache(self, event):
+        if isinstance(event, RelationBrokenEvent):
+            self._broken_relations.add(event.relation.id)
+        self._cache.invalidate(event.relation)
+        if self._unit_of_work is not None:
+            self._unit_of_work.invalidate(event.relation)
+
+    def _data(self, relation, entity):
+        """Get the databag for a unit or app in a relation.
+
+        In unit-of-work mode, this is a snapshot which buffers any writes until
+        the end of the hook.
+        """
+        if self._unit_of_work is None:
+            return relation.data[entity]
+        return self._unit_of_work.bag(relation, entity)
+
+    def _flush_writes(self, event=None):
+        self._unit_of_work.flush()
+
+    @property
+    def call_counts(self):
+        """Counts of the calls made to the model backend in the current hook.
+
+        This is a dict with the number of `calls` made to each backend method,
+        and the number of `databag_reads` (`relation-get` calls) for each
+        `(relation_id, unit or app name)`. Calls are counted from when the
+        interface is created in unit-of-work mode, or otherwise from the first
+        time this is accessed.
+        """
+        return BackendCallCounter.get(self.charm).counts
+
+    def _on_set_version(self, event):
+        self._set_version()
 
     def _set_version(self):
         if self.unit.is_leader():
             for relation in self.model.relations.get(self.relation_name, []):
-                relation.data[self.app]["version"] = str(schemas.max_version)
+                self._data(relation, self.app)["version"] = str(schemas.max_version)
+
+    def _on_digest_changed(self, event):
+        # The digest can affect any of the views on followers.
+        self._cache.invalidate()
+        if self._unit_of_work is not None:
+            self._unit_of_work.invalidate(event.relation)
+
+    @property
+    def digest(self):
+        """A compact digest of the state of every request and response.
+
+        This is a mapping of relation ID (as a string) to a mapping of request
+        name to `"<request hash>:<response hash>"`, with short hashes of the raw
+        relation data. The response hash is empty if there is no response, or if
+        it hasn't been updated for the current request yet.
+
+        On the leader, it is built from the relation data. On followers, it is
+        the digest last published by the leader to the peer relation, and is
+        empty if there is no `peer_relation` or nothing has been published yet.
+        """
+        if self.unit.is_leader():
+            relations = self.relations
+            return self._cache.view("digest", relations, self._digest_entries, True)
+        return self._published_digest or {}
+
+    @property
+    def _published_digest(self):
+        """The digest published by the leader, or None if there isn't one."""
+        peer = self._peer
+        if peer is None:
+            return None
+        sdata = self._data(peer, self.app).get(DIGEST_PREFIX + self.relation_name)
+        if not sdata:
+            return None
+        return self._cache.view("digest", [peer], partial(json.loads, sdata), False)
 
-    @cached_property
+    @abstractmethod
+    def _digest_entries(self):
+        """Build the digest from the relation data, on the leader.
+
+        This should return a mapping of relation ID (as a `str`) to a mapping of
+        request name to its `digest_entry`, for each relation with any requests.
+        Since the digest is published at the end of every hook, it must be built
+        from the raw relation data alone, without loading any of the requests or
+        responses.
+        """
+
+    @property
+    def _peer(self):
+        if self.peer_relation is None:
+            return None
+        return self.model.get_relation(self.peer_relation)
+
+    def _publish_digest(self, event=None):
+        peer = self._peer
+        if peer is None or not self.unit.is_leader():
+            return
+        sdata = json.dumps(self.digest, sort_keys=True, separators=(",", ":"))
+        key = DIGEST_PREFIX + self.relation_name
+        peer_data = self._data(peer, self.app)
+        if peer_data.get(key) != sdata:
+            peer_data[key] = sdata
+
+    @property
+    def digest_changes(self):
+        """A list of `(relation_id, name)` pairs whose entries in the `digest`
+        differ from when `ack_digest` was last called.
+
+        This lets followers cheaply tell which requests or responses have changed
+        without having to load any of them.
+        """
+        digest = self.digest
+        acked = self.state.acked_digest
+        changes = set()
+        for rid in digest.keys() | acked.keys():
+            entries = digest.get(rid, {})
+            acked_entries = acked.get(rid, {})
+            for name in entries.keys() | acked_entries.keys():
+                if entries.get(name) != acked_entries.get(name):
+                    changes.add((int(rid), name))
+        return sorted(changes)
+
+    def ack_digest(self):
+        """Acknowledge that all of the changes in the `digest` have been handled."""
+        self.state.acked_digest = {
+            rid: dict(entries) for rid, entries in self.digest.items()
+        }
+
+    def _tls_ref(self, data, field, ref):
+        """Get the TLS material that a request refers to from the given data."""
+        material = self._tls_material.get(ref)
+        if material is None:
+            material = data.get(TLS_PREFIX + ref)
+            if material is None or content_hash(material) != ref:
+                raise ValidationError({field + "_ref": ["Unknown TLS material."]})
+            self._tls_material[ref] = material
+        return material
+
+    def _resolve_tls(self, request, data):
+        """Fill in any TLS material which a request refers to."""
+        for field in getattr(request, "tls_fields", ()):
+            ref = getattr(request, field + "_ref", None)
+            if ref:
+                setattr(request, field, self._tls_ref(data, field, ref))
+        return request
+
+    @property
     def relations(self):
-        relations = self.model.relations.get(self.relation_name, [])
-        return [
+        relations = [
             relation
-            for relation in sorted(relations, key=attrgetter("id"))
-            if self._schema(relation)
+            for relation in self.model.relations.get(self.relation_name, [])
+            if relation.id not in self._broken_relations
         ]
+        return self._cache.view(
+            "relations",
+            relations,
+            lambda: [
+                relation
+                for relation in sorted(relations, key=attrgetter("id"))
+                if self._schema(relation)
+            ],
+        )
+
+    def _upgrade(self, obj):
+        """Convert an object loaded from the relation to the latest version."""
+        return schemas.convert(obj, schemas.max_version)
+
+    def _downgrade(self, obj, relation):
+        """Convert an object to the version agreed on for the relation."""
+        return schemas.convert(obj, self._schema(relation).version)
 
     def _schema(self, relation=None):
         if relation is None:
             return schemas.versions[schemas.max_version]
         if relation.app not in relation.data:
             return None
-        data = relation.data[relation.app]
+        data = self._data(relation, relation.app)
         if "version" not in data:
             return None
         remote_version = int(data["version"])
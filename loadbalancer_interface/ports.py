@@ -0,0 +1,141 @@
+"""Intervals of front-end ports, for checking requests' ports against each other.
+
+Requests listen on individual ports (the keys of `port_mapping`) as well as on
+whole ranges of ports (`port_ranges`), which can be thousands of ports wide, so
+ports are handled as intervals of `(start, end, transport)`, where `end` is
+inclusive, rather than one by one. All of the protocols other than UDP are
+carried over TCP, so they share the same ports.
+"""
+
+from bisect import bisect_right
+from collections import defaultdict
+
+
+def transport(protocol):
+    """Get the transport ("tcp" or "udp") which a protocol is carried over."""
+    return "udp" if str(protocol) == "udp" else "tcp"
+
+
+def listeners(request):
+    """The front-end port intervals that a request listens on."""
+    proto = transport(request.protocol)
+    intervals = [(port, port, proto) for port in request.port_mapping]
+    for port_range in getattr(request, "port_ranges", ()):
+        intervals.append((port_range.front_start, port_range.front_end, proto))
+    return merge(intervals)
+
+
+def merge(intervals):
+    """Merge intervals which overlap or are adjacent, sorted by transport and port."""
+    merged = []
+    for start, end, proto in sorted(intervals, key=lambda i: (i[2], i[0], i[1])):
+        if merged and merged[-1][2] == proto and start <= merged[-1][1] + 1:
+            last = merged[-1]
+            merged[-1] = (last[0], max(last[1], end), proto)
+        else:
+            merged.append((start, end, proto))
+    return merged
+
+
+def overlap(interval, other):
+    """Get the interval where two intervals overlap, or `None`."""
+    start, end = max(interval[0], other[0]), min(interval[1], other[1])
+    if interval[2] != other[2] or start > end:
+        return None
+    return (start, end, interval[2])
+
+
+def intersect(intervals, others):
+    """Get the parts of the intervals which are also covered by the others."""
+    found = (overlap(interval, other) for interval in intervals for other in others)
+    return merge(interval for interval in found if interval)
+
+
+def subtract(intervals, others):
+    """Get the parts of the intervals which aren't covered by any of the others."""
+    remaining = list(intervals)
+    for other in others:
+        pieces = []
+        for interval in remaining:
+            if overlap(interval, other) is None:
+                pieces.append(interval)
+                continue
+            start, end, proto = interval
+            if start < other[0]:
+                pieces.append((start, other[0] - 1, proto))
+            if end > other[1]:
+                pieces.append((other[1] + 1, end, proto))
+        remaining = pieces
+    return merge(remaining)
+
+
+def ports(interval):
+    """Get the port of a single port interval, or the `range` of ports."""
+    start, end, _ = interval
+    return start if start == end else range(start, end + 1)
+
+
+def interval_key(interval):
+    """Get the string form of an interval (e.g., "443/tcp" or "1000-1999/udp")."""
+    start, end, proto = interval
+    if start == end:
+        return "{}/{}".format(start, proto)
+    return "{}-{}/{}".format(start, end, proto)
+
+
+def parse_interval_key(key):
+    """Get the interval from its string form."""
+    span, proto = key.split("/")
+    start, _, end = span.partition("-")
+    return (int(start), int(end or start), proto)
+
+
+class IntervalIndex:
+    """A set of disjoint intervals, each with an owner.
+
+    The intervals for each transport are kept sorted, so that the owner of a
+    port, or the intervals overlapping another, can be found by bisection.
+    """
+
+    def __init__(self):
+        self._starts = defaultdict(list)
+        self._entries = defaultdict(list)
+
+    def add(self, interval, owner):
+        start, end, proto = interval
+        idx = bisect_right(self._starts[proto], start)
+        self._starts[proto].insert(idx, start)
+        self._entries[proto].insert(idx, (start, end, owner))
+
+    def intervals(self):
+        """Get all of the intervals, sorted by transport and port."""
+        return [
+            (start, end, proto)
+            for proto, entries in sorted(self._entries.items())
+            for start, end, _ in entries
+        ]
+
+    def owner(self, port, proto):
+        """Get the owner of the interval containing a port, or `None`."""
+        idx = bisect_right(self._starts.get(proto, []), port) - 1
+        if idx >= 0:
+            _, end, owner = self._entries[proto][idx]
+            if end >= port:
+                return owner
+        return None
+
+    def overlapping(self, interval):
+        """Get the `(overlap, owner)` pairs for each interval overlapping the
+        given one, in order.
+        """
+        start, end, proto = interval
+        entries = self._entries.get(proto, [])
+        idx = bisect_right(self._starts.get(proto, []), end) - 1
+        found = []
+        # Since the intervals are disjoint, their ends are in order as well.
+        while idx >= 0 and entries[idx][1] >= start:
+            entry_start, entry_end, owner = entries[idx]
+            found.append(((max(entry_start, start), min(entry_end, end), proto), owner))
+            idx -= 1
+        found.reverse()
+        return found
@@ -0,0 +1,151 @@
+"""Opt-in profiling of the interface code paths.
+
+When enabled, every handler, method, and property of the interface classes is
+profiled with `cProfile`, and a profile file is written for each hook which used
+them, so that it's possible to tell where the time goes in a slow hook (e.g.,
+schema loading, JSON, hashing, or calls to Juju).
+
+Profiling is enabled by setting the `LB_INTERFACE_PROFILE` environment variable
+to a true value, or by setting it to `config` and the charm having a
+`lb-interface-profile` config option which is set to true. The config is only
+read in the latter case, since the interfaces are created in every hook. The
+profiles are written to the `.lb-interface-profiles`
+directory in the charm directory (or to `LB_INTERFACE_PROFILE_DIR`), keeping
+only the most recent `LB_INTERFACE_PROFILE_KEEP` (default: 20) of them. They
+can be read with `pstats`.
+
+When not enabled, nothing is wrapped, so there is no overhead at all.
+"""
+
+import cProfile
+import os
+import pstats
+import weakref
+from datetime import datetime, timezone
+from functools import wraps
+from pathlib import Path
+from types import FunctionType
+
+from ops.framework import Object
+
+
+ENV_VAR = "LB_INTERFACE_PROFILE"
+DIR_ENV_VAR = "LB_INTERFACE_PROFILE_DIR"
+KEEP_ENV_VAR = "LB_INTERFACE_PROFILE_KEEP"
+CONFIG_OPTION = "lb-interface-profile"
+DEFAULT_DIR = ".lb-interface-profiles"
+DEFAULT_KEEP = 20
+
+_TRUE_VALUES = ("1", "true", "yes", "on")
+_CONFIG_VALUE = "config"
+
+_profilers = weakref.WeakKeyDictionary()
+_profiled_classes = {}
+
+
+def is_enabled(charm):
+    """Whether profiling has been enabled for the given charm."""
+    flag = os.environ.get(ENV_VAR, "").lower()
+    if flag != _CONFIG_VALUE:
+        return flag in _TRUE_VALUES
+    value = charm.config.get(CONFIG_OPTION)
+    if isinstance(value, str):
+        return value.lower() in _TRUE_VALUES
+    return bool(value)
+
+
+def instrument(obj):
+    """Start profiling the given interface object."""
+    obj._profiler = HookProfiler.get(obj.charm)
+    obj.__class__ = profiled_class(type(obj))
+
+
+def profiled_class(cls):
+    """Get a subclass of the given class with every member profiled."""
+    if cls not in _profiled_classes:
+        namespace = {}
+        for klass in reversed(cls.mro()):
+            if not klass.__module__.startswith(__package__ + "."):
+                continue
+            for name, value in vars(klass).items():
+                if name.startswith("__"):
+                    continue
+                if isinstance(value, FunctionType):
+                    namespace[name] = _profiled(value)
+                elif isinstance(value, property):
+                    namespace[name] = property(
+                        _profiled(value.fget),
+                        value.fset and _profiled(value.fset),
+                        value.fdel and _profiled(value.fdel),
+                        value.__doc__,
+                    )
+        _profiled_classes[cls] = type(cls.__name__, (cls,), namespace)
+    return _profiled_classes[cls]
+
+
+def _profiled(func):
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        return self._profiler.call(func, self, *args, **kwargs)
+
+    return wrapper
+
+
+class HookProfiler(Object):
+    """Collects a single profile for all of the interface calls in a hook.
+
+    Nested calls are only profiled by the outermost call, and the profile is
+    written out when the framework commits at the end of the hook.
+    """
+
+    def __init__(self, charm):
+        super().__init__(charm.framework, "lb-interface-profiler")
+        self.directory = Path(
+            os.environ.get(DIR_ENV_VAR) or Path(charm.charm_dir) / DEFAULT_DIR
+        )
+        self.keep = int(os.environ.get(KEEP_ENV_VAR, DEFAULT_KEEP))
+        self._profile = None
+        self._depth = 0
+        self.framework.observe(self.framework.on.commit, self._on_commit)
+
+    @classmethod
+    def get(cls, charm):
+        """Get the profiler shared by all of the interfaces in a charm."""
+        framework = charm.framework
+        if framework not in _profilers:
+            _profilers[framework] = cls(charm)
+        return _profilers[framework]
+
+    def call(self, func, *args, **kwargs):
+        if self._depth:
+            return func(*args, **kwargs)
+        if self._profile is None:
+            self._profile = cProfile.Profile()
+        self._depth += 1
+        self._profile.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._profile.disable()
+            self._depth -= 1
+
+    def _on_commit(self, event):
+        self.save()
+
+    def save(self):
+        """Write out the profile for the current hook, if there is one."""
+        if self._profile is None:
+            return None
+        profile, self._profile = self._profile, None
+        hook = os.environ.get("JUJU_DISPATCH_PATH", "hook").split("/")[-1]
+        timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / "{}-{}-{}.prof".format(timestamp, os.getpid(), hook)
+        pstats.Stats(profile).dump_stats(str(path))
+        self._rotate()
+        return path
+
+    def _rotate(self):
+        profiles = sorted(self.directory.glob("*.prof"))
+        for old in profiles[: max(len(profiles) - self.keep, 0)]:
+            old.unlink()
@@ -1,7 +1,14 @@
+import json
 import logging
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from itertools import chain, zip_longest
 from operator import attrgetter
+from time import monotonic, time
 
-from cached_property import cached_property
 from marshmallow import ValidationError
 
 from ops.framework import (
@@ -11,12 +18,104 @@ from ops.framework import (
     ObjectEvents,
 )
 
-from .base import VersionedInterface
+from . import schemas
+from .base import VersionedInterface, content_hash, digest_entry, scan_hash
+from .ports import (
+    IntervalIndex,
+    interval_key,
+    intersect,
+    listeners,
+    merge,
+    parse_interval_key,
+    ports,
+    subtract,
+    transport,
+)
+from .schemas.addresses import normalize_address, normalize_addresses
 
 
 log = logging.getLogger(__name__)
 
 
+_PortIndex = namedtuple("_PortIndex", "owners conflicts")
+
+# A request which was rejected for exceeding one of the quotas, without being
+# processed, along with the error to send back for it.
+_Rejection = namedtuple("_Rejection", "relation name sent_hash quota message")
+
+ProcessResult = namedtuple("ProcessResult", "processed remaining")
+ProcessResult.__doc__ = """The result of `LBConsumers.process_requests`.
+
+  * `processed` The requests which were passed to the handler, in order
+  * `remaining` How many new requests were left for a later hook
+"""
+
+
+def _rejection_key(relation, name):
+    return "{}/{}".format(relation.id, name)
+
+
+def _size(sdata):
+    """The size of some serialized data, in bytes."""
+    return len(sdata.encode("utf8"))
+
+
+def _first_port(ports):
+    return ports if isinstance(ports, int) else ports.start
+
+
+def _parse_request(version, request_sdata, response_sdata):
+    """Load a request (and its response) in a worker process.
+
+    Any error is returned rather than raised, so that it can be raised again
+    at the point where loading the request serially would have raised it.
+    """
+    try:
+        request = schemas.versions[version].Request.loads(request_sdata, response_sdata)
+        return schemas.convert(request, schemas.max_version), None
+    except Exception as e:
+        return None, e
+
+
+class ListenerGroup:
+    """A group of requests which can share a single load balancer.
+
+    All of the requests in a group have the same values for the fields in
+    `LBConsumers.shared_fields`, and none of their front-end ports collide, so
+    they can each be a listener on the same load balancer.
+    """
+
+    def __init__(self, id, settings):
+        self.id = id
+        self.settings = dict(settings)
+        self.requests = []
+        self._ports = IntervalIndex()
+
+    @property
+    def port_ranges(self):
+        """The front-end ports used by the group, as `(start, end, transport)`."""
+        return merge(self._ports.intervals())
+
+    @property
+    def listeners(self):
+        """The front-end ports used by the group, as `(port, transport)` pairs."""
+        return {
+            (port, proto)
+            for start, end, proto in self._ports.intervals()
+            for port in range(start, end + 1)
+        }
+
+    def accepts(self, request, settings):
+        if dict(settings) != self.settings:
+            return False
+        return not any(self._ports.overlapping(span) for span in listeners(request))
+
+    def add(self, request):
+        self.requests.append(request)
+        for span in listeners(request):
+            self._ports.add(span, request)
+
+
 class LBRequestsChanged(EventBase):
     pass
 
@@ -31,19 +130,50 @@ class LBConsumers(VersionedInterface):
     state = StoredState()
     on = LBConsumersEvents()
 
-    def __init__(self, charm, relation_name):
-        super().__init__(charm, relation_name)
+    # Request fields which apply to a load balancer as a whole, rather than to a
+    # single listener on it, so requests have to agree on them to share one.
+    shared_fields = (
+        "public",
+        "tls_termination",
+        "tls_cert",
+        "tls_key",
+        "ingress_address",
+    )
+
+    def __init__(self, charm, relation_name, *, peer_relation=None, unit_of_work=False):
+        super().__init__(
+            charm, relation_name, peer_relation=peer_relation, unit_of_work=unit_of_work
+        )
         self.relation_name = relation_name
-        self.state.set_default(known_requests={})
+        self.state.set_default(known_requests={}, acked_digest={})
 
         for event in (
             charm.on[relation_name].relation_created,
             charm.on[relation_name].relation_joined,
             charm.on[relation_name].relation_changed,
+            # Departing units change the default backends.
+            charm.on[relation_name].relation_departed,
+            # A new leader has to pick up any requests not yet responded to.
+            charm.on.leader_elected,
         ):
             self.framework.observe(event, self._check_consumers)
 
         self.state.set_default(follower_can_read_requests=False)
+        self.state.set_default(listener_groups={}, next_listener_group=0)
+        self.state.set_default(port_owners={})
+        self.state.set_default(process_cursor=None)
+        self.state.set_default(rejected_requests={})
+        self.max_requests = None
+        self.max_request_size = None
+        self.max_backends = None
+        self.state.set_default(response_cache={})
+        self.response_cache_ttl = None
+        self.response_cache_size = 0
+        self.state.set_default(default_backends={})
+        self.backend_debounce = None
+        self.parallel_threshold = None
+        self.parallel_workers = None
+        self._prefetched = {}
 
     def follower_perms(self, *, read: bool = None) -> "LBConsumers":
         """Set permissions on the relation for non-leader units"""
@@ -51,11 +181,101 @@ class LBConsumers(VersionedInterface):
             self.state.follower_can_read_requests = read
         return self
 
+    def set_quotas(
+        self, *, max_requests=None, max_request_size=None, max_backends=None
+    ):
+        """Limit what each consumer relation can request.
+
+        Requests which exceed any of the quotas are not processed (so they
+        don't show up in `all_requests` or `new_requests`), and the leader
+        automatically sends an error response for them instead.
+
+          * `max_requests` The maximum number of requests per relation. Requests
+            which have already been responded to are kept over new ones.
+          * `max_request_size` The maximum size of each serialized request, in
+            bytes (UTF-8), which is checked before it's parsed.
+          * `max_backends` The maximum number of backends in each request.
+        """
+        self.max_requests = max_requests
+        self.max_request_size = max_request_size
+        self.max_backends = max_backends
+        self._cache.invalidate()
+        return self
+
+    def set_response_cache(self, *, ttl=3600, max_entries=100):
+        """Remember successful responses by the content of their requests.
+
+        Equivalent requests (from the same application, with the same content
+        other than the `id` and `sent_hash`) which are received within `ttl`
+        seconds can then be answered with `reuse_response`, such as when a
+        relation is removed and re-added or a request is re-sent. At most
+        `max_entries` are kept, dropping the oldest first. Reusing an entry
+        doesn't refresh it, so it keeps the ID of the request it was made for.
+        """
+        self.response_cache_ttl = ttl
+        self.response_cache_size = max_entries
+        self._expire_responses()
+        return self
+
+    def set_backend_debounce(self, window):
+        """Batch changes to the default backends of requests.
+
+        Requests which don't list their own backends get the addresses of all
+        of the consumer's units, so every unit which joins or departs changes
+        them. With a debounce `window` (in seconds), changes to the units are
+        held back until they have been pending for that long, and then applied
+        on the next hook (checking again on every `update-status`). All of the
+        changes within the window, such as from a rolling restart, are then
+        applied at once, and any which are undone within it aren't applied.
+        """
+        if self.backend_debounce is None:
+            self.framework.observe(self.charm.on.update_status, self._on_update_status)
+        self.backend_debounce = window
+        self._cache.invalidate()
+        return self
+
+    def set_parallel_parsing(self, threshold=500, *, workers=None):
+        """Parse requests in a pool of processes when there are many of them.
+
+        When more than `threshold` requests need to be parsed at once, their
+        raw data is read in this process, but they are parsed and validated
+        by a pool of `workers` processes (by default, one per CPU). The results
+        are the same as parsing them serially, including which requests fail
+        to load and the errors logged for them.
+        """
+        self.parallel_threshold = threshold
+        self.parallel_workers = workers
+        return self
+
+    @property
+    def backends_pending(self):
+        """Whether there are changes to the default backends being held back."""
+        return any(
+            entry["pending_since"] is not None
+            for entry in self.state.default_backends.values()
+        )
+
+    def _on_update_status(self, event):
+        now = time()
+        for relation in self.relations:
+            entry = self.state.default_backends.get(str(relation.id))
+            if entry is None or entry["pending_since"] is None:
+                continue
+            if now - entry["pending_since"] >= self.backend_debounce:
+                self._cache.invalidate(relation)
+        self._check_consumers(event)
+
     def _check_consumers(self, event):
+        current_ids = {str(relation.id) for relation in self.relations}
+        for relation_id in self.state.default_backends.keys() - current_ids:
+            del self.state.default_backends[relation_id]
+        if self.unit.is_leader():
+            self._send_rejections()
+            self._assign_requests()
         if self.is_changed:
             self.on.requests_changed.emit()
 
-    @cached_property
+    @property
     def all_requests(self):
         """A list of all current consumer requests."""
         follower = not self.unit.is_leader()
@@ -68,40 +288,581 @@ class LBConsumers(VersionedInterface):
             * Only the leader may read from relation.data[self.app]
             """
             return []
+        relations = self.relations
+        return self._cache.view(
+            "all_requests",
+            relations,
+            partial(self._load_requests, relations, follower),
+            follower,
+        )
+
+    def get_request(self, relation_id, name):
+        """Get a single request by relation ID and name, such as those given by
+        `digest_changes`, without loading any of the others.
+
+        Returns `None` if there's no such request, if it can't be loaded or
+        exceeds the quotas, or if this unit isn't allowed to read requests.
+        """
+        follower = not self.unit.is_leader()
+        if follower and not self.state.follower_can_read_requests:
+            return None
+        relation = next((r for r in self.relations if r.id == relation_id), None)
+        if relation is None:
+            return None
+        if name not in self._request_names(relation, follower)[0]:
+            return None
+        load = partial(self._load_request, relation, name, follower)
+        request = self._cache.entry(relation, name, load, follower)
+        if request is None or isinstance(request, _Rejection):
+            return None
+        return request
+
+    def _load_requests(self, relations, follower):
         requests = []
-        for relation in self.relations:
+        for request in self._load_entries(relations, follower):
+            if request is None or isinstance(request, _Rejection):
+                continue
+            requests.append(request)
+            self.state.known_requests.setdefault(request.id, None)
+        return requests
+
+    def _load_entries(self, relations, follower):
+        """Load the entries for the requests from all of the relations."""
+        if self.parallel_threshold is not None:
+            self._prefetch_requests(relations, follower)
+        try:
+            return [
+                entry
+                for relation in relations
+                for entry in self._request_entries(relation, follower)
+            ]
+        finally:
+            self._prefetched.clear()
+
+    def _prefetch_requests(self, relations, follower):
+        """Parse the requests which aren't cached in a process pool, if there
+        are enough of them to be worth it.
+        """
+        pending = []
+        for relation in relations:
             schema = self._schema(relation)
-            local_data = {} if follower else relation.data[self.app]
-            remote_data = relation.data[relation.app]
+            if schema is None:
+                continue
+            local_data = {} if follower else self._data(relation, self.app)
+            remote_data = self._data(relation, relation.app)
+            for name in self._request_names(relation, follower)[0]:
+                if self._cache.has_entry(relation, name, follower):
+                    continue
+                request_sdata = remote_data["request_" + name]
+                if self.max_request_size is not None:
+                    if _size(request_sdata) > self.max_request_size:
+                        continue
+                response_sdata = local_data.get("response_" + name)
+                pending.append(
+                    (relation.id, name, schema.version, request_sdata, response_sdata)
+                )
+        if len(pending) <= self.parallel_threshold:
+            return
+        # Splitting the work into a few chunks per worker keeps the overhead of
+        # passing the data between processes low.
+        workers = self.parallel_workers or os.cpu_count() or 1
+        chunksize = max(1, len(pending) // (workers * 4))
+        _, _, versions, request_sdatas, response_sdatas = zip(*pending)
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(
+                    pool.map(
+                        _parse_request,
+                        versions,
+                        request_sdatas,
+                        response_sdatas,
+                        chunksize=chunksize,
+                    )
+                )
+        except (OSError, BrokenProcessPool):
+            # E.g., if the environment doesn't allow creating processes.
+            log.warning("Unable to parse requests in parallel", exc_info=True)
+            return
+        for (relation_id, name, _, *sdata), result in zip(pending, results):
+            self._prefetched[(relation_id, name)] = (*sdata, result)
+
+    def _request_names(self, relation, follower):
+        """Get the names of the requests from a relation which are within the
+        request quota, and those which are over it.
+        """
+        remote_data = self._data(relation, relation.app)
+        names = [
+            key[len("request_") :]
+            for key in sorted(remote_data.keys())
+            if key.startswith("request_")
+        ]
+        over_quota = []
+        if self.max_requests is not None and len(names) > self.max_requests:
+            names.sort(key=partial(self._quota_precedence, relation, follower))
+            names, over_quota = names[: self.max_requests], names[self.max_requests :]
+        return names, over_quota
+
+    def _request_entries(self, relation, follower):
+        """Load each of the requests from a relation, or the reason it was
+        rejected.
+        """
+        remote_data = self._data(relation, relation.app)
+        names, over_quota = self._request_names(relation, follower)
+        entries = [
+            self._cache.entry(
+                relation,
+                name,
+                partial(self._load_request, relation, name, follower),
+                follower,
+            )
+            for name in names
+        ]
+        message = "Too many requests (limit {})".format(self.max_requests)
+        for name in sorted(over_quota):
+            sent_hash = scan_hash(remote_data["request_" + name], "sent_hash")
+            entries.append(
+                _Rejection(relation, name, sent_hash, "max_requests", message)
+            )
+        return entries
+
+    def _quota_precedence(self, relation, follower, name):
+        # Requests which have already been responded to are kept over new ones,
+        # so that adding a request can't break another.
+        local_data = {} if follower else self._data(relation, self.app)
+        quota = self.state.rejected_requests.get(_rejection_key(relation, name))
+        return ("response_" + name not in local_data or quota == "max_requests", name)
+
+    def _load_request(self, relation, name, follower):
+        schema = self._schema(relation)
+        local_data = {} if follower else self._data(relation, self.app)
+        remote_data = self._data(relation, relation.app)
+        key = "request_" + name
+        request_sdata = remote_data[key]
+        if self.max_request_size is not None:
+            size = _size(request_sdata)
+            if size > self.max_request_size:
+                message = "Request too large ({} > {} bytes)".format(
+                    size, self.max_request_size
+                )
+                sent_hash = scan_hash(request_sdata, "sent_hash")
+                return _Rejection(
+                    relation, name, sent_hash, "max_request_size", message
+                )
+        response_sdata = local_data.get("response_" + name)
+        prefetched = self._prefetched.pop((relation.id, name), None)
+        try:
+            if prefetched and prefetched[:2] == (request_sdata, response_sdata):
+                request, error = prefetched[2]
+                if error is not None:
+                    raise error
+            else:
+                request = schema.Request.loads(request_sdata, response_sdata)
+                request = self._upgrade(request)
+            request = self._resolve_tls(request, remote_data)
+        except ValidationError:
+            log.exception("Failed to load request {}".format(key))
+            return None
+        request.relation = relation
+        if self.max_backends is not None:
+            if len(request.backends) > self.max_backends:
+                message = "Too many backends ({} > {})".format(
+                    len(request.backends), self.max_backends
+                )
+                return _Rejection(
+                    relation, name, request.sent_hash, "max_backends", message
+                )
+        if not request.backends:
+            request.backends = self._default_backends(relation)
+        return request
+
+    def _default_backends(self, relation):
+        # Shared by all of the requests from the relation, so that they agree
+        # even if the debounce window ends part way through loading them.
+        load = partial(self._load_default_backends, relation)
+        return list(self._cache.entry(relation, None, load, "default_backends"))
+
+    def _load_default_backends(self, relation):
+        addrs = [
+            self._data(relation, unit).get("ingress-address") for unit in relation.units
+        ]
+        current = normalize_addresses(addr for addr in addrs if addr)
+        if self.backend_debounce is None:
+            return current
+        backends = self.state.default_backends
+        key = str(relation.id)
+        entry = backends.get(key)
+        if entry is None:
+            backends[key] = {"backends": current, "pending_since": None}
+            return current
+        settled = list(entry["backends"])
+        if settled == current:
+            if entry["pending_since"] is not None:
+                # The changes were undone within the window.
+                entry["pending_since"] = None
+            return current
+        now = time()
+        if entry["pending_since"] is None:
+            entry["pending_since"] = now
+        elif now - entry["pending_since"] >= self.backend_debounce:
+            backends[key] = {"backends": current, "pending_since": None}
+            return current
+        return settled
+
+    @property
+    def _rejections(self):
+        relations = self.relations
+        load = partial(self._load_rejections, relations)
+        return self._cache.view("rejections", relations, load)
+
+    def _load_rejections(self, relations):
+        return [
+            entry
+            for entry in self._load_entries(relations, False)
+            if isinstance(entry, _Rejection)
+        ]
+
+    def _send_rejections(self):
+        """Send error responses for the requests which exceed the quotas, and
+        remove them once the rejected requests are removed.
+        """
+        schema = self._schema()
+        rejected = {}
+        for rejection in self._rejections:
+            key = _rejection_key(rejection.relation, rejection.name)
+            if key not in self.state.rejected_requests:
+                log.warning(
+                    "Rejecting request {} from {}: {}".format(
+                        rejection.name, rejection.relation.app.name, rejection.message
+                    )
+                )
+            rejected[key] = rejection.quota
+            request = schema.Request()
+            request.name = rejection.name
+            request.relation = rejection.relation
+            response = request.response
+            response.error = response.error_types.unsupported
+            if rejection.quota == "max_backends":
+                response.error_fields = {"backends": rejection.message}
+            else:
+                response.error_message = rejection.message
+            response.received_hash = rejection.sent_hash
+            self._write_response(request)
+        relations = {relation.id: relation for relation in self.relations}
+        for key in self.state.rejected_requests.keys() - rejected.keys():
+            relation_id, name = key.split("/", 1)
+            relation = relations.get(int(relation_id))
+            if relation is None:
+                continue
+            if "request_" + name not in self._data(relation, relation.app):
+                self._data(relation, self.app).pop("response_" + name, None)
+                self._cache.invalidate(relation, name)
+        if rejected != self.state.rejected_requests:
+            self.state.rejected_requests = rejected
+
+    def _digest_entries(self):
+        digest = {}
+        for relation in self.relations:
+            remote_data = self._data(relation, relation.app)
+            local_data = self._data(relation, self.app)
             for key, request_sdata in sorted(remote_data.items()):
                 if not key.startswith("request_"):
                     continue
                 name = key[len("request_") :]
                 response_sdata = local_data.get("response_" + name)
-                try:
-                    request = schema.Request.loads(request_sdata, response_sdata)
-                except ValidationError:
-                    log.exception("Failed to load request {}".format(key))
-                    continue
-                request.relation = relation
-                if not request.backends:
-                    for unit in sorted(relation.units, key=attrgetter("name")):
-                        addr = relation.data[unit].get("ingress-address")
-                        if addr:
-                            request.backends.append(addr)
-                requests.append(request)
-                self.state.known_requests.setdefault(request.id, None)
-        return requests
+                digest.setdefault(str(relation.id), {})[name] = digest_entry(
+                    request_sdata, response_sdata
+                )
+        return digest
+
+    @property
+    def listener_groups(self):
+        """A list of `ListenerGroup`s which the current requests are grouped into.
+
+        Requests stay in the group they were first assigned to as long as they
+        remain compatible with it, so that load balancers aren't shuffled around
+        as other requests come and go. New or changed requests are added to the
+        first compatible group, or to a new group if there isn't one.
+        """
+        follower = not self.unit.is_leader()
+        requests = self.all_requests
+        load = partial(self._load_listener_groups, requests)
+        return self._cache.view("listener_groups", self.relations, load, follower)
+
+    def _load_listener_groups(self, requests):
+        old_assignments = self._get_shared("listener_groups")
+        assignments = dict(old_assignments)
+        next_group = self._get_shared("next_listener_group")
+        groups = {}
+        by_settings = {}
+        unassigned = []
+
+        def _add_group(group_id, settings):
+            group = groups[group_id] = ListenerGroup(group_id, settings)
+            by_settings.setdefault(settings, []).append(group)
+            return group
+
+        def _key(item):
+            position, request = item
+            group_id = assignments.get(request.id)
+            return (group_id is None, group_id or 0, position)
+
+        for _, request in sorted(enumerate(requests), key=_key):
+            settings = self._shared_settings(request)
+            group_id = assignments.get(request.id)
+            if group_id is None:
+                unassigned.append((request, settings))
+                continue
+            group = groups.get(group_id) or _add_group(group_id, settings)
+            if group.accepts(request, settings):
+                group.add(request)
+            else:
+                unassigned.append((request, settings))
+        for request, settings in unassigned:
+            candidates = by_settings.get(settings, [])
+            for group in candidates:
+                if group.accepts(request, settings):
+                    break
+            else:
+                group = _add_group(next_group, settings)
+                next_group += 1
+            group.add(request)
+            assignments[request.id] = group.id
+        current_ids = {request.id for request in requests}
+        for request_id in assignments.keys() - current_ids:
+            del assignments[request_id]
+        if assignments != old_assignments:
+            self._set_shared("listener_groups", assignments)
+        if next_group != self._get_shared("next_listener_group"):
+            self._set_shared("next_listener_group", next_group)
+        return sorted(groups.values(), key=attrgetter("id"))
+
+    def port_owner(self, port, protocol="tcp"):
+        """Get the request which owns a given front-end port, if any.
+
+        The protocol can be any of the `Request.protocols`, but all of the
+        protocols other than UDP share the same (TCP) ports.
+        """
+        return self._port_index.owners.owner(port, transport(protocol))
+
+    def port_conflicts(self, request):
+        """Get the front-end ports of a request which are owned by other requests.
+
+        Returns a mapping of `(ports, "tcp" or "udp")` to the owning request,
+        where `ports` is either a single port or, for a run of more than one
+        port owned by the same request, a `range` of ports.
+        """
+        return self._port_index.conflicts.get(request.id, {})
+
+    def check_port_conflicts(self, request):
+        """Check a request for front-end ports owned by other requests.
+
+        If there are any, the request's response is filled in with an error
+        for the `port_mapping` or `port_ranges` field (whichever the ports came
+        from), ready to be sent, and `True` is returned.
+        """
+        conflicts = self.port_conflicts(request)
+        if not conflicts:
+            return False
+        errors = {}
+        for (taken, proto), owner in sorted(
+            conflicts.items(), key=lambda item: (item[0][1], _first_port(item[0][0]))
+        ):
+            single = [taken] if isinstance(taken, int) else taken
+            field = "port_ranges"
+            if any(port in request.port_mapping for port in single):
+                field = "port_mapping"
+            errors.setdefault(field, []).append(
+                "{} in use by {}:{}".format(
+                    interval_key((single[0], single[-1], proto)),
+                    owner.relation.app.name,
+                    owner.name,
+                )
+            )
+        response = request.response
+        response.error = response.error_types.unsupported
+        response.error_fields = {
+            field: "; ".join(messages) for field, messages in errors.items()
+        }
+        return True
+
+    @property
+    def _port_index(self):
+        """Which request owns each front-end port, and which requests conflict.
+
+        Ports are owned by the first request to ask for them, and stay owned
+        by it for as long as it keeps asking for them. A request which asks for
+        any ports owned by other requests is in conflict, and doesn't take any
+        new ports until it is no longer in conflict.
+        """
+        follower = not self.unit.is_leader()
+        requests = self.all_requests
+        load = partial(self._load_port_index, requests)
+        return self._cache.view("port_index", self.relations, load, follower)
+
+    def _assign_requests(self):
+        """Record the ports claimed by the current requests, and the listener
+        groups they're assigned to.
+
+        This is done in every hook, so that it goes by the order the requests
+        arrive in, rather than by when the charm happens to check them.
+        """
+        self._port_index
+        self.listener_groups
+
+    def _load_port_index(self, requests):
+        # Claims are stored as intervals, keyed by "80/tcp" or "1000-1999/udp",
+        # so that large ranges of ports don't bloat the state.
+        claims = self._get_shared("port_owners")
+        previous = {}
+        for key, request_id in claims.items():
+            previous.setdefault(request_id, []).append(parse_interval_key(key))
+        owned = {}
+        owners = IntervalIndex()
+        for request in requests:
+            kept = intersect(listeners(request), previous.get(request.id, []))
+            for span in kept:
+                owners.add(span, request)
+            owned[request.id] = kept
+        conflicts = {}
+        for request in requests:
+            wanted = subtract(listeners(request), owned[request.id])
+            taken = {
+                (ports(overlap), overlap[2]): owner
+                for span in wanted
+                for overlap, owner in owners.overlapping(span)
+            }
+            if taken:
+                conflicts[request.id] = taken
+                continue
+            for span in wanted:
+                owners.add(span, request)
+            owned[request.id] = merge(owned[request.id] + wanted)
+        new_claims = {
+            interval_key(span): request_id
+            for request_id, spans in owned.items()
+            for span in spans
+        }
+        if new_claims != claims:
+            self._set_shared("port_owners", new_claims)
+        return _PortIndex(owners, conflicts)
+
+    def _get_shared(self, field):
+        """Get some state which every leader has to agree on, such as which
+        request owns each port.
+
+        With a `peer_relation`, this is kept in the peer relation's app data,
+        which any unit can read, so it carries over to a new leader. Otherwise,
+        it can only be kept in the `StoredState` of the unit, which is also
+        where it's read from until it has been written to the peer relation.
+        """
+        peer = self._peer
+        if peer is not None:
+            sdata = self._data(peer, self.app).get(field + "_" + self.relation_name)
+            if sdata:
+                return json.loads(sdata)
+        return getattr(self.state, field)
+
+    def _set_shared(self, field, value):
+        """Update some state which every leader has to agree on.
+
+        This is only done by the leader, and any other unit just uses the state
+        as the leader last recorded it.
+        """
+        if not self.unit.is_leader():
+            return
+        peer = self._peer
+        if peer is None:
+            setattr(self.state, field, value)
+            return
+        sdata = json.dumps(value, sort_keys=True, separators=(",", ":"))
+        key = field + "_" + self.relation_name
+        peer_data = self._data(peer, self.app)
+        if peer_data.get(key) != sdata:
+            peer_data[key] = sdata
+
+    def _shared_settings(self, request):
+        return tuple((field, getattr(request, field)) for field in self.shared_fields)
 
     @property
     def new_requests(self):
         """A list of requests with changes or no response."""
+        follower = not self.unit.is_leader()
+        known = self.state.known_requests
         return [
             request
             for request in self.all_requests
-            if request.hash != self.state.known_requests[request.id]
+            if self._request_hash(request, follower) != known.get(request.id)
         ]
 
+    def _request_hash(self, request, follower):
+        # Kept alongside the loaded request, so that it's only computed again
+        # once the request is reloaded.
+        load = partial(attrgetter("hash"), request)
+        return self._cache.entry(request.relation, request.name, load, follower, "hash")
+
+    def process_requests(
+        self,
+        handler,
+        *,
+        event=None,
+        max_requests=None,
+        max_seconds=None,
+        priority=None,
+    ):
+        """Pass the new requests to a handler until a budget is used up.
+
+        The `handler` is called with each request, and should send (or revoke)
+        its response. Requests are taken from each relation in `priority` order
+        (a sort key function; by default, requests which have never had a
+        response come first, then by name), and the relations take turns, so
+        that a consumer with many requests can't hold up the others. The next
+        call starts with the relation after the last one served.
+
+        Processing stops once `max_requests` have been handled or `max_seconds`
+        have passed, though at least one request is always handled. If any
+        requests are left and an `event` is given, it's deferred so that they
+        will be processed on the next hook.
+
+        Returns a `ProcessResult`.
+        """
+        if not self.unit.is_leader():
+            return ProcessResult([], 0)
+        queue = self._fair_order(self.new_requests, priority or self._priority)
+        deadline = None if max_seconds is None else monotonic() + max_seconds
+        processed = []
+        for request in queue:
+            if processed:
+                if max_requests is not None and len(processed) >= max_requests:
+                    break
+                if deadline is not None and monotonic() >= deadline:
+                    break
+            handler(request)
+            processed.append(request)
+            self.state.process_cursor = request.relation.id
+        remaining = len(queue) - len(processed)
+        if remaining and event is not None:
+            event.defer()
+        return ProcessResult(processed, remaining)
+
+    def _priority(self, request):
+        return (self.state.known_requests.get(request.id) is not None, request.name)
+
+    def _fair_order(self, requests, priority):
+        """Interleave the requests from each relation, starting with the relation
+        after the cursor.
+        """
+        by_relation = {}
+        for request in requests:
+            by_relation.setdefault(request.relation.id, []).append(request)
+        cursor = self.state.process_cursor
+        relation_ids = sorted(
+            by_relation, key=lambda rid: (cursor is not None and rid <= cursor, rid)
+        )
+        turns = zip_longest(
+            *(sorted(by_relation[rid], key=priority) for rid in relation_ids)
+        )
+        return [req for req in chain.from_iterable(turns) if req is not None]
+
     @property
     def removed_requests(self):
         """A list of requests which have been removed, either explicitly or
@@ -126,17 +887,112 @@ class LBConsumers(VersionedInterface):
             return
 
         request.response.received_hash = request.sent_hash
-        key = "response_" + request.name
-        request.relation.data[self.app][key] = request.response.dumps()
+        self._write_response(request)
         self.state.known_requests[request.id] = request.hash
+        if self.response_cache_size and not request.response.error:
+            self._cache_response(request)
+        try:
+            from charms.reactive import clear_flag
+        except ImportError:
+            return  # not being used in a reactive charm
+        # Checking for remaining changes is only needed for the flag, and is
+        # relatively costly with many requests, so it's only done when needed.
         if not self.new_requests:
-            try:
-                from charms.reactive import clear_flag
+            prefix = "endpoint." + self.relation_name
+            clear_flag(prefix + ".requests_changed")
+
+    def _write_response(self, request):
+        key = "response_" + request.name
+        # The response is sent in the schema version agreed on with the consumer.
+        response = self._downgrade(request.response, request.relation)
+        sdata = response.dumps()
+        local_data = self._data(request.relation, self.app)
+        if local_data.get(key) != sdata:
+            local_data[key] = sdata
+            self._cache.invalidate(request.relation, request.name)
 
-                prefix = "endpoint." + self.relation_name
-                clear_flag(prefix + ".requests_changed")
-            except ImportError:
-                pass  # not being used in a reactive charm
+    def reuse_response(self, request):
+        """Answer a request from the response cache, if possible.
+
+        If a response was sent to an equivalent request within the TTL of the
+        cache (see `set_response_cache`), it's filled in and sent as the
+        response to this request, and the ID of the request it was originally
+        sent for is returned, so that the load balancer for that request can
+        be reused. Otherwise, `None` is returned.
+        """
+        if not self.response_cache_size or not self.unit.is_leader():
+            return None
+        self._expire_responses()
+        entry = self.state.response_cache.get(self._content_key(request))
+        if entry is None:
+            return None
+        request_id = entry["request_id"]
+        request.response._load(json.loads(entry["response"]))
+        self.send_response(request)
+        return request_id
+
+    def _content_key(self, request):
+        data = request.dump()
+        for field in ("id", "sent_hash"):
+            data.pop(field, None)
+        content = json.dumps(data, sort_keys=True)
+        return content_hash(request.relation.app.name + ":" + content)
+
+    def _cache_response(self, request):
+        response = request.response.dump()
+        # These are specific to the request they were sent for.
+        for field in ("received_hash", "backend_health"):
+            response.pop(field, None)
+        key = self._content_key(request)
+        sdata = json.dumps(response, sort_keys=True)
+        entry = self.state.response_cache.get(key)
+        if entry is not None and entry["response"] == sdata:
+            # Nothing new to remember, such as when a cached response is reused,
+            # and the entry has to keep the ID of the request it was made for.
+            return
+        self.state.response_cache[key] = {
+            "request_id": request.id,
+            "response": sdata,
+            "time": time(),
+        }
+        self._expire_responses()
+
+    def _expire_responses(self):
+        cache = self.state.response_cache
+        if self.response_cache_ttl is not None:
+            cutoff = time() - self.response_cache_ttl
+            for key in [key for key, entry in cache.items() if entry["time"] < cutoff]:
+                del cache[key]
+        excess = len(cache) - self.response_cache_size
+        if excess > 0:
+            for key in sorted(cache, key=lambda key: cache[key]["time"])[:excess]:
+                del cache[key]
+
+    def update_backend_health(self, request, health):
+        """Update the health of some or all of the backends for a request.
+
+        The health should be a mapping of backend address to one of the
+        `response.health_states`; the addresses are normalized the same way as
+        the request's `backends`. Only entries which differ from what was last
+        sent are applied, and the response is only rewritten if any of them did
+        (or if any backends have since been removed). Returns whether or not the
+        response was rewritten.
+        """
+        response = request.response
+        current = response.backend_health
+        changed = False
+        for address in current.keys() - set(normalize_addresses(request.backends)):
+            del current[address]
+            changed = True
+        for address, status in health.items():
+            address = normalize_address(address)
+            status = response.health_states(status)
+            if current.get(address) != status:
+                current[address] = status
+                changed = True
+        if changed:
+            self.send_response(request)
+        return changed
 
     def revoke_response(self, request):
         """Revoke / remove the response for a given request."""
@@ -144,7 +1000,8 @@ class LBConsumers(VersionedInterface):
             self.state.known_requests.pop(request.id, None)
         if request.relation:
             key = "response_" + request.name
-            request.relation.data.get(self.app, {}).pop(key, None)
+            self._data(request.relation, self.app).pop(key, None)
+            self._cache.invalidate(request.relation, request.name)
 
     @property
     def is_changed(self):
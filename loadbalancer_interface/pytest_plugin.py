@@ -4,6 +4,8 @@ import shutil
 
 import pytest
 
+from .testing import RelationSimulator
+
 
 try:
     from importlib.resources import path as resource_path
@@ -37,6 +39,19 @@ def lb_charms(ops_test):
     return LBCharms(ops_test)
 
 
+@pytest.fixture
+def lb_relation_sim(request):
+    """Fixture which provides an in-memory `RelationSimulator` for testing.
+
+    Applications running charms which use `LBProvider` or `LBConsumers` can be
+    added to it and related, after which the relation data can be sent back and
+    forth without needing to deploy anything. See `loadbalancer_interface.testing`.
+    """
+    sim = RelationSimulator(model_name=request.node.originalname)
+    yield sim
+    sim.cleanup()
+
+
 class LBCharms:
     def __init__(self, ops_test):
         self._ops_test = ops_test
@@ -0,0 +1,118 @@
+"""Incremental rendering of load balancer configuration from requests.
+
+Providers generally have to turn all of the current requests into a single
+concrete configuration (such as an HAProxy or nginx config file), and then
+reload the load balancer to apply it. Regenerating everything and reloading on
+every change is wasteful and can drop connections, so `ConfigRenderer` keeps the
+fragment of configuration rendered for each request, only re-renders those whose
+requests have changed, and reports whether the assembled configuration actually
+differs from what was last rendered.
+"""
+
+import json
+from collections import namedtuple
+from hashlib import md5
+
+from ops.framework import Object, StoredState
+
+
+RenderResult = namedtuple("RenderResult", "config reload_needed rendered removed")
+RenderResult.__doc__ = """The result of `ConfigRenderer.render`.
+
+  * `config` The assembled configuration
+  * `reload_needed` Whether the configuration differs from the last one rendered
+  * `rendered` The requests whose fragments were (re-)rendered
+  * `removed` The IDs of the requests whose fragments were dropped
+"""
+
+
+def _request_order(request):
+    app = request.relation.app.name if request.relation else ""
+    return (app, request.name, request.id)
+
+
+def _join(fragments):
+    return "\n".join(fragments)
+
+
+class ConfigRenderer(Object):
+    """Renders configuration incrementally, one fragment per request.
+
+    The `render_request` function is called with a `Request` and should return
+    the fragment of configuration for it, or `None` to leave it out (e.g., if an
+    error response is being sent for it). The `assemble` function is called
+    with the list of fragments, in a stable order (by consumer application and
+    request name), and should return the full configuration; by default, the
+    fragments are joined with newlines.
+
+    Fragments are keyed by the hash of their request (or whatever `fragment_key`
+    returns for it, if given), and persisted in `StoredState`, so they're only
+    re-rendered when the request changes. If the way fragments are rendered
+    changes, such as on charm upgrade, a different `version` should be given to
+    drop all of the previously rendered fragments.
+
+    Since the state is only saved at the end of a successful hook, a failure to
+    apply the configuration leaves it to be rendered and reported again.
+    """
+
+    state = StoredState()
+
+    def __init__(
+        self,
+        charm,
+        key,
+        render_request,
+        *,
+        assemble=None,
+        fragment_key=None,
+        version=None,
+    ):
+        super().__init__(charm, key)
+        self.render_request = render_request
+        self.assemble = assemble or _join
+        self.fragment_key = fragment_key or (lambda request: request.hash)
+        self.version = version
+        self.state.set_default(fragments={}, digest=None, version=None)
+
+    def render(self, requests):
+        """Render the configuration for the given requests.
+
+        Returns a `RenderResult` with the assembled configuration and whether or
+        not the load balancer needs to be reloaded to apply it.
+        """
+        fragments = self.state.fragments
+        if self.state.version != self.version:
+            fragments.clear()
+            self.state.version = self.version
+        rendered = []
+        current = []
+        for request in sorted(requests, key=_request_order):
+            key = self.fragment_key(request)
+            cached = fragments.get(request.id)
+            if cached is None or cached["key"] != key:
+                fragment = self.render_request(request)
+                fragments[request.id] = {"key": key, "fragment": fragment}
+                rendered.append(request)
+            else:
+                fragment = cached["fragment"]
+            if fragment is not None:
+                current.append(fragment)
+        removed = sorted(fragments.keys() - {request.id for request in requests})
+        for request_id in removed:
+            del fragments[request_id]
+        config = self.assemble(current)
+        serialized = config
+        if not isinstance(config, str):
+            # E.g., the parameters for a cloud API.
+            serialized = json.dumps(config, sort_keys=True)
+        digest = md5(serialized.encode("utf8")).hexdigest()
+        reload_needed = digest != self.state.digest
+        self.state.digest = digest
+        return RenderResult(config, reload_needed, rendered, removed)
+
+    def reset(self):
+        """Drop all rendered fragments, so everything is re-rendered next time,
+        and consider the configuration to need reloading.
+        """
+        self.state.fragments = {}
+        self.state.digest = None
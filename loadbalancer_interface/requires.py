@@ -1,10 +1,15 @@
 import json
 import logging
+from collections import namedtuple
+from functools import partial
+from hashlib import md5
+from itertools import groupby
+from operator import attrgetter
 from uuid import uuid4
 
-from cached_property import cached_property
 from marshmallow import ValidationError
 
+from ops.charm import RelationBrokenEvent
 from ops.framework import (
     StoredState,
     EventBase,
@@ -13,12 +18,44 @@ from ops.framework import (
 )
 from ops.model import ModelError
 
-from .base import VersionedInterface
+from . import schemas
+from .base import (
+    TLS_PREFIX,
+    VersionedInterface,
+    content_hash,
+    digest_entry,
+    digest_hash,
+)
 
 
 log = logging.getLogger(__name__)
 
 
+_RequestRecord = namedtuple(
+    "_RequestRecord", "name request response response_hash complete"
+)
+
+
+def _shard_score(name, relation):
+    # Rendezvous hashing, so that requests only move between providers when
+    # the provider they are assigned to goes away.
+    key = "{}:{}".format(relation.app.name, name)
+    return md5(key.encode("utf8")).hexdigest()
+
+
+def _health_hash(response):
+    health = {addr: str(status) for addr, status in response.backend_health.items()}
+    if not health:
+        return None
+    return md5(json.dumps(health, sort_keys=True).encode("utf8")).hexdigest()
+
+
+def _record_rank(record):
+    # Prefer responses which are complete, then successful.
+    response = record.response
+    return (record.complete, record.response_hash is not None, not response.error)
+
+
 class LBProviderAvailable(EventBase):
     pass
 
@@ -31,25 +68,58 @@ class LBResponseChanged(EventBase):
     pass
 
 
+class LBBackendHealthChanged(EventBase):
+    pass
+
+
 class LBProviderEvents(ObjectEvents):
     available = EventSource(LBProviderAvailable)
     response_available = EventSource(LBResponseAvailable)
     response_changed = EventSource(LBResponseChanged)
+    backend_health_changed = EventSource(LBBackendHealthChanged)
 
 
 class LBProvider(VersionedInterface):
-    """API used to interact with the provider of loadbalancers."""
+    """API used to interact with the provider of loadbalancers.
+
+    By default, only a single provider can be related. If `distribution` is
+    given, multiple providers can be related and requests will be either
+    sharded across them (`LBProvider.SHARD`) or replicated to all of them
+    (`LBProvider.REPLICATE`). Either way, the responses are aggregated so that
+    there is at most one per request.
+    """
+
+    SHARD = "shard"
+    REPLICATE = "replicate"
 
     state = StoredState()
     on = LBProviderEvents()
 
-    def __init__(self, charm, relation_name):
-        super().__init__(charm, relation_name)
+    def __init__(
+        self,
+        charm,
+        relation_name,
+        *,
+        distribution=None,
+        peer_relation=None,
+        unit_of_work=False,
+    ):
+        if distribution not in (None, self.SHARD, self.REPLICATE):
+            raise ValueError("Invalid distribution: {}".format(distribution))
+        super().__init__(
+            charm, relation_name, peer_relation=peer_relation, unit_of_work=unit_of_work
+        )
         self.relation_name = relation_name
-        # just call this to enforce that only one app can be related
-        self.model.get_relation(relation_name)
+        self.distribution = distribution
+        if distribution is None:
+            # just call this to enforce that only one app can be related
+            self.model.get_relation(relation_name)
         self.state.set_default(
-            response_hashes={}, was_available=False, was_response_available=False
+            response_hashes={},
+            backend_health_hashes={},
+            acked_digest={},
+            was_available=False,
+            was_response_available=False,
         )
 
         for event in (
@@ -58,10 +128,14 @@ class LBProvider(VersionedInterface):
             charm.on[relation_name].relation_changed,
             charm.on[relation_name].relation_departed,
             charm.on[relation_name].relation_broken,
+            # The leader's view of the responses is based on the requests.
+            charm.on.leader_elected,
         ):
             self.framework.observe(event, self._check_provider)
 
     def _check_provider(self, event):
+        if isinstance(event, RelationBrokenEvent) and self.unit.is_leader():
+            self._move_requests(event.relation)
         if self.is_available:
             if not self.state.was_available:
                 self.state.was_available = True
@@ -69,19 +143,75 @@ class LBProvider(VersionedInterface):
             if not self.state.was_response_available:
                 self.state.was_response_available = True
                 self.on.response_available.emit()
+            self._prune_acks()
             if self.is_changed:
                 self.on.response_changed.emit()
+            if self.new_backend_health:
+                self.on.backend_health_changed.emit()
         elif self.state.was_available:
             self.state.was_available = False
             self.state.was_response_available = False
             if self.state.response_hashes:
                 self.state.response_hashes = {}
                 self.on.response_changed.emit()
+            self.state.backend_health_hashes = {}
+
+    def _prune_acks(self):
+        # Acks for requests which no longer exist at all will never be cleared
+        # by a revocation, such as when a response was acked by a non-leader
+        # after the request was removed, so they need to be dropped.
+        names = {record.name for record in self._snapshot}
+        for acked in (self.state.response_hashes, self.state.backend_health_hashes):
+            for name in acked.keys() - names:
+                del acked[name]
+
+    def _move_requests(self, relation):
+        """Re-send the requests which were sharded to a provider that's going
+        away to the providers they're now assigned to.
+
+        The responses from the old provider are gone with it, so they show up
+        as revoked until the new providers respond.
+        """
+        if self.distribution != self.SHARD or not self.relation:
+            return
+        # The remote data, including the version agreed on with the provider,
+        # can't be read any more, but the requests we sent can be.
+        local_data = self._data(relation, self.app)
+        for key in sorted(local_data.keys()):
+            if not key.startswith("request_"):
+                continue
+            request = self._load_orphan(local_data, key)
+            if request is not None:
+                self.send_request(request)
+
+    def _load_orphan(self, local_data, key):
+        for version in sorted(schemas.versions, reverse=True):
+            try:
+                request = schemas.versions[version].Request.loads(local_data[key])
+                return self._resolve_tls(self._upgrade(request), local_data)
+            except ValidationError:
+                continue
+        log.error("Failed to move request {}".format(key))
+        return None
 
     @property
     def relation(self):
         return self.relations[0] if self.relations else None
 
+    @property
+    def _providers(self):
+        """The provider relations which requests are sent to."""
+        if self.distribution is None:
+            return self.relations[:1]
+        return self.relations
+
+    def _targets(self, name):
+        """The provider relations which a given request should be sent to."""
+        providers = self._providers
+        if self.distribution == self.SHARD and providers:
+            return [max(providers, key=partial(_shard_score, name))]
+        return providers
+
     def get_request(self, name):
         """Get or create a Load Balancer Request object.
 
@@ -91,9 +221,30 @@ class LBProvider(VersionedInterface):
             raise ModelError("Unit is not leader")
         if not self.relation:
             raise ModelError("Relation not available")
-        schema = self._schema(self.relation)
-        local_data = self.relation.data[self.app]
-        remote_data = self.relation.data[self.relation.app]
+        # Look at the providers this request should go to first, but also fall
+        # back to any others that it was previously sent to, so that the request
+        # ID is preserved if providers have come or gone.
+        targets = self._targets(name)
+        relations = targets + [r for r in self._providers if r not in targets]
+        key = "request_" + name
+        found = [
+            relation for relation in relations if key in self._data(relation, self.app)
+        ]
+        if len(found) < 2:
+            relation = (found or relations)[0]
+            return self._load_request(relation, self._schema(relation), name)
+        records = [
+            self._load_record(relation, self._schema(relation), name, True)
+            for relation in found
+        ]
+        best = max(records, key=_record_rank)
+        request = records[0].request
+        request._response = best.response
+        return request
+
+    def _load_request(self, relation, schema, name):
+        local_data = self._data(relation, self.app)
+        remote_data = self._data(relation, relation.app)
         request_key = "request_" + name
         response_key = "response_" + name
         request = None
@@ -102,10 +253,12 @@ class LBProvider(VersionedInterface):
                 request_sdata = local_data[request_key]
                 response_sdata = remote_data.get(response_key)
                 request = schema.Request.loads(request_sdata, response_sdata)
+                request = self._resolve_tls(self._upgrade(request), local_data)
             except ValidationError:
                 log.exception("Failed to load request {}".format(request_key))
-        if not request:
-            request = schema.Request()
+                request = None
+        if request is None:
+            request = self._schema().Request()
             request.name = name
             request.id = uuid4().hex
         return request
@@ -116,18 +269,61 @@ class LBProvider(VersionedInterface):
         This is similar to `get_request(name).response`, except that it will return
         `None` if the response is not available and can be used by non-leaders.
         """
-        if not self.is_available:
+        responses = self.get_responses(name)
+        if not responses:
             return None
-        schema = self._schema(self.relation)
-        remote_data = self.relation.data[self.relation.app]
+        return max(responses, key=lambda response: not response.error)
+
+    def get_response_view(self, name):
+        """Get a lightweight, read-only view of a specific Load Balancer Response.
+
+        This is similar to `get_response(name)`, except that the response isn't
+        loaded up front: each field is only decoded when it's first read. This
+        makes it much cheaper for code which only needs a few of the fields, such
+        as setting the status on every hook. The view can't be acknowledged,
+        though, so `get_response` should still be used to handle the response.
+        """
+        views = []
+        for relation in self._providers:
+            load = partial(self._load_response_view, relation, name)
+            view = self._cache.entry(relation, name, load, "view")
+            if view is not None:
+                views.append(view)
+        if not views:
+            return None
+        return max(views, key=lambda view: not view.error)
+
+    def _load_response_view(self, relation, name):
+        sdata = self._data(relation, relation.app).get("response_" + name)
+        if sdata is None:
+            return None
+        # The view decodes with the latest schema, which older versions of the
+        # Response are a subset of.
+        return self._schema().ResponseView(name, sdata)
+
+    def get_responses(self, name):
+        """Get the responses to a request from each provider it was sent to.
+
+        This is only useful when using multiple providers, since `get_response`
+        will give the single best response from any of the providers.
+        """
+        responses = []
+        for relation in self._providers:
+            response = self._load_response(relation, self._schema(relation), name)
+            if response is not None:
+                responses.append(response)
+        return responses
+
+    def _load_response(self, relation, schema, name):
+        remote_data = self._data(relation, relation.app)
         response_key = "response_" + name
         if response_key not in remote_data:
             return None
         request = schema.Request()
         request.name = name
         response = schema.Response(request)
-        response._update(json.loads(remote_data[response_key]))
-        return response
+        response._load(json.loads(remote_data[response_key]))
+        return self._upgrade(response)
 
     def send_request(self, request):
         """Send a specific request.
@@ -144,10 +340,70 @@ class LBProvider(VersionedInterface):
         # being filled in on that side (e.g., the backend addresses). We have to
         # clear the sent_hash field before calculating the hash to send so that
         # it doesn't cause the hash to change even if no other fields have.
-        request.sent_hash = None
-        request.sent_hash = request.hash
+        # Since the request is sent in the schema version agreed on with each
+        # provider, the hash has to be calculated on what's actually sent.
         key = "request_" + request.name
-        self.relation.data[self.app][key] = request.dumps()
+        targets = self._targets(request.name)
+        for relation in self._providers:
+            local_data = self._data(relation, self.app)
+            if relation in targets:
+                sent = self._store_tls(self._downgrade(request, relation), local_data)
+                sent.sent_hash = None
+                sent.sent_hash = request.sent_hash = sent.hash
+                self._write_request(local_data, key, sent.dumps())
+            elif key in local_data:
+                # The request was moved to a different provider.
+                self._write_request(local_data, key, None)
+            self._cache.invalidate(relation, request.name)
+
+    def _store_tls(self, request, data):
+        """Store the TLS material of a request once in the relation data, under
+        its content hash, and get a copy of the request which refers to it.
+
+        Requests in schema versions which don't support this are left as is.
+        """
+        if "tls_cert_ref" not in request._schema.fields:
+            return request
+        stored = request._convert(type(request))
+        stored.relation = request.relation
+        for field in request.tls_fields:
+            material = getattr(request, field)
+            ref = None
+            if material is not None:
+                ref = content_hash(material)
+                if data.get(TLS_PREFIX + ref) != material:
+                    data[TLS_PREFIX + ref] = material
+            setattr(stored, field, None)
+            setattr(stored, field + "_ref", ref)
+        return stored
+
+    def _write_request(self, data, key, sdata):
+        """Write or (if sdata is None) remove a request, and remove any TLS
+        material which is no longer referred to by any request.
+        """
+        old_sdata = data.get(key)
+        if sdata is None:
+            data.pop(key, None)
+        elif old_sdata != sdata:
+            data[key] = sdata
+        if not old_sdata:
+            return
+        # Only material which the old request referred to can have been freed.
+        # The refs are plain hashes, so they can just be searched for.
+        refs = [
+            name[len(TLS_PREFIX) :]
+            for name in data.keys()
+            if name.startswith(TLS_PREFIX)
+        ]
+        freed = [ref for ref in refs if ref in old_sdata and ref not in (sdata or "")]
+        if not freed:
+            return
+        requests = [
+            value for name, value in data.items() if name.startswith("request_")
+        ]
+        for ref in freed:
+            if not any(ref in request_sdata for request_sdata in requests):
+                del data[TLS_PREFIX + ref]
 
     def remove_request(self, name):
         """Remove a specific request.
@@ -159,70 +415,159 @@ class LBProvider(VersionedInterface):
         if not self.relation:
             return
         key = "request_" + name
-        self.relation.data[self.app].pop(key, None)
+        for relation in self._providers:
+            self._write_request(self._data(relation, self.app), key, None)
+            self._cache.invalidate(relation, name)
         self.state.response_hashes.pop(name, None)
+        self.state.backend_health_hashes.pop(name, None)
 
     @property
     def all_requests(self):
         """A list of all requests which have been made."""
-        requests = []
-        if self.relation and self.charm.unit.is_leader():
-            for key in sorted(self.relation.data[self.app].keys()):
+        if not self.charm.unit.is_leader():
+            return []
+        return [record.request for record in self._snapshot]
+
+    @property
+    def _snapshot(self):
+        """Every request and response pair, loaded once.
+
+        On the leader, this is built from the requests which have been sent,
+        and all of the request-based views are derived from it so that each
+        request and response is only parsed and hashed once per hook. On
+        non-leaders, which can't read the requests, it is built from the
+        responses alone.
+
+        With multiple providers, the records from each provider are aggregated
+        so that there is only one per request, with the best response.
+        """
+        providers = self._providers
+        leader = self.charm.unit.is_leader()
+        load = partial(self._load_snapshot, providers, leader)
+        return self._cache.view("snapshot", providers, load, leader)
+
+    def _load_snapshot(self, providers, leader):
+        records = []
+        for relation in providers:
+            schema = self._schema(relation)
+            if leader:
+                prefix, data = "request_", self._data(relation, self.app)
+            else:
+                prefix, data = "response_", self._data(relation, relation.app)
+            for key in sorted(data.keys()):
+                if not key.startswith(prefix):
+                    continue
+                name = key[len(prefix) :]
+                load = partial(self._load_record, relation, schema, name, leader)
+                records.append(
+                    self._cache.entry(relation, name, load, "record", leader)
+                )
+        if len(providers) < 2:
+            return records
+        records.sort(key=attrgetter("name"))
+        return [
+            max(group, key=_record_rank)
+            for _, group in groupby(records, key=attrgetter("name"))
+        ]
+
+    def _load_record(self, relation, schema, name, leader):
+        if not leader:
+            response = self._load_response(relation, schema, name)
+            complete = self._follower_complete(relation, name)
+            return _RequestRecord(name, None, response, response.hash, complete)
+        request = self._load_request(relation, schema, name)
+        response = request.response
+        complete = response.received_hash == request.sent_hash
+        return _RequestRecord(name, request, response, response.hash, complete)
+
+    def _follower_complete(self, relation, name):
+        # Non-leaders can't read the requests, so they can't tell whether a
+        # response is up to date unless the leader has published a digest.
+        digest = self._published_digest
+        if digest is None:
+            return True
+        entry = digest.get(str(relation.id), {}).get(name)
+        if entry is None:
+            return False
+        response_sdata = self._data(relation, relation.app).get("response_" + name)
+        return entry.split(":")[1] == digest_hash(response_sdata)
+
+    def _digest_entries(self):
+        digest = {}
+        for relation in self._providers:
+            local_data = self._data(relation, self.app)
+            remote_data = self._data(relation, relation.app)
+            for key, request_sdata in sorted(local_data.items()):
                 if not key.startswith("request_"):
                     continue
-                requests.append(self.get_request(key[len("request_") :]))
-        return requests
+                name = key[len("request_") :]
+                response_sdata = remote_data.get("response_" + name)
+                digest.setdefault(str(relation.id), {})[name] = digest_entry(
+                    request_sdata, response_sdata
+                )
+        return digest
 
     @property
     def revoked_responses(self):
         """A list of responses which are no longer available."""
+        if not self.charm.unit.is_leader():
+            return []
+        acked = self.state.response_hashes
         return [
-            request.response
-            for request in self.all_requests
-            if not request.response and request.name in self.state.response_hashes
+            record.response
+            for record in self._snapshot
+            if record.response_hash is None and record.name in acked
         ]
 
-    @cached_property
+    @property
     def all_responses(self):
         """A list of all responses which are available."""
         # NB: Non-leaders can't read the request data, but they should be able
         # to read the responses.
+        providers = self._providers
+        return self._cache.view(
+            "all_responses", providers, partial(self._load_all_responses, providers)
+        )
+
+    def _load_all_responses(self, providers):
         responses = []
-        if self.relation:
-            for key in sorted(self.relation.data[self.relation.app].keys()):
+        for relation in providers:
+            schema = self._schema(relation)
+            for key in sorted(self._data(relation, relation.app).keys()):
                 if not key.startswith("response_"):
                     continue
-                responses.append(self.get_response(key[len("response_") :]))
-        return responses
+                name = key[len("response_") :]
+                load = partial(self._load_response, relation, schema, name)
+                responses.append(self._cache.entry(relation, name, load, "response"))
+        if len(providers) < 2:
+            return responses
+        responses.sort(key=attrgetter("name"))
+        return [
+            max(group, key=lambda response: not response.error)
+            for _, group in groupby(responses, key=attrgetter("name"))
+        ]
 
-    @cached_property
+    @property
     def complete_responses(self):
         """A list of all responses which are up to date with their associated
         request.
         """
-        if not self.charm.unit.is_leader():
-            # Ugh.  Non-leaders can't read the request data, so they can't
-            # verify if the response is up-to-date with the latest request
-            # data. Instead, just assume that if there's a response there, that
-            # it's up-to-date so that the non-leaders can at least see the
-            # responses.
-            return self.all_responses
-        return [
-            request.response
-            for request in self.all_requests
-            if request.response.received_hash == request.sent_hash
-        ]
+        # NB: Non-leaders can't read the request data, so they can't verify if
+        # the response is up-to-date with the latest request data. Instead, the
+        # snapshot just assumes that if there's a response there, that it's
+        # up-to-date so that the non-leaders can at least see the responses.
+        return [record.response for record in self._snapshot if record.complete]
 
     @property
     def new_responses(self):
         """A list of complete responses which have not yet been acknowledged as
         handled or which have changed.
         """
-        acked_responses = self.state.response_hashes
+        acked = self.state.response_hashes
         return [
-            response
-            for response in self.complete_responses
-            if response.hash != acked_responses.get(response.name)
+            record.response
+            for record in self._snapshot
+            if record.complete and record.response_hash != acked.get(record.name)
         ]
 
     def ack_response(self, response):
@@ -235,14 +580,38 @@ class LBProvider(VersionedInterface):
             self.state.response_hashes[response.name] = response.hash
         else:
             self.state.response_hashes.pop(response.name, None)
+        try:
+            from charms.reactive import clear_flag
+        except ImportError:
+            return  # not being used in a reactive charm
+        # Checking for remaining changes is only needed for the flag, and is
+        # relatively costly with many responses, so it's only done when needed.
         if not self.is_changed:
-            try:
-                from charms.reactive import clear_flag
+            prefix = "endpoint." + self.relation_name
+            clear_flag(prefix + ".response.changed")
 
-                prefix = "endpoint." + self.relation_name
-                clear_flag(prefix + ".response.changed")
-            except ImportError:
-                pass  # not being used in a reactive charm
+    @property
+    def new_backend_health(self):
+        """A list of complete responses for which the health of the backends has
+        changed and not yet been acknowledged.
+
+        Changes to the backend health don't cause a response to show up in
+        `new_responses`, since they don't affect the rest of the response.
+        """
+        acked = self.state.backend_health_hashes
+        return [
+            response
+            for response in self.complete_responses
+            if _health_hash(response) != acked.get(response.name)
+        ]
+
+    def ack_backend_health(self, response):
+        """Acknowledge that the backend health for a response has been handled."""
+        health_hash = _health_hash(response)
+        if health_hash:
+            self.state.backend_health_hashes[response.name] = health_hash
+        else:
+            self.state.backend_health_hashes.pop(response.name, None)
 
     @property
     def is_changed(self):
@@ -11,3 +11,16 @@ for subpath in Path(__file__).parent.glob("*.py"):
         versions[submod.version] = submod
 
 max_version = max(versions.keys())
+
+
+def convert(obj, version):
+    """Convert a Request, Response, or HealthCheck to another schema version.
+
+    Each schema version after the first provides `upgrade` and `downgrade`
+    functions to convert objects from and to the previous version.
+    """
+    while obj.version < version:
+        obj = versions[obj.version + 1].upgrade(obj)
+    while obj.version > version:
+        obj = versions[obj.version].downgrade(obj)
+    return obj
@@ -0,0 +1,71 @@
+"""Normalization of backend addresses.
+
+Addresses come from free-form charm input or from the units' `ingress-address`,
+so the same set of backends can be written in many ways (e.g., in a different
+order, with duplicates, or with IPv6 addresses in an expanded form). They are
+normalized so that equal sets of backends are always stored, and hashed, the
+same way: IP addresses are put in their canonical form and hostnames are
+lowercased, then the list is deduplicated and sorted (IPv4 addresses, then IPv6
+addresses, both by numeric value, then hostnames).
+"""
+
+from functools import lru_cache
+from ipaddress import ip_address
+
+from marshmallow import fields
+
+
+@lru_cache(maxsize=4096)
+def _address_key(address):
+    address = address.strip()
+    try:
+        ip = ip_address(address)
+    except ValueError:
+        return (1, 0, 0, address.lower())
+    return (0, ip.version, int(ip), str(ip))
+
+
+def normalize_address(address):
+    """Get the canonical form of a single address."""
+    return _address_key(address)[-1]
+
+
+def normalize_addresses(addresses):
+    """Get the canonical, deduplicated, and sorted form of a list of addresses."""
+    keys = {}
+    for address in addresses:
+        key = _address_key(address)
+        keys[key[-1]] = key
+    return [key[-1] for key in sorted(keys.values())]
+
+
+class Address(fields.Str):
+    """A string field holding an address, which is normalized when loaded or
+    dumped.
+    """
+
+    # Also applied by the compiled decoders to values which they load.
+    normalize = staticmethod(normalize_address)
+
+    def _serialize(self, value, attr, obj, **kwargs):
+        value = super()._serialize(value, attr, obj, **kwargs)
+        return None if value is None else self.normalize(value)
+
+    def _deserialize(self, value, attr, data, **kwargs):
+        return self.normalize(super()._deserialize(value, attr, data, **kwargs))
+
+
+class AddressList(fields.List):
+    """A list of addresses, which is normalized when loaded or dumped."""
+
+    normalize = staticmethod(normalize_addresses)
+
+    def __init__(self, **kwargs):
+        super().__init__(Address(), **kwargs)
+
+    def _serialize(self, value, attr, obj, **kwargs):
+        value = super()._serialize(value, attr, obj, **kwargs)
+        return None if value is None else self.normalize(value)
+
+    def _deserialize(self, value, attr, data, **kwargs):
+        return self.normalize(super()._deserialize(value, attr, data, **kwargs))
@@ -1,5 +1,6 @@
 import inspect
 import json
+from copy import copy
 from hashlib import md5
 
 from marshmallow import (
@@ -8,13 +9,18 @@ from marshmallow import (
     ValidationError,
 )
 
+from .decoder import compile_decoder, compile_field_decoders
+
 
 class SchemaWrapper:
     class _Schema(Schema):
         pass
 
+    # Fields which are sent, but which don't count as a change to the object.
+    _hash_exclude = ()
+
     def __init__(self):
-        self._schema = self._Schema()
+        self._schema = self._schema_instance()
         self.version = inspect.getmodule(self).version
         for field_name, field in self._schema.fields.items():
             if field.missing is not missing:
@@ -25,19 +31,77 @@ class SchemaWrapper:
                 value = None
             setattr(self, field_name, value)
 
+    def __getstate__(self):
+        # Only the field values need to be pickled (e.g., to pass objects loaded
+        # in another process back), since the schema is shared per class.
+        state = dict(self.__dict__)
+        del state["_schema"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._schema = self._schema_instance()
+
+    @classmethod
+    def _schema_instance(cls):
+        # Schema instances are expensive to create but don't hold any state
+        # between loads or dumps, so a single instance is shared per class.
+        if "_shared_schema" not in cls.__dict__:
+            cls._shared_schema = cls._Schema()
+        return cls._shared_schema
+
+    @classmethod
+    def _decoder(cls):
+        if "_compiled_decoder" not in cls.__dict__:
+            # Wrapped in a tuple so that it doesn't get bound as a method.
+            cls._compiled_decoder = (compile_decoder(cls._schema_instance()),)
+        return cls._compiled_decoder[0]
+
+    @classmethod
+    def _field_decoders(cls):
+        if "_compiled_field_decoders" not in cls.__dict__:
+            schema = cls._schema_instance()
+            cls._compiled_field_decoders = compile_field_decoders(schema)
+        return cls._compiled_field_decoders
+
     def _update(self, data=None, **kwdata):
         if data is None:
             data = {}
-        data.update(kwdata)
-        for field, value in self._schema.load(data).items():
+        if kwdata:
+            data = dict(data, **kwdata)
+        return self._set(self._schema.load(data))
+
+    def _load(self, data):
+        """Update from serialized data, as received over the relation.
+
+        This is equivalent to `_update(data)`, but uses the compiled decoder.
+        """
+        return self._set(self._decoder()(data))
+
+    def _set(self, loaded):
+        for field, value in loaded.items():
             setattr(self, field, value)
         return self
 
+    def _convert(self, cls, *args):
+        """Create an instance of another version of this class.
+
+        Only the values of the fields which both versions share are copied, so
+        any further conversion has to be done by the caller.
+        """
+        other = cls(*args)
+        for field_name in other._schema.fields.keys() & self._schema.fields.keys():
+            setattr(other, field_name, copy(getattr(self, field_name)))
+        return other
+
     def dump(self):
         # We have to manually validate every field first, or serialization can
         # can fail and we won't know which field it failed on.
         for field_name, field in self._schema.fields.items():
             value = getattr(self, field_name, None)
+            if value is None and field.allow_none:
+                # Optional fields which aren't set have nothing to validate.
+                continue
             try:
                 if hasattr(field, "_validated"):
                     # For some reason, some field types do their validation in
@@ -52,10 +116,12 @@ class SchemaWrapper:
                 raise ValidationError({field_name: e.messages}) from e
         serialized = self._schema.dump(self)
         # Then we have to validate the serialized data again to catch any
-        # schema-level validation issues.
-        errors = self._schema.validate(serialized)
-        if errors:
-            raise ValidationError(errors)
+        # schema-level validation issues. The compiled decoder does the same
+        # checks as `Schema.validate`, but much faster.
+        try:
+            self._decoder()(serialized)
+        except ValidationError as e:
+            raise ValidationError(e.messages) from e
         return serialized
 
     def dumps(self):
@@ -64,6 +130,48 @@ class SchemaWrapper:
     @property
     def hash(self):
         try:
-            return md5(self.dumps().encode("utf8")).hexdigest()
+            data = self.dump()
         except ValidationError:
             return None
+        for field_name in self._hash_exclude:
+            data.pop(field_name, None)
+        return md5(json.dumps(data, sort_keys=True).encode("utf8")).hexdigest()
+
+
+class LazyView:
+    """A read-only view of the serialized data for a SchemaWrapper.
+
+    Nothing is decoded up front; each field is decoded and validated, in the
+    same way as loading the whole object would, only when it's first accessed.
+    Since the object as a whole is never loaded, schema-level validation and
+    unknown keys in the data are not checked.
+    """
+
+    wrapper = SchemaWrapper
+
+    def __init__(self, sdata):
+        object.__setattr__(self, "_sdata", sdata)
+        object.__setattr__(self, "_data", None)
+
+    def __getattr__(self, name):
+        decoders = self.wrapper._field_decoders()
+        if name not in decoders:
+            raise AttributeError(
+                "{!r} object has no attribute {!r}".format(type(self).__name__, name)
+            )
+        if self._data is None:
+            data = json.loads(self._sdata)
+            if not isinstance(data, dict):
+                error = self.wrapper._schema_instance().error_messages["type"]
+                raise ValidationError({"_schema": [error]})
+            object.__setattr__(self, "_data", data)
+        data_key, decode_field = decoders[name]
+        try:
+            value = decode_field(self._data.get(data_key, missing))
+        except ValidationError as e:
+            raise ValidationError({data_key: e.messages}) from e
+        object.__setattr__(self, name, value)
+        return value
+
+    def __setattr__(self, name, value):
+        raise AttributeError("{} is read-only".format(type(self).__name__))
@@ -0,0 +1,237 @@
+"""Compiled decoders for loading relation data.
+
+Loading data with `Schema.load` is fully generic, which makes it fairly slow for
+the data which has to be loaded from the relation on every hook. Instead, each
+schema can be compiled into a decoder which does the same type checks, required
+field checks, and conversions in a single pass over the data.
+
+Valid values are handled directly by the decoder, while anything else is handed
+back to the marshmallow field, so that the `ValidationError` messages produced
+are always exactly the same as those from `Schema.load`.
+"""
+
+from collections.abc import Mapping
+
+from marshmallow import (
+    fields,
+    missing,
+    RAISE,
+    ValidationError,
+)
+from marshmallow.decorators import (
+    POST_LOAD,
+    PRE_LOAD,
+    VALIDATES,
+    VALIDATES_SCHEMA,
+)
+from marshmallow.error_store import ErrorStore
+from marshmallow_enum import EnumField
+
+
+def compile_decoder(schema):
+    """Compile a decoder function for the given schema instance.
+
+    The decoder takes the data to load and returns the loaded data, raising a
+    `ValidationError` if it is invalid, the same as `schema.load(data)` would.
+    """
+    # None of the schemas use these, so they're not worth handling; just fall
+    # back to the generic loading if they ever do.
+    unsupported_hooks = (PRE_LOAD, POST_LOAD, VALIDATES)
+    if schema.many or schema.unknown != RAISE:
+        return schema.load
+    if any(schema._hooks[hook] for hook in unsupported_hooks):
+        return schema.load
+
+    plan = [
+        (name, data_key, decode_field)
+        for name, (data_key, decode_field) in compile_field_decoders(schema).items()
+    ]
+    known_keys = {data_key for _, data_key, _ in plan}
+    type_error = schema.error_messages["type"]
+    unknown_error = schema.error_messages["unknown"]
+    has_validators = bool(schema._hooks[VALIDATES_SCHEMA])
+
+    def decode(data):
+        if not isinstance(data, Mapping):
+            raise ValidationError({"_schema": [type_error]})
+        result = {}
+        errors = {}
+        for name, data_key, decode_field in plan:
+            try:
+                value = decode_field(data.get(data_key, missing))
+            except ValidationError as e:
+                errors[data_key] = e.messages
+                continue
+            if value is not missing:
+                result[name] = value
+        for key in data.keys() - known_keys:
+            errors[key] = [unknown_error]
+        if has_validators:
+            error_store = ErrorStore()
+            error_store.errors = errors
+            for pass_many in (True, False):
+                schema._invoke_schema_validators(
+                    error_store=error_store,
+                    pass_many=pass_many,
+                    data=result,
+                    original_data=data,
+                    many=False,
+                    partial=None,
+                    field_errors=bool(errors),
+                )
+            errors = error_store.errors
+        if errors:
+            raise ValidationError(errors, data=data, valid_data=result)
+        return result
+
+    return decode
+
+
+def compile_field_decoders(schema):
+    """Compile a decoder for each field of the given schema instance.
+
+    Returns a mapping of field name to `(data_key, decode_field)`, where
+    `decode_field` takes the value for that key in the data (or `missing`) and
+    returns the loaded value, raising a `ValidationError` if it is invalid.
+    """
+    decoders = {}
+    for name, field in schema.load_fields.items():
+        data_key = field.data_key if field.data_key is not None else name
+        decoders[name] = (data_key, _compile_field(field))
+    return decoders
+
+
+def _compile_field(field):
+    """Compile a decoder for a field, equivalent to `field.deserialize`."""
+    decode_value = _compile_value(field)
+    required = field.required
+    allow_none = field.allow_none
+    default = field.missing
+    validators = field.validators
+    # Fields which put values into a canonical form once they've been loaded.
+    normalize = getattr(field, "normalize", None)
+
+    def decode_field(value):
+        if value is missing:
+            if required:
+                raise field.make_error("required")
+            return default() if callable(default) else default
+        if value is None:
+            if allow_none:
+                return None
+            raise field.make_error("null")
+        output = decode_value(value)
+        if normalize is not None:
+            output = normalize(output)
+        if validators:
+            field._validate(output)
+        return output
+
+    return decode_field
+
+
+def _compile_value(field):
+    """Compile a decoder for a non-missing, non-null value of a field.
+
+    Each of these only handles the values which are known to be valid directly,
+    and defers to the field's own `_deserialize` for anything else, so that the
+    field can either convert the value or produce the appropriate error.
+    """
+    fallback = field._deserialize
+
+    if getattr(field, "wrapper", None) is not None:
+        # Fields which hold a nested SchemaWrapper.
+        wrapper = field.wrapper
+        decode_nested = wrapper._decoder()
+
+        def decode_value(value):
+            if isinstance(value, wrapper):
+                return value
+            return wrapper()._set(decode_nested(value))
+
+    elif isinstance(field, EnumField):
+        if field.load_by == EnumField.VALUE:
+            members = {member.value: member for member in field.enum}
+        else:
+            members = {member.name: member for member in field.enum}
+
+        def decode_value(value):
+            if type(value) is str and value in members:
+                return members[value]
+            return fallback(value, None, None)
+
+    elif isinstance(field, fields.Integer):
+
+        def decode_value(value):
+            if type(value) is int:
+                return value
+            return fallback(value, None, None)
+
+    elif isinstance(field, fields.String):
+
+        def decode_value(value):
+            if type(value) is str:
+                return value
+            return fallback(value, None, None)
+
+    elif isinstance(field, fields.Boolean):
+
+        def decode_value(value):
+            if value is True or value is False:
+                return value
+            return fallback(value, None, None)
+
+    elif isinstance(field, fields.List):
+        decode_item = _compile_field(field.inner)
+
+        def decode_value(value):
+            if type(value) is not list:
+                return fallback(value, None, None)
+            result = []
+            errors = {}
+            for idx, item in enumerate(value):
+                try:
+                    result.append(decode_item(item))
+                except ValidationError as e:
+                    errors[idx] = e.messages
+            if errors:
+                raise ValidationError(errors)
+            return result
+
+    elif isinstance(field, fields.Mapping) and field.mapping_type is dict:
+        decode_key = field.key_field and _compile_field(field.key_field)
+        decode_val = field.value_field and _compile_field(field.value_field)
+
+        def decode_value(value):
+            if type(value) is not dict:
+                return fallback(value, None, None)
+            result = {}
+            errors = {}
+            for key, val in value.items():
+                item_errors = {}
+                if decode_key:
+                    try:
+                        new_key = decode_key(key)
+                    except ValidationError as e:
+                        item_errors["key"] = e.messages
+                else:
+                    new_key = key
+                if decode_val:
+                    try:
+                        val = decode_val(val)
+                    except ValidationError as e:
+                        item_errors["value"] = e.messages
+                if item_errors:
+                    errors[key] = item_errors
+                else:
+                    result[new_key] = val
+            if errors:
+                raise ValidationError(errors)
+            return result
+
+    else:
+
+        def decode_value(value):
+            return fallback(value, None, None)
+
+    return decode_value
@@ -50,7 +50,7 @@ class Response(SchemaWrapper):
                 raise ValidationError(
                     "error_message or error_fields required on failure"
                 )
-            request_fields = Request._Schema().fields
+            request_fields = Request._schema_instance().fields
             unknown_fields = data["error_fields"].keys() - request_fields.keys()
             if unknown_fields:
                 s = "s" if len(unknown_fields) > 1 else ""
@@ -84,13 +84,15 @@ class HealthCheck(SchemaWrapper):
 
 
 class HealthCheckField(fields.Field):
+    wrapper = HealthCheck
+
     def _serialize(self, value, attr, obj, **kwargs):
         return value._schema.dump(value)
 
     def _deserialize(self, value, attr, data, **kwargs):
-        if isinstance(value, HealthCheck):
+        if isinstance(value, self.wrapper):
             return value
-        return HealthCheck()._update(value)
+        return self.wrapper()._update(value)
 
 
 class Request(SchemaWrapper):
@@ -131,9 +133,9 @@ class Request(SchemaWrapper):
     def loads(cls, request_sdata, response_sdata=None):
         self = cls()
         if request_sdata:
-            self._update(json.loads(request_sdata))
+            self._load(json.loads(request_sdata))
         if response_sdata:
-            self.response._update(json.loads(response_sdata))
+            self.response._load(json.loads(response_sdata))
         return self
 
     def add_health_check(self, **kwargs):
@@ -0,0 +1,404 @@
+import json
+from enum import Enum
+from marshmallow import (
+    Schema,
+    fields,
+    validate,
+    validates_schema,
+    ValidationError,
+)
+from marshmallow_enum import EnumField
+
+from . import v1
+from .addresses import Address, AddressList, normalize_addresses
+from .base import LazyView, SchemaWrapper
+from .v1 import Protocols, ErrorTypes
+
+
+version = 2
+
+
+class Algorithms(str, Enum):
+    round_robin = "round-robin"
+    least_conn = "least-conn"
+    source_hash = "source-hash"
+    weighted = "weighted"
+
+    def __str__(self):
+        return self.value
+
+
+# Algorithms can also be given by name, or by the free-form strings from v1.
+_known_algorithms = {alg.value: alg for alg in Algorithms}
+_known_algorithms.update({alg.name: alg for alg in Algorithms})
+
+
+def known_algorithm(algorithm):
+    """Get the `Algorithms` member for an algorithm or its value or name, or
+    `None` if it isn't known.
+    """
+    try:
+        return _known_algorithms.get(algorithm)
+    except TypeError:
+        return None
+
+
+def coerce_algorithms(values):
+    """Get the `Algorithms` for a list of algorithms or their values or names.
+
+    Raises a `ValidationError` for any which aren't known.
+    """
+    algorithms = []
+    for algorithm in values:
+        known = known_algorithm(algorithm)
+        if known is None:
+            raise ValidationError("Unknown algorithm: {}".format(algorithm))
+        algorithms.append(known)
+    return algorithms
+
+
+class AlgorithmList(fields.List):
+    """A list of algorithms, which can also be set as strings, by either value
+    or name, as they could be in v1.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(EnumField(Algorithms, by_value=True), **kwargs)
+
+    def _validated(self, value):
+        return None if value is None else coerce_algorithms(value)
+
+    def _serialize(self, value, attr, obj, **kwargs):
+        return super()._serialize(self._validated(value), attr, obj, **kwargs)
+
+
+class HealthStates(Enum):
+    healthy = "healthy"
+    unhealthy = "unhealthy"
+    unknown = "unknown"
+
+    def __str__(self):
+        return self.value
+
+
+class Response(SchemaWrapper):
+    error_types = ErrorTypes
+    health_states = HealthStates
+
+    # Backend health can change frequently and is surfaced separately, so it
+    # shouldn't make the response look changed.
+    _hash_exclude = ("backend_health",)
+
+    class _Schema(Schema):
+        error = EnumField(ErrorTypes, missing=None)
+        error_message = fields.Str(missing=None)
+        error_fields = fields.Dict(key=fields.Str, value=fields.Str, missing=dict)
+        address = fields.Str(missing=None)
+        received_hash = fields.Str(missing=None)
+        backend_health = fields.Dict(
+            keys=Address(),
+            values=EnumField(HealthStates, by_value=True),
+            missing=dict,
+        )
+
+        @validates_schema
+        def _validate(self, data, **kwargs):
+            if not data["error"] and not data["address"]:
+                raise ValidationError("address required on success")
+            if data["error"] and not (data["error_message"] or data["error_fields"]):
+                raise ValidationError(
+                    "error_message or error_fields required on failure"
+                )
+            request_fields = Request._schema_instance().fields
+            unknown_fields = data["error_fields"].keys() - request_fields.keys()
+            if unknown_fields:
+                s = "s" if len(unknown_fields) > 1 else ""
+                raise ValidationError(
+                    {
+                        "error_fields": "Unknown field{}: {}".format(
+                            s, ", ".join(unknown_fields)
+                        )
+                    }
+                )
+
+    def __init__(self, request):
+        super().__init__()
+        self._name = request.name
+
+    @property
+    def name(self):
+        return self._name
+
+    def __bool__(self):
+        return self.hash is not None
+
+
+class ResponseView(LazyView):
+    """A read-only view of a serialized Response, for code which only needs to
+    read a few fields of it, such as to set the status.
+
+    Each field is only decoded when it's first accessed.
+    """
+
+    wrapper = Response
+    error_types = ErrorTypes
+    health_states = HealthStates
+
+    def __init__(self, name, sdata):
+        super().__init__(sdata)
+        object.__setattr__(self, "name", name)
+
+    def __bool__(self):
+        # Equivalent to the schema-level validation of a Response, but only
+        # looking at the fields which it needs.
+        try:
+            if self.error:
+                return bool(self.error_message or self.error_fields)
+            return bool(self.address)
+        except ValidationError:
+            return False
+
+
+class HealthCheck(SchemaWrapper):
+    class _Schema(Schema):
+        protocol = EnumField(Protocols, by_value=True, required=True)
+        port = fields.Int(required=True)
+        path = fields.Str(missing=None)
+        interval = fields.Int(missing=30)
+        retries = fields.Int(missing=3)
+        timeout = fields.Int(validate=validate.Range(min=1), missing=None)
+        healthy_threshold = fields.Int(validate=validate.Range(min=1), missing=None)
+        unhealthy_threshold = fields.Int(validate=validate.Range(min=1), missing=None)
+        expected_status = fields.Int(
+            validate=validate.Range(min=100, max=599), missing=None
+        )
+
+
+class HealthCheckField(fields.Field):
+    wrapper = HealthCheck
+
+    def _serialize(self, value, attr, obj, **kwargs):
+        return value._schema.dump(value)
+
+    def _deserialize(self, value, attr, data, **kwargs):
+        if isinstance(value, self.wrapper):
+            return value
+        return self.wrapper()._update(value)
+
+
+_port_number = validate.Range(min=1, max=65535)
+
+
+class PortRange(SchemaWrapper):
+    """A contiguous range of front-end ports, mapped in order onto a range of
+    backend ports of the same size.
+    """
+
+    class _Schema(Schema):
+        front_start = fields.Int(validate=_port_number, required=True)
+        front_end = fields.Int(validate=_port_number, required=True)
+        back_start = fields.Int(validate=_port_number, required=True)
+
+        @validates_schema
+        def _validate(self, data, **kwargs):
+            if data["front_end"] < data["front_start"]:
+                raise ValidationError({"front_end": ["Must be at least front_start."]})
+            if data["back_start"] + data["front_end"] - data["front_start"] > 65535:
+                raise ValidationError({"back_start": ["Range ends past port 65535."]})
+
+    @property
+    def port_mapping(self):
+        """The equivalent mapping of each front-end port to its backend port."""
+        offset = self.back_start - self.front_start
+        ports = range(self.front_start, self.front_end + 1)
+        return {port: port + offset for port in ports}
+
+
+class PortRangeField(HealthCheckField):
+    wrapper = PortRange
+
+
+class Request(SchemaWrapper):
+    protocols = Protocols
+    algorithms = Algorithms
+    # Fields which tune how connections are handled, which providers may not
+    # all support. If any are set but not supported, they should be reported in
+    # the response's error_fields.
+    tuning_fields = (
+        "connect_timeout",
+        "idle_timeout",
+        "max_connections",
+        "keepalive",
+        "drain_timeout",
+    )
+    # Fields holding TLS material, which is sent by reference.
+    tls_fields = ("tls_cert", "tls_key")
+
+    class _Schema(Schema):
+        id = fields.Str(required=True)
+        name = fields.Str(required=True)
+        protocol = EnumField(Protocols, by_value=True, required=True)
+        backends = AddressList(missing=list)
+        weights = fields.Dict(
+            keys=Address(),
+            values=fields.Int(validate=validate.Range(min=0)),
+            missing=dict,
+        )
+        port_mapping = fields.Dict(
+            keys=fields.Int(), values=fields.Int(), required=True
+        )
+        # Large ranges of ports are sent as ranges, rather than port by port.
+        port_ranges = fields.List(PortRangeField, missing=list)
+        algorithm = AlgorithmList(missing=list)
+        sticky = fields.Bool(missing=False)
+        health_checks = fields.List(HealthCheckField, missing=list)
+        public = fields.Bool(missing=True)
+        tls_termination = fields.Bool(missing=False)
+        tls_cert = fields.Str(missing=None)
+        tls_key = fields.Str(missing=None)
+        # Set automatically when the request is sent, to refer to the TLS
+        # material stored once per relation rather than embedded in each request.
+        tls_cert_ref = fields.Str(missing=None)
+        tls_key_ref = fields.Str(missing=None)
+        ingress_address = fields.Str(missing=None)
+        connect_timeout = fields.Int(validate=validate.Range(min=0), missing=None)
+        idle_timeout = fields.Int(validate=validate.Range(min=0), missing=None)
+        max_connections = fields.Int(validate=validate.Range(min=1), missing=None)
+        keepalive = fields.Bool(missing=None)
+        drain_timeout = fields.Int(validate=validate.Range(min=0), missing=None)
+        sent_hash = fields.Str(missing=None)
+
+        @validates_schema
+        def _validate(self, data, **kwargs):
+            spans = [(port, port) for port in data["port_mapping"]]
+            spans.extend((r.front_start, r.front_end) for r in data["port_ranges"])
+            spans.sort()
+            for (_, end), (start, _) in zip(spans, spans[1:]):
+                if start <= end:
+                    message = "Port {} is mapped more than once.".format(start)
+                    raise ValidationError({"port_ranges": [message]})
+
+    def __init__(self):
+        super().__init__()
+        self._response = None
+        # On the provider side, requests need to track which relation they
+        # came from to know where to send the response.
+        self.relation = None
+        # Requests from v1 can have free-form algorithms, which are kept as is.
+        self._v1_algorithms = False
+
+    def dump(self):
+        if not self._v1_algorithms:
+            return super().dump()
+        algorithm = self.algorithm
+        self.algorithm = [alg for alg in algorithm if known_algorithm(alg)]
+        try:
+            data = super().dump()
+        finally:
+            self.algorithm = algorithm
+        for alg in algorithm:
+            if not known_algorithm(alg) and not isinstance(alg, str):
+                raise ValidationError({"algorithm": ["Not a valid string."]})
+        data["algorithm"] = [str(known_algorithm(alg) or alg) for alg in algorithm]
+        return data
+
+    @property
+    def response(self):
+        if self._response is None:
+            self._response = Response(self)
+        return self._response
+
+    @classmethod
+    def loads(cls, request_sdata, response_sdata=None):
+        self = cls()
+        if request_sdata:
+            self._load(json.loads(request_sdata))
+        if response_sdata:
+            self.response._load(json.loads(response_sdata))
+        return self
+
+    def add_health_check(self, **kwargs):
+        """Create a HealthCheck and add it to the list."""
+        health_check = HealthCheck()._update(kwargs)
+        self.health_checks.append(health_check)
+        return health_check
+
+    def add_port_range(self, front_start, front_end, back_start=None):
+        """Create a PortRange and add it to the list.
+
+        If no `back_start` is given, the ports are mapped to the same ports.
+        """
+        if back_start is None:
+            back_start = front_start
+        port_range = PortRange()._update(
+            front_start=front_start, front_end=front_end, back_start=back_start
+        )
+        self.port_ranges.append(port_range)
+        return port_range
+
+
+def upgrade(obj):
+    """Convert a v1 object to the equivalent v2 object."""
+    if isinstance(obj, v1.Request):
+        request = obj._convert(Request)
+        request.relation = obj.relation
+        request.backends = normalize_addresses(obj.backends)
+        # Free-form algorithms which aren't known are left for the charm to
+        # deal with, as they would be with v1.
+        request.algorithm = [known_algorithm(alg) or alg for alg in obj.algorithm]
+        request._v1_algorithms = True
+        request.health_checks = [upgrade(hc) for hc in obj.health_checks]
+        if obj._response is not None:
+            request._response = obj._response._convert(Response, request)
+        return request
+    if isinstance(obj, v1.Response):
+        return obj._convert(Response, obj)
+    if isinstance(obj, v1.HealthCheck):
+        return obj._convert(HealthCheck)
+    raise TypeError("Unable to upgrade {}".format(type(obj).__name__))
+
+
+def downgrade(obj):
+    """Convert a v2 object to the equivalent v1 object.
+
+    Any fields which v1 doesn't support are dropped.
+    """
+    if isinstance(obj, Request):
+        request = obj._convert(v1.Request)
+        request.relation = obj.relation
+        # Free-form algorithms are still allowed by v1, so they're sent as is.
+        request.algorithm = [
+            str(known_algorithm(alg) or alg) if isinstance(alg, str) else alg
+            for alg in obj.algorithm
+        ]
+        request.health_checks = [downgrade(hc) for hc in obj.health_checks]
+        # v1 only has the mapping of individual ports.
+        request.port_mapping = dict(obj.port_mapping)
+        for port_range in obj.port_ranges:
+            request.port_mapping.update(port_range.port_mapping)
+        if obj._response is not None:
+            request._response = downgrade(obj._response)
+        return request
+    if isinstance(obj, Response):
+        response = obj._convert(v1.Response, obj)
+        v1_fields = v1.Request._schema_instance().fields
+        response.error_fields = {
+            field: message
+            for field, message in obj.error_fields.items()
+            if field in v1_fields
+        }
+        if obj.error and not (response.error_fields or response.error_message):
+            # Errors on fields which v1 doesn't know about still need to be
+            # reported somehow.
+            response.error_message = "; ".join(
+                "{}: {}".format(field, message)
+                for field, message in sorted(obj.error_fields.items())
+            )
+        return response
+    if isinstance(obj, HealthCheck):
+        health_check = obj._convert(v1.HealthCheck)
+        if obj.unhealthy_threshold is not None:
+            # This is the closest equivalent that v1 has.
+            health_check.retries = obj.unhealthy_threshold
+        return health_check
+    raise TypeError("Unable to downgrade {}".format(type(obj).__name__))
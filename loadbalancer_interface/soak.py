@@ -0,0 +1,289 @@
+"""Churn soak testing for the interface.
+
+This replays long, generated traces of the sort of churn that a deployment sees
+over its lifetime (units joining and departing, leadership moving, requests being
+added and removed, and providers restarting) against a consumer and a provider
+charm in a `RelationSimulator`. For each type of operation, the time taken by the
+hooks it triggers is recorded, and the size of the `StoredState` of both sides is
+sampled as the trace goes on, so that leaks and super-linear slowdowns show up.
+
+It can be run with:
+
+    python -m loadbalancer_interface.soak --steps 5000
+"""
+
+import argparse
+import json
+import random
+from math import ceil
+from time import perf_counter
+
+from ops.charm import CharmBase
+
+from .provides import LBConsumers
+from .requires import LBProvider
+from .testing import RelationSimulator
+
+
+OPERATIONS = (
+    "unit_join",
+    "unit_depart",
+    "leader_flip",
+    "request_add",
+    "request_remove",
+    "provider_restart",
+)
+DEFAULT_WEIGHTS = {
+    "unit_join": 2,
+    "unit_depart": 2,
+    "leader_flip": 1,
+    "request_add": 4,
+    "request_remove": 3,
+    "provider_restart": 1,
+}
+
+
+class SoakProviderCharm(CharmBase):
+    _meta = """
+        name: soak-provider
+        provides:
+          lb-consumers:
+            interface: loadbalancer
+    """
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.lb_consumers = LBConsumers(self, "lb-consumers")
+        self.framework.observe(self.lb_consumers.on.requests_changed, self._update)
+
+    def _update(self, event):
+        if not self.unit.is_leader():
+            return
+        for request in self.lb_consumers.new_requests:
+            request.response.address = "lb-" + request.name
+            self.lb_consumers.send_response(request)
+        for request in self.lb_consumers.removed_requests:
+            self.lb_consumers.revoke_response(request)
+
+
+class SoakConsumerCharm(CharmBase):
+    _meta = """
+        name: soak-consumer
+        requires:
+          lb-provider:
+            interface: loadbalancer
+    """
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.lb_provider = LBProvider(self, "lb-provider")
+        self.framework.observe(self.lb_provider.on.response_changed, self._update)
+
+    def _update(self, event):
+        for response in self.lb_provider.new_responses:
+            self.lb_provider.ack_response(response)
+        for response in self.lb_provider.revoked_responses:
+            self.lb_provider.ack_response(response)
+
+
+def generate_trace(steps, seed=0, weights=None):
+    """Generate a trace of `(operation, argument)` pairs.
+
+    The generator tracks what the state will be as the trace is replayed, so
+    that every operation in the trace is valid when it's reached (e.g., only
+    existing requests are removed, and only the leader makes requests).
+    """
+    rng = random.Random(seed)
+    weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+    extra_units = 1
+    leaders = {"consumer": True, "provider": True}
+    requests = []
+    next_request = 0
+    trace = []
+    while len(trace) < steps:
+        op = rng.choices(OPERATIONS, [weights[op] for op in OPERATIONS])[0]
+        if op == "unit_join":
+            extra_units += 1
+            arg = None
+        elif op == "unit_depart":
+            if not extra_units:
+                continue
+            arg = rng.randrange(extra_units)
+            extra_units -= 1
+        elif op == "leader_flip":
+            arg = rng.choice(sorted(leaders))
+            leaders[arg] = not leaders[arg]
+        elif op == "request_add":
+            if not leaders["consumer"]:
+                continue
+            arg = "svc{}".format(next_request)
+            next_request += 1
+            requests.append(arg)
+        elif op == "request_remove":
+            if not leaders["consumer"] or not requests:
+                continue
+            arg = requests.pop(rng.randrange(len(requests)))
+        else:
+            arg = None
+        trace.append((op, arg))
+    return trace
+
+
+def percentile(values, pct):
+    """Get the given percentile of a list of values, by nearest rank."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(ceil(pct / 100 * len(values))), 1)
+    return values[rank - 1]
+
+
+def state_size(obj):
+    """Get the size in bytes of the serialized StoredState of an object."""
+    snapshot = obj.state._data.snapshot()
+    return len(json.dumps(snapshot, sort_keys=True))
+
+
+class SoakRunner:
+    """Replay a trace against a consumer and provider, recording stats.
+
+    Each operation is applied and then the relation data is flushed, and the
+    time for both is recorded against the operation type. A provider restart is
+    simulated by creating the provider charm again, keeping only its
+    `StoredState` and the relation data, and having it re-elected as leader.
+    """
+
+    def __init__(self, sample_every=100):
+        self.sample_every = sample_every
+        self.timings = {op: [] for op in OPERATIONS}
+        self.samples = []
+        self.sim = RelationSimulator(model_name="soak")
+        self.consumer = self.sim.add_app(
+            SoakConsumerCharm, SoakConsumerCharm._meta, units=2
+        )
+        self.provider = self.sim.add_app(SoakProviderCharm, SoakProviderCharm._meta)
+        self.sim.relate(self.consumer, "lb-provider", self.provider, "lb-consumers")
+        self.sim.flush()
+        self._window = []
+
+    def run(self, trace):
+        for step, (op, arg) in enumerate(trace, 1):
+            start = perf_counter()
+            getattr(self, "_" + op)(arg)
+            self.sim.flush()
+            elapsed = perf_counter() - start
+            self.timings[op].append(elapsed)
+            self._window.append(elapsed)
+            if step % self.sample_every == 0 or step == len(trace):
+                self.sample(step)
+        return self.report()
+
+    def sample(self, step):
+        """Record the size of the stored state, and the mean time taken by the
+        operations since the last sample.
+        """
+        window = self._window
+        lb_consumers = self.provider.charm.lb_consumers
+        lb_provider = self.consumer.charm.lb_provider
+        (relation,) = self.consumer.relations
+        sent = relation.data(self.consumer, self.consumer.name)
+        self.samples.append(
+            {
+                "step": step,
+                "requests": sum(key.startswith("request_") for key in sent),
+                "known_requests": len(lb_consumers.state.known_requests),
+                "response_hashes": len(lb_provider.state.response_hashes),
+                "provider_state_bytes": state_size(lb_consumers),
+                "consumer_state_bytes": state_size(lb_provider),
+                "mean_op_time": sum(window) / len(window) if window else None,
+            }
+        )
+        self._window = []
+
+    def _unit_join(self, arg):
+        self.sim.add_unit(self.consumer)
+
+    def _unit_depart(self, arg):
+        self.sim.remove_unit(self.consumer, self.consumer.units[1:][arg])
+
+    def _leader_flip(self, arg):
+        app = getattr(self, arg)
+        self.sim.set_leader(app, not app.is_leader)
+
+    def _request_add(self, name):
+        lb_provider = self.consumer.charm.lb_provider
+        request = lb_provider.get_request(name)
+        request.protocol = request.protocols.http
+        request.port_mapping = {80: 8080}
+        lb_provider.send_request(request)
+
+    def _request_remove(self, name):
+        self.consumer.charm.lb_provider.remove_request(name)
+
+    def _provider_restart(self, arg):
+        self.sim.restart(self.provider)
+        if self.provider.is_leader:
+            self.sim.set_leader(self.provider)
+
+    def report(self):
+        latency = {}
+        for op, times in self.timings.items():
+            if not times:
+                continue
+            latency[op] = {
+                "count": len(times),
+                "p50": percentile(times, 50),
+                "p95": percentile(times, 95),
+                "p99": percentile(times, 99),
+            }
+        return {"latency": latency, "samples": self.samples}
+
+    def cleanup(self):
+        self.sim.cleanup()
+
+
+def format_report(report):
+    """Format a soak report as text tables."""
+    lines = ["{:<18}{:>8}{:>10}{:>10}{:>10}".format("op", "count", "p50", "p95", "p99")]
+    for op, stats in report["latency"].items():
+        lines.append(
+            "{:<18}{:>8}{:>9.2f}m{:>9.2f}m{:>9.2f}m".format(
+                op,
+                stats["count"],
+                stats["p50"] * 1000,
+                stats["p95"] * 1000,
+                stats["p99"] * 1000,
+            )
+        )
+    lines.append("")
+    columns = (
+        "step",
+        "requests",
+        "known_requests",
+        "response_hashes",
+        "provider_state_bytes",
+        "consumer_state_bytes",
+    )
+    lines.append("".join("{:>22}".format(column) for column in columns))
+    for sample in report["samples"]:
+        lines.append("".join("{:>22}".format(sample[column]) for column in columns))
+    return "\n".join(lines)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--steps", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sample-every", type=int, default=100)
+    parser.add_argument("--json", action="store_true", help="Output the raw report")
+    opts = parser.parse_args(args)
+    runner = SoakRunner(sample_every=opts.sample_every)
+    try:
+        report = runner.run(generate_trace(opts.steps, opts.seed))
+    finally:
+        runner.cleanup()
+    print(json.dumps(report, indent=2) if opts.json else format_report(report))
+
+
+if __name__ == "__main__":
+    main()
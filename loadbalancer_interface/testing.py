@@ -0,0 +1,252 @@
+"""In-memory simulation of relations between charms, for fast testing.
+
+Each application is backed by its own `Harness`, and relation data is shuttled
+between them on request, firing the same relation events that Juju would. This
+allows both sides of the interface to be exercised together, with many
+applications and units, without needing a Juju controller.
+
+Only one unit of each application (its first unit) actually runs the charm code
+and can be the leader; any additional units only contribute their unit relation
+data (such as their `ingress-address`).
+"""
+
+from ipaddress import IPv4Address
+
+import yaml
+from ops.framework import Framework
+from ops.model import Model
+from ops.testing import Harness
+
+
+# The parts of the ops 1.x `Harness` which `RelationSimulator.restart` uses.
+_HARNESS_INTERNALS = ("_backend", "_storage", "_model", "_framework", "_charm")
+
+
+class SimulatedApp:
+    """An application in a `RelationSimulator`."""
+
+    def __init__(self, name, harness):
+        self.name = name
+        self.harness = harness
+        self.unit_name = harness.charm.unit.name
+        # All of the units, starting with the one running the charm.
+        self.units = [self.unit_name]
+        # The data Juju provides for each unit, such as its ingress-address.
+        # Changes to this will be sent on the next transmit or flush.
+        self.unit_data = {}
+        self.relations = []
+
+    @property
+    def charm(self):
+        return self.harness.charm
+
+    @property
+    def is_leader(self):
+        return self.charm.unit.is_leader()
+
+
+class SimulatedRelation:
+    """A relation between two applications in a `RelationSimulator`."""
+
+    def __init__(self, app_a, endpoint_a, app_b, endpoint_b):
+        self.apps = (app_a, app_b)
+        self.endpoints = {app_a.name: endpoint_a, app_b.name: endpoint_b}
+        self.relation_ids = {}
+
+    def other(self, app):
+        """Get the application on the other side of the relation."""
+        return self.apps[1] if app is self.apps[0] else self.apps[0]
+
+    def get(self, app):
+        """Get the `ops.model.Relation` as seen by the given application."""
+        endpoint = self.endpoints[app.name]
+        return app.charm.model.get_relation(endpoint, self.relation_ids[app.name])
+
+    def data(self, app, name):
+        """Get the raw data for an app or unit, as seen by the given application.
+
+        This bypasses the access controls, so that a non-leader unit can still
+        be checked.
+        """
+        return app.harness.get_relation_data(self.relation_ids[app.name], name)
+
+
+class RelationSimulator:
+    """Simulate relations between any number of applications, in memory.
+
+    Applications are added with `add_app` and related with `relate`, after
+    which the relation data can be sent between them either one direction at
+    a time with `transmit`, or until nothing changes any more with `flush`.
+    """
+
+    def __init__(self, model_name=None):
+        self.model_name = model_name
+        self.apps = {}
+        self.relations = []
+        self._next_address = IPv4Address("10.0.0.1")
+
+    def _address(self):
+        address = self._next_address
+        self._next_address += 1
+        return str(address)
+
+    def add_app(self, charm_cls, meta, *, name=None, units=1, leader=True, config=None):
+        """Add an application running the given charm.
+
+        The application name defaults to the charm's name from the metadata,
+        but can be overridden to add multiple applications of the same charm.
+        """
+        if isinstance(meta, str):
+            meta = yaml.safe_load(meta)
+        name = name or meta["name"]
+        if name in self.apps:
+            raise ValueError("Application already exists: {}".format(name))
+        harness = Harness(
+            charm_cls, meta=yaml.safe_dump(dict(meta, name=name)), config=config
+        )
+        if self.model_name:
+            harness.set_model_name(self.model_name)
+        harness.set_leader(leader)
+        harness.begin()
+        app = self.apps[name] = SimulatedApp(name, harness)
+        app.unit_data[app.unit_name] = {"ingress-address": self._address()}
+        for _ in range(units - 1):
+            self.add_unit(app)
+        return app
+
+    def add_unit(self, app, address=None):
+        """Add a unit to an application, joining it to all of its relations."""
+        num = max(int(unit.split("/")[1]) for unit in app.units) + 1
+        unit = "{}/{}".format(app.name, num)
+        app.units.append(unit)
+        app.unit_data[unit] = {"ingress-address": address or self._address()}
+        for relation in app.relations:
+            other = relation.other(app)
+            other.harness.add_relation_unit(relation.relation_ids[other.name], unit)
+        return unit
+
+    def remove_unit(self, app, unit):
+        """Remove a unit from an application, departing all of its relations."""
+        if unit == app.unit_name:
+            raise ValueError("Cannot remove the unit running the charm")
+        for relation in app.relations:
+            other = relation.other(app)
+            other.harness.remove_relation_unit(relation.relation_ids[other.name], unit)
+        app.units.remove(unit)
+        del app.unit_data[unit]
+
+    def set_leader(self, app, is_leader=True):
+        """Change whether the unit running the charm is the leader.
+
+        When it's not, leadership is considered to have moved to another unit.
+        """
+        app.harness.set_leader(is_leader)
+
+    def restart(self, app):
+        """Restart the unit running the charm, as if for a new hook.
+
+        The `StoredState` is committed, and then the charm is created again with
+        a new model and framework, so that nothing else held in memory survives.
+
+        The `Harness` has no API for this, so it depends on how the `Harness`
+        from ops 1.x is put together (the tests are pinned to those versions),
+        and raises `NotImplementedError` with any `Harness` which doesn't match.
+        """
+        harness = app.harness
+        if not all(hasattr(harness, attr) for attr in _HARNESS_INTERNALS):
+            raise NotImplementedError("Restarting isn't supported with this ops")
+        framework = harness.framework
+        framework.commit()
+        # The same backend and storage are kept, since they stand in for Juju and
+        # for the unit's state on disk, and the rest is set up the same way that
+        # the harness does it.
+        model = Model(framework.meta, harness._backend)
+        harness._model = model
+        harness._framework = Framework(
+            storage=harness._storage,
+            charm_dir=framework.charm_dir,
+            meta=framework.meta,
+            model=model,
+        )
+        harness._charm = None
+        harness.begin()
+
+    def relate(self, app_a, endpoint_a, app_b, endpoint_b):
+        """Relate two applications and join all of their units.
+
+        No relation data is sent until `transmit` or `flush` is called.
+        """
+        relation = SimulatedRelation(app_a, endpoint_a, app_b, endpoint_b)
+        for app in relation.apps:
+            other = relation.other(app)
+            rid = app.harness.add_relation(relation.endpoints[app.name], other.name)
+            relation.relation_ids[app.name] = rid
+        for app in relation.apps:
+            other = relation.other(app)
+            for unit in other.units:
+                app.harness.add_relation_unit(relation.relation_ids[app.name], unit)
+            app.relations.append(relation)
+        self.relations.append(relation)
+        return relation
+
+    def unrelate(self, relation):
+        """Remove a relation, departing all units and breaking it on both sides.
+
+        Note that some versions of the ops Harness don't allow any remote relation
+        data to be read during relation-broken, even from other relations.
+        """
+        for app in relation.apps:
+            app.harness.remove_relation(relation.relation_ids[app.name])
+            app.relations.remove(relation)
+        self.relations.remove(relation)
+
+    def transmit(self, src, dst):
+        """Send the relation data from one application to another.
+
+        Only the data which has changed is sent, and only databags with changes
+        trigger a relation-changed event. Returns whether anything was sent.
+        """
+        changed = False
+        for relation in src.relations:
+            if relation.other(src) is dst:
+                changed = self._transmit(relation, src, dst) or changed
+        return changed
+
+    def _transmit(self, relation, src, dst):
+        src_rid = relation.relation_ids[src.name]
+        dst_rid = relation.relation_ids[dst.name]
+        bags = [(src.name, src.harness.get_relation_data(src_rid, src.name))]
+        for unit in src.units:
+            data = dict(src.unit_data[unit])
+            if unit == src.unit_name:
+                data.update(src.harness.get_relation_data(src_rid, unit))
+            bags.append((unit, data))
+        changed = False
+        for name, data in bags:
+            current = dst.harness.get_relation_data(dst_rid, name)
+            delta = {key: val for key, val in data.items() if current.get(key) != val}
+            # Removed keys have to be explicitly set to an empty string for the
+            # harness to remove them.
+            delta.update({key: "" for key in current.keys() - data.keys()})
+            if delta:
+                dst.harness.update_relation_data(dst_rid, name, delta)
+                changed = True
+        return changed
+
+    def flush(self, max_rounds=100):
+        """Send relation data in both directions on every relation until it
+        settles, returning the number of rounds it took.
+        """
+        for rounds in range(1, max_rounds + 1):
+            changed = False
+            for relation in list(self.relations):
+                app_a, app_b = relation.apps
+                changed = self._transmit(relation, app_a, app_b) or changed
+                changed = self._transmit(relation, app_b, app_a) or changed
+            if not changed:
+                return rounds
+        raise RuntimeError("Relation data did not settle in {} rounds".format(rounds))
+
+    def cleanup(self):
+        for app in self.apps.values():
+            app.harness.cleanup()
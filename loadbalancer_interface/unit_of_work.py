@@ -0,0 +1,193 @@
+"""Unit-of-work access to relation data.
+
+Normally, every read of a databag goes through the ops model and every write is
+a separate `relation-set` call as soon as it's made, scattered throughout the
+hook. In unit-of-work mode, each databag which is used is instead snapshotted
+into a plain dict the first time it's accessed in a hook, all reads are served
+from those snapshots, and writes are buffered and then flushed in one pass, in
+the order they were first made, when the framework commits at the end of the
+hook. Repeated writes to the same key, or writes which end up restoring the
+original value, are coalesced so that only the net changes are sent.
+
+This matches how Juju itself behaves, since relation data changes are only
+visible to other units once the hook has completed.
+
+The calls made to the model backend can also be counted per hook, to verify how
+many round trips each hook is making.
+"""
+
+import weakref
+from collections import Counter
+from collections.abc import MutableMapping
+from functools import wraps
+
+from ops.framework import Object
+
+
+_counters = weakref.WeakKeyDictionary()
+
+
+class BufferedDatabag(MutableMapping):
+    """A snapshot of a single databag, with buffered writes."""
+
+    def __init__(self, unit_of_work, relation, entity):
+        self._unit_of_work = unit_of_work
+        self._relation_key = (relation.name, relation.id)
+        self._entity = entity
+        self._data = dict(relation.data[entity])
+
+    def _content(self):
+        # The model may replace its Relation instances between events (leaving
+        # the old data content objects dangling), so look it up fresh.
+        relation = self._unit_of_work.model.get_relation(*self._relation_key)
+        if relation is None:
+            return None
+        return relation.data[self._entity]
+
+    @property
+    def dirty(self):
+        return self._unit_of_work.has_writes(self)
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __setitem__(self, key, value):
+        if not isinstance(value, str):
+            raise TypeError("Relation data values must be strings")
+        if value == "":
+            # Same as the ops model, setting an empty value removes the key.
+            self._data.pop(key, None)
+        else:
+            self._data[key] = value
+        self._unit_of_work.record(self, key)
+
+    def __delitem__(self, key):
+        del self._data[key]
+        self._unit_of_work.record(self, key)
+
+    def _flush(self, key, content):
+        value = self._data.get(key)
+        if value is None:
+            if key in content:
+                del content[key]
+                return True
+        elif content.get(key) != value:
+            content[key] = value
+            return True
+        return False
+
+
+class UnitOfWork:
+    """Snapshots of the databags used in a hook, and the writes made to them."""
+
+    def __init__(self, model):
+        self.model = model
+        self._bags = {}
+        self._writes = {}
+        self._dirty = set()
+
+    def bag(self, relation, entity):
+        """Get the buffered databag for an entity (unit or app) in a relation."""
+        key = (relation.id, entity.name)
+        bag = self._bags.get(key)
+        if bag is None:
+            bag = self._bags[key] = BufferedDatabag(self, relation, entity)
+        return bag
+
+    def record(self, bag, key):
+        # Only the first write to a key determines its place in the order.
+        self._writes.setdefault((id(bag), key), (bag, key))
+        self._dirty.add(id(bag))
+
+    def has_writes(self, bag):
+        return id(bag) in self._dirty
+
+    def invalidate(self, relation):
+        """Drop the snapshots for a relation whose data has changed, other than
+        any which have writes waiting to be flushed.
+        """
+        for key, bag in list(self._bags.items()):
+            if key[0] == relation.id and not bag.dirty:
+                del self._bags[key]
+
+    def flush(self):
+        """Write all of the buffered changes, returning how many were written."""
+        writes, self._writes = self._writes, {}
+        self._dirty.clear()
+        contents = {}
+        written = 0
+        for bag, key in writes.values():
+            if id(bag) not in contents:
+                contents[id(bag)] = bag._content()
+            if contents[id(bag)] is not None:
+                written += bag._flush(key, contents[id(bag)])
+        # Other units may change the data before the next hook.
+        self._bags.clear()
+        return written
+
+
+class BackendCallCounter(Object):
+    """Counts the calls made to the model backend during each hook.
+
+    There is a single counter per charm, which is installed the first time it
+    is requested, and the counts are reset when the framework commits at the
+    end of each hook, after being saved as `last_hook`.
+    """
+
+    # Writes are counted as `update_relation_data`, which is how the model makes
+    # them (and which the testing backend replaces entirely).
+    counted = (
+        "relation_get",
+        "update_relation_data",
+        "relation_list",
+        "relation_ids",
+        "is_leader",
+    )
+
+    def __init__(self, charm):
+        super().__init__(charm.framework, "lb-interface-call-counter")
+        self.calls = Counter()
+        self.databag_reads = Counter()
+        self.last_hook = None
+        backend = charm.framework.model._backend
+        for name in self.counted:
+            setattr(backend, name, self._counted(name, getattr(backend, name)))
+        self.framework.observe(self.framework.on.commit, self._on_commit)
+
+    @classmethod
+    def get(cls, charm):
+        """Get the call counter for a charm, installing it if needed."""
+        framework = charm.framework
+        if framework not in _counters:
+            _counters[framework] = cls(charm)
+        return _counters[framework]
+
+    def _counted(self, name, method):
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            self.calls[name] += 1
+            if name == "relation_get":
+                relation_id, member_name = args[:2]
+                self.databag_reads[(relation_id, member_name)] += 1
+            return method(*args, **kwargs)
+
+        return wrapper
+
+    @property
+    def counts(self):
+        """The counts for the current hook so far."""
+        return {"calls": dict(self.calls), "databag_reads": dict(self.databag_reads)}
+
+    def _on_commit(self, event):
+        self.last_hook = self.counts
+        self.calls.clear()
+        self.databag_reads.clear()
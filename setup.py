@@ -32,7 +32,6 @@ SETUP = {
     },
     "install_requires": [
         "ops>=1.0.0",
-        "cached_property",
         "marshmallow<4.0.0",
         "marshmallow-enum",
         "ops_reactive_interface",
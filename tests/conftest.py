@@ -1,11 +1,9 @@
 import builtins
 import inspect
-from unittest import mock
 
+# The plugin isn't auto-loaded for the functional tests.
+from loadbalancer_interface.pytest_plugin import lb_relation_sim  # noqa: F401
 
-# Cached properties are useful at runtime for efficiency, but make unit
-# testing harder. This simply replaces @cached_property with @property.
-mock.patch("cached_property.cached_property", property).start()
 
 if not hasattr(builtins, "breakpoint"):
     # Shim breakpoint() builtin from PEP-0553 prior to 3.7
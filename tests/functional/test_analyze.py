@@ -0,0 +1,102 @@
+import json
+
+from ops.storage import SQLiteStorage
+
+from loadbalancer_interface import analyze
+from loadbalancer_interface.soak import SoakConsumerCharm, SoakProviderCharm
+
+
+def show_unit(app, relation, other):
+    """Build the `juju show-unit` output for an app's unit in a simulation."""
+    relation_id = relation.relation_ids[app.name]
+    return {
+        app.unit_name: {
+            "leader": True,
+            "relation-info": [
+                {
+                    "endpoint": relation.endpoints[app.name],
+                    "relation-id": relation_id,
+                    "application-data": dict(relation.data(other, other.name)),
+                    "local-unit": {"in-scope": True, "data": {}},
+                    "related-units": {
+                        unit: {"in-scope": True, "data": other.unit_data.get(unit, {})}
+                        for unit in other.units
+                    },
+                }
+            ],
+        }
+    }
+
+
+def request_lb(consumer, name, backends=()):
+    lb_provider = consumer.charm.lb_provider
+    request = lb_provider.get_request(name)
+    request.protocol = request.protocols.http
+    request.port_mapping = {80: 80}
+    request.backends = list(backends)
+    lb_provider.send_request(request)
+
+
+def test_analyze(lb_relation_sim, tmp_path, capsys):
+    sim = lb_relation_sim
+    provider = sim.add_app(SoakProviderCharm, SoakProviderCharm._meta)
+    consumer = sim.add_app(SoakConsumerCharm, SoakConsumerCharm._meta, units=2)
+    relation = sim.relate(consumer, "lb-provider", provider, "lb-consumers")
+    sim.flush()
+    lb_p = consumer.charm.lb_provider
+    for name in ("foo", "bar", "baz"):
+        request_lb(consumer, name)
+    sim.flush()
+    state = provider.charm.lb_consumers.state._data.snapshot()
+    state_path = tmp_path / "state.json"
+    handle = "SoakProviderCharm/LBConsumers[lb-consumers]/StoredStateData[state]"
+    state_path.write_text(json.dumps({handle: state}))
+    db_path = tmp_path / ".unit-state.db"
+    storage = SQLiteStorage(db_path)
+    storage.save_snapshot(handle, state)
+    storage.commit()
+    storage.close()
+    assert analyze.load_state(db_path, "lb-consumers") == state
+
+    # Changes which the provider hasn't seen yet.
+    request_lb(consumer, "foo", backends=["10.1.1.1"])
+    request_lb(consumer, "qux")
+    removed_id = lb_p.get_request("baz").id
+    lb_p.remove_request("baz")
+    sent = relation.data(consumer, consumer.name)
+    sent["request_bad"] = json.dumps({"id": "bad", "name": "bad"})
+    snapshot = show_unit(provider, relation, consumer)
+    snapshot.update(show_unit(consumer, relation, provider))
+    snapshot_path = tmp_path / "snapshot.json"
+    snapshot_path.write_text(json.dumps(snapshot))
+
+    report = analyze.analyze(
+        analyze.load_units(snapshot_path), analyze.load_state(state_path)
+    )
+    by_unit = {rel["unit"]: rel for rel in report["relations"]}
+    provider_rel = by_unit[provider.unit_name]
+    assert (provider_rel["requests"], provider_rel["responses"]) == (4, 0)
+    assert provider_rel["version"] == 2
+    assert provider_rel["remote_app"] == consumer.name
+    sizes = provider_rel["databag_bytes"]
+    assert set(sizes) == {consumer.name, provider.unit_name, *consumer.units}
+    assert sizes[consumer.name] > sizes[consumer.units[1]] > 0
+    assert [item["key"] for item in provider_rel["invalid"]] == ["request_bad"]
+    assert all(
+        timing["total"] >= timing["max"] > 0
+        for timing in provider_rel["timings"].values()
+    )
+    consumer_rel = by_unit[consumer.unit_name]
+    assert (consumer_rel["requests"], consumer_rel["responses"]) == (0, 3)
+    assert consumer_rel["invalid"] == []
+
+    replayed = report["replay"]
+    assert replayed["unit"] == provider.unit_name
+    assert [request["name"] for request in replayed["new"]] == ["qux"]
+    assert [request["name"] for request in replayed["changed"]] == ["foo"]
+    assert replayed["removed"] == [removed_id]
+
+    analyze.main([str(snapshot_path), "--state", str(state_path)])
+    output = capsys.readouterr().out
+    assert "INVALID request_bad" in output
+    assert "changed soak-consumer:foo" in output
@@ -1,129 +1,90 @@
-from collections import defaultdict
+import json
+import time
+from functools import partial
+from operator import attrgetter
+from unittest import mock
+
+import pytest
+from marshmallow import ValidationError
 
 from ops.charm import CharmBase
-from ops.model import Unit
 from ops.testing import Harness
 
-from loadbalancer_interface import LBProvider, LBConsumers
-
+from loadbalancer_interface import LBProvider, LBConsumers, provides
+from loadbalancer_interface.base import content_hash
+from loadbalancer_interface.schemas.base import SchemaWrapper
+from loadbalancer_interface.schemas.v2 import Request
+from loadbalancer_interface.unit_of_work import BackendCallCounter
 
-def test_interface(request):
-    provider = Harness(ProviderCharm, meta=ProviderCharm._meta)
-    provider.set_model_name(request.node.originalname)
-    provider.begin()
-
-    consumer = Harness(ConsumerCharm, meta=ConsumerCharm._meta)
-    consumer.set_model_name(request.node.originalname)
-    consumer.begin()
 
-    peer_units = defaultdict(list)
+def test_interface(lb_relation_sim):
+    sim = lb_relation_sim
+    provider = sim.add_app(ProviderCharm, ProviderCharm._meta, leader=False)
+    consumer = sim.add_app(ConsumerCharm, ConsumerCharm._meta, units=2, leader=False)
 
     # Helpers
-    def add_peer_unit(harness):
-        units = [harness.charm.unit] + peer_units[harness]
-        next_unit_num = max(int(unit.name.split("/")[1]) for unit in units) + 1
-        new_unit = Unit(
-            "/".join((harness.charm.app.name, str(next_unit_num))),
-            harness.charm.unit._cache._meta,
-            harness.charm.unit._backend,
-            harness.charm.unit._cache,
-        )
-        peer_units[harness].append(new_unit)
-        return new_unit
-
-    def get_rel_data(harness, src):
+    def get_rel_data(app, src):
         if hasattr(src, "name"):
             src = src.name
-        return harness.get_relation_data(harness._rid, src)
-
-    def update_rel_data(harness, data_map):
-        for src, data in data_map.items():
-            if hasattr(src, "name"):
-                src = src.name
-            harness.update_relation_data(harness._rid, src, data)
-
-    def transmit_rel_data(src_harness, dst_harness):
-        data = {}
-        for src in [src_harness.charm.app, src_harness.charm.unit] + peer_units[
-            src_harness
-        ]:
-            src_data = get_rel_data(src_harness, src)
-            dst_data = get_rel_data(dst_harness, src)
-            # Removed keys have to be explicitly set to an empty string for the
-            # harness to remove them. (TODO: file upstream bug)
-            for removed in dst_data.keys() - src_data.keys():
-                src_data[removed] = ""
-            data[src] = src_data
-        update_rel_data(dst_harness, data)
+        return relation.data(app, src)
+
+    def set_address(unit, address):
+        consumer.unit_data[unit]["ingress-address"] = address
 
     p_charm = provider.charm
     p_app = p_charm.app
-    p_unit_0 = p_charm.unit
 
     c_charm = consumer.charm
     c_app = c_charm.app
-    c_unit0 = c_charm.unit
-    c_unit1 = add_peer_unit(consumer)
+    c_unit0, c_unit1 = consumer.units
 
     # Setup initial relation with only Juju-provided automatic data.
-    provider._rid = provider.add_relation("lb-consumers", c_charm.app.name)
-    consumer._rid = consumer.add_relation("lb-provider", p_charm.app.name)
-    # NB: The first unit added to the relation determines the app of the
-    # relation, so it's critical to add a remote unit before any local units.
-    provider.add_relation_unit(provider._rid, c_unit0.name)
-    provider.add_relation_unit(provider._rid, c_unit1.name)
-    provider.add_relation_unit(provider._rid, p_unit_0.name)
-    consumer.add_relation_unit(consumer._rid, p_unit_0.name)
-    consumer.add_relation_unit(consumer._rid, c_unit0.name)
-    consumer.add_relation_unit(consumer._rid, c_unit1.name)
-    update_rel_data(
-        consumer,
-        {
-            c_unit1: {"ingress-address": "192.168.0.3"},
-            c_unit0: {"ingress-address": "192.168.0.5"},
-        },
-    )
+    relation = sim.relate(provider, "lb-consumers", consumer, "lb-provider")
+    set_address(c_unit1, "192.168.0.3")
+    set_address(c_unit0, "192.168.0.5")
+    sim.transmit(consumer, provider)
 
     # Confirm that non-leaders cannot set the version.
-    provider.set_leader(False)
     p_charm.lb_consumers._set_version()
     assert not get_rel_data(provider, p_app)
 
     # Confirm that only leaders set the version.
-    provider.set_leader(True)
+    sim.set_leader(provider)
     p_charm.lb_consumers._set_version()
-    assert get_rel_data(provider, p_app) == {"version": "1"}
+    assert get_rel_data(provider, p_app) == {"version": "2"}
     assert not c_charm.lb_provider.is_available  # waiting on remote version
     assert not c_charm.lb_provider.can_request  # waiting on remote version
 
     # Transmit version, but non-leader still can't make requests
-    transmit_rel_data(provider, consumer)
+    sim.transmit(provider, consumer)
     assert c_charm.lb_provider.is_available
     assert not c_charm.lb_provider.can_request  # not leader
 
     # Verify that becoming leader completes the version negotiation process and
     # allows sending requests.
-    consumer.set_leader(True)
+    sim.set_leader(consumer)
     c_charm.lb_provider._set_version()
     assert c_charm.lb_provider.can_request
-    assert get_rel_data(consumer, c_app) == {"version": "1"}
-    transmit_rel_data(consumer, provider)
+    assert get_rel_data(consumer, c_app) == {"version": "2"}
+    sim.transmit(consumer, provider)
 
     # Test creating and sending a request.
     c_charm.request_lb("foo")
     foo_id = c_charm.lb_provider.get_request("foo").id
-    transmit_rel_data(consumer, provider)
+    sim.transmit(consumer, provider)
     assert foo_id in p_charm.lb_consumers.state.known_requests
 
     # Confirm leaders can read requests
     assert p_charm.lb_consumers.all_requests[0].backends == [
-        "192.168.0.5",
         "192.168.0.3",
+        "192.168.0.5",
     ]
     assert p_charm.changes == {"foo": 1}
+    # Repeated reads within a hook are served from the cache
+    assert p_charm.lb_consumers.all_requests is p_charm.lb_consumers.all_requests
 
     # Confirm non-leaders cannot read requests
-    provider.set_leader(False)
+    sim.set_leader(provider, False)
     assert len(p_charm.lb_consumers.all_requests) == 0
 
     # Confirm non-leaders can see requests with read permission
@@ -135,25 +96,23 @@ def test_interface(request):
     assert len(p_charm.lb_consumers.all_requests) == 0
 
     # Test receiving the response
-    provider.set_leader(True)
+    sim.set_leader(provider)
     assert not c_charm.active_lbs
     assert not c_charm.failed_lbs
-    transmit_rel_data(provider, consumer)
+    sim.transmit(provider, consumer)
     assert c_charm.changes == {"foo": 1}
     assert c_charm.active_lbs == {"foo"}
     assert not c_charm.failed_lbs
     assert c_charm.lb_provider.get_response("foo").address == "lb-foo"
+    view = c_charm.lb_provider.get_response_view("foo")
+    assert view and not view.error and view.address == "lb-foo"
+    assert c_charm.lb_provider.get_response_view("bar") is None
 
     # Test default updates being tracked
-    update_rel_data(
-        consumer,
-        {
-            c_unit1: {"ingress-address": "192.168.0.4"},
-            c_unit0: {"ingress-address": "192.168.0.6"},
-        },
-    )
-    transmit_rel_data(consumer, provider)
-    transmit_rel_data(provider, consumer)
+    set_address(c_unit1, "192.168.0.4")
+    set_address(c_unit0, "192.168.0.6")
+    sim.transmit(consumer, provider)
+    sim.transmit(provider, consumer)
     assert p_charm.changes == {"foo": 3}
     # Note: Since the request didn't change, the requires side doesn't see
     # a change in the response.
@@ -165,14 +124,14 @@ def test_interface(request):
     c_charm.request_lb("foo", ["192.168.0.5"])
     lb_p = c_charm.lb_provider
     assert len(lb_p.complete_responses) != len(lb_p.all_responses)
-    consumer.set_leader(False)
+    sim.set_leader(consumer, False)
     # non-leaders can't read app-level relation data set by their own leader, so can't
     # verify whether a response has been updated or not; however, they should still be
     # able to read responses
     assert len(lb_p.complete_responses) == len(lb_p.all_responses)
-    consumer.set_leader(True)
-    transmit_rel_data(consumer, provider)
-    transmit_rel_data(provider, consumer)
+    sim.set_leader(consumer)
+    sim.transmit(consumer, provider)
+    sim.transmit(provider, consumer)
     assert p_charm.lb_consumers.all_requests[0].backends == ["192.168.0.5"]
     assert p_charm.changes == {"foo": 4}
     assert c_charm.changes == {"foo": 2}
@@ -182,15 +141,38 @@ def test_interface(request):
     # Test sending a second request
     c_charm.request_lb("bar")
     bar_id = c_charm.lb_provider.get_request("bar").id
-    transmit_rel_data(consumer, provider)
-    transmit_rel_data(provider, consumer)
+    sim.transmit(consumer, provider)
+    sim.transmit(provider, consumer)
     assert bar_id in p_charm.lb_consumers.state.known_requests
     assert c_charm.active_lbs == {"foo"}
     assert c_charm.failed_lbs == {"bar"}
 
+    # Test backend health updates, which only rewrite the response when changed
+    # and don't show up as a changed response.
+    lb_c = p_charm.lb_consumers
+    req = lb_c.all_requests[1]
+    assert req.name == "foo"
+    healthy = req.response.health_states.healthy
+    assert lb_c.update_backend_health(req, {"192.168.0.5": healthy})
+    assert not lb_c.update_backend_health(req, {"192.168.0.5": "healthy"})
+    sim.transmit(provider, consumer)
+    assert c_charm.changes == {"foo": 2, "bar": 1}
+    assert c_charm.health == {"foo": {"192.168.0.5": healthy}}
+    assert not c_charm.lb_provider.new_backend_health
+
+    # Confirm the flag checks only load each request once
+    lb_p = c_charm.lb_provider
+    lb_p._cache.invalidate()
+    with mock.patch.object(Request, "loads", wraps=Request.loads) as loads:
+        assert lb_p.is_available
+        assert lb_p.has_response
+        assert not lb_p.is_changed
+        assert len(lb_p.all_requests) == 2
+    assert loads.call_count == 2
+
     # Test request removal
     c_charm.lb_provider.remove_request("bar")
-    transmit_rel_data(consumer, provider)
+    sim.transmit(consumer, provider)
     assert foo_id in p_charm.lb_consumers.state.known_requests
     assert bar_id not in p_charm.lb_consumers.state.known_requests
     assert len(p_charm.lb_consumers.all_requests) == 1
@@ -198,10 +180,109 @@ def test_interface(request):
     # Test response revocation
     req = p_charm.lb_consumers.all_requests[0]
     p_charm.lb_consumers.revoke_response(req)
-    transmit_rel_data(provider, consumer)
+    sim.transmit(provider, consumer)
     assert not c_charm.active_lbs
 
 
+def test_new_requests_cached(lb_relation_sim):
+    sim = lb_relation_sim
+    provider = sim.add_app(ProviderCharm, ProviderCharm._meta)
+    consumer = sim.add_app(ConsumerCharm, ConsumerCharm._meta)
+    sim.relate(consumer, "lb-provider", provider, "lb-consumers")
+    sim.flush()
+    names = ["req{}".format(i) for i in range(20)]
+    for name in names:
+        consumer.charm.request_lb(name)
+    sim.flush()
+    lb_c = provider.charm.lb_consumers
+    lb_c._cache.invalidate()
+
+    with mock.patch.object(
+        Request, "dump", autospec=True, side_effect=Request.dump
+    ) as dump:
+        for _ in range(3):
+            assert lb_c.new_requests == []
+        # Each request is only hashed once, however often it's checked.
+        assert dump.call_count == len(names)
+        (request,) = [req for req in lb_c.all_requests if req.name == "req0"]
+        request.response.error_message = "Another reason"
+        lb_c.send_response(request)
+        dump.reset_mock()
+        assert lb_c.new_requests == []
+        # Writing the response only drops the hash for that request.
+        assert dump.call_count == 1
+
+
+def test_v1_peers(request):
+    # Consumer talking to a v1 provider.
+    consumer = Harness(ConsumerCharm, meta=ConsumerCharm._meta)
+    consumer.set_model_name(request.node.originalname)
+    consumer.set_leader(True)
+    consumer.begin()
+    c_charm = consumer.charm
+    rid = consumer.add_relation("lb-provider", "provider")
+    consumer.add_relation_unit(rid, "provider/0")
+    consumer.update_relation_data(rid, "provider", {"version": "1"})
+
+    lb_p = c_charm.lb_provider
+    req = lb_p.get_request("foo")
+    req.protocol = req.protocols.tcp
+    req.port_mapping = {80: 80}
+    req.algorithm = [req.algorithms.weighted, req.algorithms.least_conn]
+    req.backends = ["10.0.0.1", "10.0.0.2"]
+    req.weights = {"10.0.0.1": 2}
+    lb_p.send_request(req)
+    sent = json.loads(consumer.get_relation_data(rid, "consumer")["request_foo"])
+    assert "weights" not in sent
+    assert sent["algorithm"] == ["weighted", "least-conn"]
+    assert sent["sent_hash"] == req.sent_hash
+
+    response = {"address": "lb-foo", "received_hash": sent["sent_hash"]}
+    consumer.update_relation_data(
+        rid, "provider", {"response_foo": json.dumps(response)}
+    )
+    assert c_charm.active_lbs == {"foo"}
+    req = lb_p.get_request("foo")
+    assert req.version == 2
+    assert req.algorithm == [req.algorithms.weighted, req.algorithms.least_conn]
+    # The algorithms can still be compared to the strings from v1.
+    assert req.algorithm == ["weighted", "least-conn"]
+    assert req.weights == {}
+    assert req.response.address == "lb-foo"
+
+    # Free-form algorithms from v1 can still be sent to a v1 provider.
+    req.algorithm = ["leastconn", "least_conn"]
+    lb_p.send_request(req)
+    sent = json.loads(consumer.get_relation_data(rid, "consumer")["request_foo"])
+    assert sent["algorithm"] == ["leastconn", "least-conn"]
+
+    # Provider talking to a v1 consumer.
+    provider = Harness(ProviderCharm, meta=ProviderCharm._meta)
+    provider.set_model_name(request.node.originalname)
+    provider.set_leader(True)
+    provider.begin()
+    p_charm = provider.charm
+    rid = provider.add_relation("lb-consumers", "consumer")
+    provider.add_relation_unit(rid, "consumer/0")
+    provider.update_relation_data(
+        rid,
+        "consumer",
+        {"version": "1", "request_foo": json.dumps(dict(sent, algorithm=["foo"]))},
+    )
+    assert p_charm.changes == {"foo": 1}
+    lb_c = p_charm.lb_consumers
+    req = lb_c.all_requests[0]
+    assert req.version == 2
+    assert req.algorithm == ["foo"]
+    assert req.hash is not None
+    req.response.error = req.response.error_types.unsupported
+    req.response.error_fields = {"weights": "no weights"}
+    lb_c.send_response(req)
+    sent = json.loads(provider.get_relation_data(rid, "provider")["response_foo"])
+    assert sent["error_fields"] == {}
+    assert sent["error_message"] == "weights: no weights"
+
+
 # TODO: Replace these with the example charms.
 class ProviderCharm(CharmBase):
     _meta = """
@@ -211,9 +292,17 @@ class ProviderCharm(CharmBase):
             interface: loadbalancer
     """
 
+    _peer_relation = None
+    _unit_of_work = False
+
     def __init__(self, *args):
         super().__init__(*args)
-        self.lb_consumers = LBConsumers(self, "lb-consumers")
+        self.lb_consumers = LBConsumers(
+            self,
+            "lb-consumers",
+            peer_relation=self._peer_relation,
+            unit_of_work=self._unit_of_work,
+        )
 
         self.framework.observe(self.lb_consumers.on.requests_changed, self._update_lbs)
 
@@ -221,17 +310,20 @@ class ProviderCharm(CharmBase):
 
     def _update_lbs(self, event):
         for request in self.lb_consumers.new_requests:
-            self.changes.setdefault(request.name, 0)
-            self.changes[request.name] += 1
-            if request.name == "foo":
-                request.response.address = "lb-" + request.name
-            else:
-                request.response.error = request.response.error_types.unsupported
-                request.response.error_message = "No reason"
-            self.lb_consumers.send_response(request)
+            self._respond(request)
         for request in self.lb_consumers.removed_requests:
             self.lb_consumers.revoke_response(request)
 
+    def _respond(self, request):
+        self.changes.setdefault(request.name, 0)
+        self.changes[request.name] += 1
+        if request.name == "foo":
+            request.response.address = "lb-" + request.name
+        else:
+            request.response.error = request.response.error_types.unsupported
+            request.response.error_message = "No reason"
+        self.lb_consumers.send_response(request)
+
 
 class ConsumerCharm(CharmBase):
     _meta = """
@@ -241,16 +333,30 @@ class ConsumerCharm(CharmBase):
             interface: loadbalancer
     """
 
+    _distribution = None
+    _peer_relation = None
+    _unit_of_work = False
+
     def __init__(self, *args):
         super().__init__(*args)
         self._to_break = False
-        self.lb_provider = LBProvider(self, "lb-provider")
+        self.lb_provider = LBProvider(
+            self,
+            "lb-provider",
+            distribution=self._distribution,
+            peer_relation=self._peer_relation,
+            unit_of_work=self._unit_of_work,
+        )
 
         self.framework.observe(self.lb_provider.on.response_changed, self._update_lbs)
+        self.framework.observe(
+            self.lb_provider.on.backend_health_changed, self._update_health
+        )
 
         self.changes = {}
         self.active_lbs = set()
         self.failed_lbs = set()
+        self.health = {}
 
     def request_lb(self, name, backends=None):
         request = self.lb_provider.get_request(name)
@@ -274,3 +380,969 @@ class ConsumerCharm(CharmBase):
         for response in self.lb_provider.revoked_responses:
             self.active_lbs.discard(response.name)
             self.failed_lbs.discard(response.name)
+
+    def _update_health(self, event):
+        for response in self.lb_provider.new_backend_health:
+            self.health[response.name] = dict(response.backend_health)
+            self.lb_provider.ack_backend_health(response)
+
+
+def test_string_algorithms(lb_relation_sim):
+    sim = lb_relation_sim
+    provider = sim.add_app(ProviderCharm, ProviderCharm._meta)
+    consumer = sim.add_app(ConsumerCharm, ConsumerCharm._meta)
+    sim.relate(consumer, "lb-provider", provider, "lb-consumers")
+    sim.flush()
+    lb_p = consumer.charm.lb_provider
+
+    request = lb_p.get_request("foo")
+    request.protocol = request.protocols.http
+    request.port_mapping = {80: 80}
+    request.algorithm = ["round-robin", "least_conn"]
+    lb_p.send_request(request)
+    sim.flush()
+    (received,) = provider.charm.lb_consumers.all_requests
+    assert received.algorithm == [
+        received.algorithms.round_robin,
+        received.algorithms.least_conn,
+    ]
+    assert consumer.charm.active_lbs == {"foo"}
+
+    request.algorithm = ["fastest"]
+    with pytest.raises(ValidationError):
+        lb_p.send_request(request)
+
+
+def test_multiple_providers(request):
+    consumer = Harness(MultiConsumerCharm, meta=ConsumerCharm._meta)
+    consumer.set_model_name(request.node.originalname)
+    consumer.set_leader(True)
+    consumer.begin()
+    c_charm = consumer.charm
+
+    rids = {}
+    for app in ("provider-a", "provider-b", "provider-c"):
+        rids[app] = consumer.add_relation("lb-provider", app)
+        consumer.add_relation_unit(rids[app], app + "/0")
+        consumer.update_relation_data(rids[app], app, {"version": "1"})
+    assert len(c_charm.lb_provider.relations) == 3
+
+    def respond(app, name, **response):
+        data = consumer.get_relation_data(rids[app], c_charm.app.name)
+        sent = json.loads(data["request_" + name])
+        response["received_hash"] = sent["sent_hash"]
+        response_data = {"response_" + name: json.dumps(response)}
+        consumer.update_relation_data(rids[app], app, response_data)
+
+    def sent_to(name):
+        return {
+            app
+            for app, rid in rids.items()
+            if "request_" + name in consumer.get_relation_data(rid, c_charm.app.name)
+        }
+
+    # Requests are sharded across providers by name.
+    names = ["svc{}".format(i) for i in range(10)]
+    for name in names:
+        c_charm.request_lb(name)
+    assignments = {name: sent_to(name) for name in names}
+    assert all(len(apps) == 1 for apps in assignments.values())
+    assert len(set.union(*assignments.values())) > 1
+
+    # Responses are aggregated from each provider.
+    for name, (app,) in assignments.items():
+        respond(app, name, address="lb-" + name)
+    lb_p = c_charm.lb_provider
+    assert [r.name for r in lb_p.complete_responses] == sorted(names)
+    assert lb_p.get_response("svc0").address == "lb-svc0"
+    assert c_charm.changes == {name: 1 for name in names}
+
+    # Re-sending is stable and keeps the request ID.
+    svc0_id = lb_p.get_request("svc0").id
+    c_charm.request_lb("svc0")
+    assert sent_to("svc0") == assignments["svc0"]
+    assert lb_p.get_request("svc0").id == svc0_id
+
+    # Replicated requests go to every provider and use the best response.
+    lb_p.distribution = lb_p.REPLICATE
+    c_charm.request_lb("svc0")
+    assert sent_to("svc0") == set(rids)
+    assert lb_p.get_request("svc0").id == svc0_id
+    (primary,) = assignments["svc0"]
+    others = sorted(set(rids) - {primary})
+    respond(others[0], "svc0", error="unsupported", error_message="no")
+    respond(others[1], "svc0", address="lb-svc0-b")
+    assert len(lb_p.get_responses("svc0")) == 3
+    assert lb_p.get_response("svc0").address == "lb-svc0"
+    respond(primary, "svc0", error="unsupported", error_message="no")
+    assert lb_p.get_response("svc0").address == "lb-svc0-b"
+    assert lb_p.get_response_view("svc0").address == "lb-svc0-b"
+    assert [r.name for r in lb_p.complete_responses] == sorted(names)
+    assert not lb_p.get_request("svc0").response.error
+
+    # Removal clears the request from every provider.
+    lb_p.remove_request("svc0")
+    assert not sent_to("svc0")
+
+
+class MultiConsumerCharm(ConsumerCharm):
+    _distribution = LBProvider.SHARD
+
+
+def test_shard_provider_removed(request):
+    consumer = Harness(MultiConsumerCharm, meta=ConsumerCharm._meta)
+    consumer.set_model_name(request.node.originalname)
+    consumer.set_leader(True)
+    consumer.begin()
+    c_charm = consumer.charm
+    lb_p = c_charm.lb_provider
+
+    rids = {}
+    for app in ("provider-a", "provider-b", "provider-c"):
+        rids[app] = consumer.add_relation("lb-provider", app)
+        consumer.add_relation_unit(rids[app], app + "/0")
+        consumer.update_relation_data(rids[app], app, {"version": "2"})
+
+    def sent_to(name):
+        return {
+            app
+            for app, rid in rids.items()
+            if "request_" + name in consumer.get_relation_data(rid, c_charm.app.name)
+        }
+
+    names = ["svc{}".format(i) for i in range(9)]
+    for name in names:
+        c_charm.request_lb(name)
+    ids = {name: lb_p.get_request(name).id for name in names}
+    for name in names:
+        (app,) = sent_to(name)
+        data = consumer.get_relation_data(rids[app], c_charm.app.name)
+        sent = json.loads(data["request_" + name])
+        response = {"address": "lb-" + name, "received_hash": sent["sent_hash"]}
+        response_data = {"response_" + name: json.dumps(response)}
+        consumer.update_relation_data(rids[app], app, response_data)
+    assert c_charm.active_lbs == set(names)
+
+    # The requests of a removed provider are moved to the remaining ones.
+    removed = max(rids, key=lambda app: sum(app in sent_to(n) for n in names))
+    orphans = [name for name in names if sent_to(name) == {removed}]
+    # Unlike Juju, the harness doesn't allow the remote data of the remaining
+    # relations to be read during relation-broken (see LP#1960934).
+    backend = consumer._backend
+    remote_apps = {rid: app for app, rid in rids.items()}
+    with mock.patch.object(backend, "relation_remote_app_name", remote_apps.get):
+        consumer.remove_relation(rids.pop(removed))
+    for name in names:
+        (app,) = sent_to(name)
+        assert app != removed
+        assert lb_p.get_request(name).id == ids[name]
+    assert c_charm.active_lbs == set(names) - set(orphans)
+    assert sorted(r.name for r in lb_p.revoked_responses) == orphans
+    assert not lb_p.get_request(orphans[0]).response
+
+
+class PeerProviderCharm(ProviderCharm):
+    _meta = ProviderCharm._meta + """
+        peers:
+          lb-peers:
+            interface: lb-peers
+    """
+    _peer_relation = "lb-peers"
+
+
+class PeerConsumerCharm(ConsumerCharm):
+    _meta = ConsumerCharm._meta + """
+        peers:
+          lb-peers:
+            interface: lb-peers
+    """
+    _peer_relation = "lb-peers"
+
+
+def test_peer_digest(lb_relation_sim):
+    sim = lb_relation_sim
+    provider = sim.add_app(PeerProviderCharm, PeerProviderCharm._meta)
+    consumer = sim.add_app(PeerConsumerCharm, PeerConsumerCharm._meta)
+    relation = sim.relate(consumer, "lb-provider", provider, "lb-consumers")
+    peer_rids = {
+        app.name: app.harness.add_relation("lb-peers", app.name)
+        for app in (provider, consumer)
+    }
+    sim.flush()
+    lb_p = consumer.charm.lb_provider
+    lb_c = provider.charm.lb_consumers
+
+    def commit():
+        # The digest is published when the hook's changes are committed.
+        for app in (provider, consumer):
+            app.harness.framework.commit()
+
+    def become_follower(app):
+        sim.set_leader(app, False)
+        peer = app.charm.model.get_relation("lb-peers")
+        app.charm.on["lb-peers"].relation_changed.emit(peer, app.charm.app)
+
+    def published(app, endpoint):
+        data = app.harness.get_relation_data(peer_rids[app.name], app.name)
+        return json.loads(data["digest_" + endpoint])
+
+    consumer.charm.request_lb("foo")
+    sim.flush()
+    # Building the digest to publish doesn't load any requests or responses.
+    lb_p._cache.invalidate()
+    lb_c._cache.invalidate()
+    load = mock.patch.object(
+        SchemaWrapper, "_load", autospec=True, side_effect=SchemaWrapper._load
+    )
+    with load as loads:
+        commit()
+    assert not loads.called
+    rid = str(relation.relation_ids[consumer.name])
+    assert published(consumer, "lb-provider") == lb_p.digest
+    request_hash, response_hash = lb_p.digest[rid]["foo"].split(":")
+    assert request_hash and response_hash
+    assert published(provider, "lb-consumers") == {
+        str(relation.relation_ids[provider.name]): {
+            "foo": "{}:{}".format(request_hash, response_hash)
+        }
+    }
+
+    become_follower(consumer)
+    assert lb_p.digest == published(consumer, "lb-provider")
+    assert [r.name for r in lb_p.complete_responses] == ["foo"]
+    assert lb_p.digest_changes == [(int(rid), "foo")]
+    lb_p.ack_digest()
+    assert lb_p.digest_changes == []
+    become_follower(provider)
+    assert lb_c.digest == published(provider, "lb-consumers")
+    # Followers only have to load the requests which have changed.
+    provider_rid = relation.relation_ids[provider.name]
+    assert lb_c.digest_changes == [(provider_rid, "foo")]
+    assert lb_c.get_request(provider_rid, "foo") is None
+    lb_c.follower_perms(read=True)
+    with mock.patch.object(Request, "loads", wraps=Request.loads) as loads:
+        changed = [lb_c.get_request(*change) for change in lb_c.digest_changes]
+        assert [request.name for request in changed] == ["foo"]
+        assert lb_c.get_request(provider_rid, "bar") is None
+    assert loads.call_count == 1
+    lb_c.ack_digest()
+    lb_c.follower_perms(read=False)
+
+    # Followers can tell that the response is stale once the request changes.
+    sim.set_leader(consumer)
+    consumer.charm.request_lb("foo", backends=["10.1.1.1"])
+    sim.transmit(consumer, provider)
+    commit()
+    become_follower(consumer)
+    assert lb_p.digest[rid]["foo"].split(":")[1] == ""
+    assert lb_p.complete_responses == []
+    assert [r.name for r in lb_p.all_responses] == ["foo"]
+    assert lb_p.digest_changes == [(int(rid), "foo")]
+
+
+class UnitOfWorkProviderCharm(ProviderCharm):
+    _unit_of_work = True
+
+
+class UnitOfWorkConsumerCharm(ConsumerCharm):
+    _unit_of_work = True
+
+
+def test_unit_of_work(lb_relation_sim):
+    sim = lb_relation_sim
+    provider = sim.add_app(UnitOfWorkProviderCharm, ProviderCharm._meta)
+    consumer = sim.add_app(UnitOfWorkConsumerCharm, ConsumerCharm._meta)
+    relation = sim.relate(consumer, "lb-provider", provider, "lb-consumers")
+    lb_p = consumer.charm.lb_provider
+    lb_c = provider.charm.lb_consumers
+
+    def settle():
+        # Writes are only flushed when the hook's changes are committed.
+        for _ in range(10):
+            for app in (provider, consumer):
+                app.harness.framework.commit()
+            if sim.flush() == 1:
+                return
+
+    settle()
+    sent = relation.data(consumer, consumer.name)
+    assert sent["version"]
+    for backends in (["10.1.1.1"], ["10.1.1.2"]):
+        consumer.charm.request_lb("foo", backends=backends)
+    consumer.charm.request_lb("bar")
+    # Reads see the buffered writes, but they haven't been sent yet.
+    assert lb_p.get_request("foo").backends == ["10.1.1.2"]
+    assert "request_foo" not in sent
+    assert lb_p.call_counts["calls"].get("update_relation_data", 0) == 0
+    consumer.harness.framework.commit()
+    # Both writes to the same key were coalesced into one.
+    assert consumer.charm.lb_provider.call_counts == {"calls": {}, "databag_reads": {}}
+    counter = BackendCallCounter.get(consumer.charm)
+    assert counter.last_hook["calls"]["update_relation_data"] == 2
+    assert list(sent)[-2:] == ["request_foo", "request_bar"]
+
+    sim.transmit(consumer, provider)
+    assert {req.name for req in lb_c.all_requests} == {"foo", "bar"}
+    assert max(lb_c.call_counts["databag_reads"].values()) == 1
+    settle()
+    assert consumer.charm.active_lbs == {"foo"}
+    assert consumer.charm.failed_lbs == {"bar"}
+    lb_p.remove_request("bar")
+    assert "request_bar" in sent
+    settle()
+    assert "request_bar" not in sent
+    assert provider.charm.lb_consumers.removed_requests == []
+
+
+class BudgetedProviderCharm(ProviderCharm):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.processed = []
+        self.budget = {"max_requests": 2}
+
+    def _update_lbs(self, event):
+        result = self.lb_consumers.process_requests(
+            self._respond, event=event, **self.budget
+        )
+        self.processed.extend(request.name for request in result.processed)
+
+
+def test_process_requests(lb_relation_sim):
+    sim = lb_relation_sim
+    provider = sim.add_app(BudgetedProviderCharm, ProviderCharm._meta)
+    con_a = sim.add_app(ConsumerCharm, ConsumerCharm._meta, name="consumer-a")
+    con_b = sim.add_app(ConsumerCharm, ConsumerCharm._meta, name="consumer-b")
+    for consumer in (con_a, con_b):
+        sim.relate(consumer, "lb-provider", provider, "lb-consumers")
+    sim.flush()
+    lb_c = provider.charm.lb_consumers
+
+    for name in ("a3", "a1", "a2"):
+        con_a.charm.request_lb(name)
+    con_b.charm.request_lb("b1")
+    sim.flush()
+    # The second consumer's request isn't held up behind all of the first's.
+    assert provider.charm.processed == ["a1", "a2", "b1", "a3"]
+    assert lb_c.new_requests == []
+
+    for name in ("a4", "a5", "a6"):
+        con_a.charm.request_lb(name)
+    sim.transmit(con_a, provider)
+    assert provider.charm.processed[4:] == ["a4", "a5"]
+    assert [request.name for request in lb_c.new_requests] == ["a6"]
+    # The rest are handled when the deferred event is re-run on the next hook.
+    provider.harness.framework.reemit()
+    assert provider.charm.processed[6:] == ["a6"]
+    assert lb_c.new_requests == []
+    sim.flush()
+    assert con_a.charm.failed_lbs == {"a1", "a2", "a3", "a4", "a5", "a6"}
+
+    # At least one request is always processed, even with no time to spare.
+    for name in ("a7", "a8"):
+        con_a.charm.request_lb(name)
+    provider.charm.budget = {"max_seconds": 0}
+    sim.transmit(con_a, provider)
+    assert provider.charm.processed[7:] == ["a7"]
+
+
+class QuotaProviderCharm(ProviderCharm):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.lb_consumers.set_quotas(
+            max_requests=3, max_request_size=1000, max_backends=2
+        )
+
+
+def test_quotas(lb_relation_sim):
+    sim = lb_relation_sim
+    provider = sim.add_app(QuotaProviderCharm, ProviderCharm._meta)
+    consumer = sim.add_app(ConsumerCharm, ConsumerCharm._meta)
+    relation = sim.relate(consumer, "lb-provider", provider, "lb-consumers")
+    sim.flush()
+    lb_p = consumer.charm.lb_provider
+    lb_c = provider.charm.lb_consumers
+    sent = relation.data(provider, provider.name)
+
+    consumer.charm.request_lb("foo")
+    request = lb_p.get_request("big")
+    request.protocol = request.protocols.http
+    request.port_mapping = {80: 80}
+    request.ingress_address = "x" * 1000
+    lb_p.send_request(request)
+    consumer.charm.request_lb("many", backends=["10.1.1.1", "10.1.1.2", "10.1.1.3"])
+    with mock.patch("json.loads", wraps=json.loads) as loads:
+        sim.transmit(consumer, provider)
+    # Oversized requests aren't even parsed.
+    assert loads.call_count
+    assert not any(len(call.args[0]) > 1000 for call in loads.call_args_list)
+    sim.flush()
+    assert [request.name for request in lb_c.all_requests] == ["foo"]
+    assert provider.charm.changes == {"foo": 1}
+    assert consumer.charm.active_lbs == {"foo"}
+    assert consumer.charm.failed_lbs == {"big", "many"}
+    big, many = lb_p.get_response("big"), lb_p.get_response("many")
+    assert big.error_message.startswith("Request too large")
+    assert many.error_fields == {"backends": "Too many backends (3 > 2)"}
+
+    # Requests which have been responded to are kept over new ones.
+    consumer.charm.request_lb("bar")
+    sim.flush()
+    assert lb_p.get_response("bar").error_message == "Too many requests (limit 3)"
+    assert provider.charm.changes == {"foo": 1}
+    # The error responses are removed with the requests, making room for others.
+    lb_p.remove_request("big")
+    sim.flush()
+    assert "response_big" not in sent
+    assert provider.charm.changes == {"foo": 1, "bar": 1}
+    assert lb_p.get_response("bar").error_message == "No reason"
+    consumer.charm.request_lb("many", backends=["10.1.1.1"])
+    sim.flush()
+    assert provider.charm.changes == {"foo": 1, "bar": 1, "many": 1}
+    assert lb_c.state.rejected_requests == {}
+
+    # The size is in bytes, even with non-ASCII data from other implementations.
+    lb_p.remove_request("bar")
+    data = json.loads(relation.data(consumer, consumer.name)["request_foo"])
+    data.update(name="wide", id="wide", ingress_address="\u00e9" * 400)
+    sdata = json.dumps(data, ensure_ascii=False)
+    assert len(sdata) <= 1000 < len(sdata.encode("utf8"))
+    relation.get(consumer).data[consumer.charm.app]["request_wide"] = sdata
+    sim.flush()
+    assert "wide" not in provider.charm.changes
+    error_message = lb_p.get_response("wide").error_message
+    assert error_message.startswith("Request too large")
+
+
+class ParallelProviderCharm(ProviderCharm):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.lb_consumers.set_parallel_parsing(threshold=3, workers=2)
+
+
+def test_parallel_parsing(lb_relation_sim, caplog):
+    sim = lb_relation_sim
+    provider = sim.add_app(ParallelProviderCharm, ProviderCharm._meta)
+    consumer = sim.add_app(ConsumerCharm, ConsumerCharm._meta)
+    relation = sim.relate(consumer, "lb-provider", provider, "lb-consumers")
+    sim.flush()
+    lb_c = provider.charm.lb_consumers
+
+    consumer.charm.request_lb("foo")
+    consumer.charm.request_lb("bar", backends=["10.1.1.1"])
+    sim.flush()
+    for name in ("baz", "qux", "quux"):
+        consumer.charm.request_lb(name)
+    sent = relation.data(consumer, consumer.name)
+    sent["request_bad"] = json.dumps({"id": "bad", "name": "bad"})
+    pool = mock.patch(
+        "loadbalancer_interface.provides.ProcessPoolExecutor",
+        wraps=provides.ProcessPoolExecutor,
+    )
+    caplog.clear()
+    with pool as pool_cls:
+        sim.transmit(consumer, provider)
+    # Only the new requests needed parsing, which was enough to use the pool.
+    assert pool_cls.call_count == 1
+    parallel = lb_c.all_requests
+    parallel_logs = [(r.levelname, r.getMessage()) for r in caplog.records]
+    assert parallel_logs == [("ERROR", "Failed to load request request_bad")]
+    assert provider.charm.changes == {"foo": 1, "bar": 1, "baz": 1, "qux": 1, "quux": 1}
+
+    lb_c.parallel_threshold = None
+    lb_c._cache.invalidate()
+    caplog.clear()
+    serial = lb_c.all_requests
+    assert [(r.levelname, r.getMessage()) for r in caplog.records] == parallel_logs
+    assert [(r.name, r.id, r.hash) for r in parallel] == [
+        (r.name, r.id, r.hash) for r in serial
+    ]
+    assert [r.backends for r in parallel] == [r.backends for r in serial]
+    assert [r.response.dump() for r in parallel] == [r.response.dump() for r in serial]
+
+    # Below the threshold, requests are parsed serially.
+    lb_c.parallel_threshold = 10
+    lb_c._cache.invalidate()
+    with pool as pool_cls:
+        assert len(lb_c.all_requests) == 5
+    assert not pool_cls.called
+
+
+class CachingProviderCharm(ProviderCharm):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.lb_consumers.set_response_cache(ttl=600, max_entries=2)
+        self.reused = {}
+
+    def _respond(self, request):
+        reused_id = self.lb_consumers.reuse_response(request)
+        if reused_id:
+            self.reused[request.name] = reused_id
+        else:
+            super()._respond(request)
+
+
+def test_response_cache(lb_relation_sim):
+    sim = lb_relation_sim
+    provider = sim.add_app(CachingProviderCharm, ProviderCharm._meta)
+    consumer = sim.add_app(ConsumerCharm, ConsumerCharm._meta)
+    sim.relate(consumer, "lb-provider", provider, "lb-consumers")
+    sim.flush()
+    lb_p = consumer.charm.lb_provider
+    lb_c = provider.charm.lb_consumers
+
+    consumer.charm.request_lb("foo")
+    consumer.charm.request_lb("bar")
+    sim.flush()
+    foo_id = lb_p.get_request("foo").id
+    # Only successful responses are cached.
+    assert len(lb_c.state.response_cache) == 1
+
+    for name in ("foo", "bar"):
+        lb_p.remove_request(name)
+    sim.flush()
+    consumer.charm.request_lb("foo")
+    consumer.charm.request_lb("bar")
+    sim.flush()
+    assert lb_p.get_request("foo").id != foo_id
+    assert provider.charm.reused == {"foo": foo_id}
+    assert provider.charm.changes == {"foo": 1, "bar": 2}
+    assert consumer.charm.active_lbs == {"foo"}
+    assert lb_p.get_response("foo").address == "lb-foo"
+    # Reusing the response doesn't change which request it was made for.
+    assert [e["request_id"] for e in lb_c.state.response_cache.values()] == [foo_id]
+
+    lb_p.remove_request("foo")
+    sim.flush()
+    consumer.charm.request_lb("foo")
+    sim.flush()
+    assert provider.charm.reused == {"foo": foo_id}
+    assert provider.charm.changes == {"foo": 1, "bar": 2}
+
+    # Requests with different content aren't equivalent.
+    consumer.charm.request_lb("foo", backends=["10.1.1.1"])
+    sim.flush()
+    assert provider.charm.changes["foo"] == 2
+    assert len(lb_c.state.response_cache) == 2
+
+    # Entries expire after the TTL.
+    lb_p.remove_request("foo")
+    sim.flush()
+    later = time.time() + 601
+    with mock.patch("loadbalancer_interface.provides.time", return_value=later):
+        consumer.charm.request_lb("foo", backends=["10.1.1.1"])
+        sim.flush()
+    assert provider.charm.changes["foo"] == 3
+    assert list(provider.charm.reused) == ["foo"]
+    assert len(lb_c.state.response_cache) == 1
+
+
+class DebouncedProviderCharm(ProviderCharm):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.lb_consumers.set_backend_debounce(60)
+
+
+def test_backend_debounce(lb_relation_sim):
+    sim = lb_relation_sim
+    provider = sim.add_app(DebouncedProviderCharm, ProviderCharm._meta)
+    consumer = sim.add_app(ConsumerCharm, ConsumerCharm._meta, units=3)
+    sim.relate(consumer, "lb-provider", provider, "lb-consumers")
+    sim.flush()
+    lb_c = provider.charm.lb_consumers
+
+    def backends():
+        (request,) = lb_c.all_requests
+        return request.backends
+
+    consumer.charm.request_lb("foo")
+    sim.flush()
+    initial = backends()
+    assert len(initial) == 3
+    assert provider.charm.changes == {"foo": 1}
+
+    # A unit restarting within the window doesn't change anything.
+    unit = consumer.units[1]
+    address = consumer.unit_data[unit]["ingress-address"]
+    sim.remove_unit(consumer, unit)
+    assert lb_c.backends_pending
+    sim.add_unit(consumer, address)
+    sim.flush()
+    assert not lb_c.backends_pending
+    assert backends() == initial
+
+    # Changes within the window are applied together once it has passed.
+    start = time.time()
+    with mock.patch("loadbalancer_interface.provides.time", return_value=start):
+        sim.remove_unit(consumer, consumer.units[1])
+    with mock.patch("loadbalancer_interface.provides.time", return_value=start + 30):
+        sim.add_unit(consumer)
+        sim.add_unit(consumer)
+        sim.flush()
+        provider.charm.on.update_status.emit()
+    assert backends() == initial
+    assert provider.charm.changes == {"foo": 1}
+    assert lb_c.backends_pending
+    with mock.patch("loadbalancer_interface.provides.time", return_value=start + 61):
+        provider.charm.on.update_status.emit()
+    assert len(backends()) == 4
+    assert provider.charm.changes == {"foo": 2}
+    assert not lb_c.backends_pending
+
+
+def test_simulator(lb_relation_sim):
+    sim = lb_relation_sim
+    consumer = sim.add_app(MultiConsumerCharm, ConsumerCharm._meta, units=3)
+    providers = [
+        sim.add_app(ProviderCharm, ProviderCharm._meta, name=name, units=2)
+        for name in ("provider-a", "provider-b")
+    ]
+    for provider in providers:
+        sim.relate(consumer, "lb-provider", provider, "lb-consumers")
+    sim.flush()
+    c_charm = consumer.charm
+    assert len(c_charm.lb_provider.relations) == 2
+
+    names = ["foo"] + ["svc{}".format(i) for i in range(49)]
+    for name in names:
+        c_charm.request_lb(name)
+    sim.flush()
+    assert c_charm.active_lbs == {"foo"}
+    assert sorted(c_charm.failed_lbs) == sorted(names[1:])
+    p_changes = [provider.charm.changes for provider in providers]
+    assert sorted(name for changes in p_changes for name in changes) == sorted(names)
+
+    # Departing units change the default backends of every request.
+    sim.remove_unit(consumer, consumer.units[-1])
+    sim.flush()
+    for provider in providers:
+        for request in provider.charm.lb_consumers.all_requests:
+            assert request.backends == ["10.0.0.1", "10.0.0.2"]
+        assert set(provider.charm.changes.values()) == {2}
+    assert c_charm.changes == {name: 1 for name in names}
+
+    # Leadership changes don't cause the requests to be resent.
+    sim.set_leader(consumer, False)
+    assert sim.flush() == 1
+    sim.set_leader(consumer)
+    c_charm.request_lb("foo")
+    assert sim.flush() == 1
+
+    # Breaking the relation removes the responses.
+    single = sim.add_app(ConsumerCharm, ConsumerCharm._meta, name="single")
+    relation = sim.relate(single, "lb-provider", providers[0], "lb-consumers")
+    sim.flush()
+    single.charm.request_lb("foo")
+    sim.flush()
+    assert single.charm.active_lbs == {"foo"}
+    sim.unrelate(relation)
+    assert not single.charm.lb_provider.is_available
+    assert not single.charm.lb_provider.complete_responses
+
+
+class PortsSim:
+    """A provider related to two consumers, "consumer-a" and "consumer-b", for
+    checking how the front-end ports of their requests are allocated.
+
+    With `peers`, the provider also has a peer relation, whose ID is `peer_rid`.
+    """
+
+    def __init__(self, sim, peers=False):
+        self.sim = sim
+        charm = PeerProviderCharm if peers else ProviderCharm
+        self.provider = sim.add_app(charm, charm._meta)
+        self.con_a, self.con_b = [
+            sim.add_app(ConsumerCharm, ConsumerCharm._meta, name=name)
+            for name in ("consumer-a", "consumer-b")
+        ]
+        for consumer in (self.con_a, self.con_b):
+            sim.relate(consumer, "lb-provider", self.provider, "lb-consumers")
+        self.peer_rid = None
+        if peers:
+            harness = self.provider.harness
+            self.peer_rid = harness.add_relation("lb-peers", self.provider.name)
+        sim.flush()
+
+    @property
+    def lb_c(self):
+        return self.provider.charm.lb_consumers
+
+    def set_leader(self, is_leader=True):
+        self.sim.set_leader(self.provider, is_leader)
+
+    def request_lb(self, consumer, name, ports=(), ranges=(), protocol="tcp", **fields):
+        """Send a request for the given ports and `(start, end)` ranges of ports,
+        and get the request as received by the provider.
+        """
+        lb_provider = consumer.charm.lb_provider
+        request = lb_provider.get_request(name)
+        request.protocol = request.protocols[protocol]
+        request.port_mapping = {port: port for port in ports}
+        request.port_ranges = []
+        for start, end in ranges:
+            request.add_port_range(start, end)
+        for field, value in fields.items():
+            setattr(request, field, value)
+        lb_provider.send_request(request)
+        self.sim.flush()
+        return next(req for req in self.lb_c.all_requests if req.id == request.id)
+
+    def remove_request(self, consumer, name):
+        consumer.charm.lb_provider.remove_request(name)
+        self.sim.flush()
+
+    def groups(self):
+        """The names of the requests in each listener group."""
+        return [
+            sorted(req.name for req in group.requests)
+            for group in self.lb_c.listener_groups
+        ]
+
+
+@pytest.fixture
+def ports_sim(lb_relation_sim):
+    return PortsSim(lb_relation_sim)
+
+
+def test_listener_groups(ports_sim):
+    con_a, con_b, lb_c = ports_sim.con_a, ports_sim.con_b, ports_sim.lb_c
+    groups, request_lb = ports_sim.groups, ports_sim.request_lb
+
+    request_lb(con_a, "web", [80, 443])
+    request_lb(con_b, "api", [8080])
+    request_lb(con_b, "db", [5432], public=False)
+    request_lb(con_a, "web2", [80])
+    assert groups() == [["api", "web"], ["db"], ["web2"]]
+    group_ids = [g.id for g in lb_c.listener_groups]
+
+    # Groups are stable as requests come and go.
+    request_lb(con_b, "api", [8080, 8443])
+    ports_sim.remove_request(con_a, "web")
+    assert groups() == [["api"], ["db"], ["web2"]]
+    request_lb(con_a, "web3", [443])
+    assert groups() == [["api", "web3"], ["db"], ["web2"]]
+    lb_groups = lb_c.listener_groups
+    assert [g.id for g in lb_groups] == group_ids
+    assert lb_groups[1].settings["public"] is False
+
+    # Changed requests which no longer fit are moved.
+    request_lb(con_b, "api", [8080, 443])
+    assert groups() == [["web3"], ["db"], ["api", "web2"]]
+    assert lb_c.listener_groups[2].listeners == {
+        (80, "tcp"),
+        (443, "tcp"),
+        (8080, "tcp"),
+    }
+    ports_sim.remove_request(con_b, "db")
+    assert groups() == [["web3"], ["api", "web2"]]
+    assert lb_c.state.listener_groups.keys() == {
+        con_a.charm.lb_provider.get_request("web2").id,
+        con_a.charm.lb_provider.get_request("web3").id,
+        con_b.charm.lb_provider.get_request("api").id,
+    }
+
+
+def test_listener_groups_failover(lb_relation_sim):
+    ports_sim = PortsSim(lb_relation_sim, peers=True)
+    con_a, lb_c = ports_sim.con_a, ports_sim.lb_c
+
+    ports_sim.request_lb(con_a, "web", [80])
+    ports_sim.request_lb(con_a, "db", [80], public=False)
+    assert [g.id for g in lb_c.listener_groups] == [0, 1]
+    ports_sim.remove_request(con_a, "web")
+    assert [g.id for g in lb_c.listener_groups] == [1]
+
+    # Followers and new leaders get the same IDs, without the old StoredState,
+    # and only the leader records them.
+    lb_c.state.listener_groups = {}
+    lb_c.state.next_listener_group = 0
+    ports_sim.set_leader(False)
+    lb_c.follower_perms(read=True)
+    assert [g.id for g in lb_c.listener_groups] == [1]
+    ports_sim.set_leader()
+    assert [g.id for g in lb_c.listener_groups] == [1]
+    ports_sim.request_lb(con_a, "web", [443], public=False)
+    assert [g.id for g in lb_c.listener_groups] == [1]
+    ports_sim.request_lb(con_a, "web", [443], public=True)
+    assert [g.id for g in lb_c.listener_groups] == [1, 2]
+    assert lb_c.state.listener_groups == {}
+    assert lb_c.state.next_listener_group == 0
+
+
+def test_port_index(ports_sim):
+    con_a, con_b, lb_c = ports_sim.con_a, ports_sim.con_b, ports_sim.lb_c
+    request_lb = ports_sim.request_lb
+
+    web = request_lb(con_a, "web", [80, 443], protocol="https")
+    assert lb_c.port_owner(80) is web
+    assert lb_c.port_owner(443, web.protocols.http) is web
+    assert lb_c.port_owner(80, "udp") is None
+    dns = request_lb(con_b, "dns", [53, 80], protocol="udp")
+    assert lb_c.port_owner(80, "udp") is dns
+    assert not lb_c.check_port_conflicts(dns)
+
+    api = request_lb(con_b, "api", [8080, 443])
+    assert lb_c.port_conflicts(api) == {(443, "tcp"): web}
+    assert lb_c.port_owner(8080) is None
+    assert lb_c.check_port_conflicts(api)
+    assert api.response.error == api.response.error_types.unsupported
+    assert api.response.error_fields == {
+        "port_mapping": "443/tcp in use by consumer-a:web"
+    }
+    lb_c.send_response(api)
+
+    # Ownership is kept, and freed ports can be taken by conflicting requests.
+    web = request_lb(con_a, "web", [80, 443, 8080], protocol="https")
+    assert lb_c.port_owner(8080) is web
+    ports_sim.remove_request(con_a, "web")
+    (api,) = [req for req in lb_c.all_requests if req.name == "api"]
+    assert not lb_c.port_conflicts(api)
+    assert lb_c.port_owner(443) is api
+    assert lb_c.state.port_owners == {
+        "53/udp": dns.id,
+        "80/udp": dns.id,
+        "443/tcp": api.id,
+        "8080/tcp": api.id,
+    }
+
+    # Followers don't record any claims of their own.
+    claims = dict(lb_c.state.port_owners)
+    lb_c.state.port_owners = {}
+    ports_sim.set_leader(False)
+    lb_c.follower_perms(read=True)
+    lb_c._cache.invalidate()
+    assert lb_c.port_owner(443).id == api.id
+    assert lb_c.state.port_owners == {}
+    lb_c.follower_perms(read=False)
+    ports_sim.set_leader()
+    lb_c._cache.invalidate()
+    assert lb_c.port_owner(443).id == api.id
+    assert lb_c.state.port_owners == claims
+
+
+def test_port_ranges(ports_sim):
+    con_a, con_b, lb_c = ports_sim.con_a, ports_sim.con_b, ports_sim.lb_c
+    request_lb = partial(ports_sim.request_lb, protocol="udp")
+
+    rtp = request_lb(con_a, "rtp", [5060], [(10000, 19999)])
+    assert lb_c.port_owner(15000, "udp") is rtp
+    assert lb_c.port_owner(20000, "udp") is None
+    assert lb_c.port_owner(15000) is None
+    assert lb_c.state.port_owners == {
+        "5060/udp": rtp.id,
+        "10000-19999/udp": rtp.id,
+    }
+
+    media = request_lb(con_b, "media", [5060], [(19000, 20999)])
+    assert lb_c.port_conflicts(media) == {
+        (5060, "udp"): rtp,
+        (range(19000, 20000), "udp"): rtp,
+    }
+    assert lb_c.port_owner(20500, "udp") is None
+    assert lb_c.check_port_conflicts(media)
+    assert media.response.error_fields == {
+        "port_mapping": "5060/udp in use by consumer-a:rtp",
+        "port_ranges": "19000-19999/udp in use by consumer-a:rtp",
+    }
+    # The same ports over TCP don't conflict, and can share a load balancer.
+    web = request_lb(con_b, "web", [], [(19000, 20999)], protocol="tcp")
+    assert not lb_c.port_conflicts(web)
+    groups = {group.id: group for group in lb_c.listener_groups}
+    assignments = lb_c.state.listener_groups
+    assert assignments[web.id] == assignments[rtp.id] != assignments[media.id]
+    assert groups[assignments[rtp.id]].port_ranges == [
+        (19000, 20999, "tcp"),
+        (5060, 5060, "udp"),
+        (10000, 19999, "udp"),
+    ]
+
+    # Shrinking the range frees the ports for the conflicting request.
+    rtp = request_lb(con_a, "rtp", [], [(10000, 18999)])
+    (media,) = [req for req in lb_c.all_requests if req.name == "media"]
+    assert not lb_c.port_conflicts(media)
+    assert lb_c.state.port_owners == {
+        "10000-18999/udp": rtp.id,
+        "5060/udp": media.id,
+        "19000-20999/udp": media.id,
+        "19000-20999/tcp": web.id,
+    }
+
+
+def test_port_claims_failover(lb_relation_sim):
+    ports_sim = PortsSim(lb_relation_sim, peers=True)
+    con_a, con_b, lb_c = ports_sim.con_a, ports_sim.con_b, ports_sim.lb_c
+    provider, peer_rid = ports_sim.provider, ports_sim.peer_rid
+
+    # The ports are claimed as the requests arrive, without the charm asking.
+    web_id = ports_sim.request_lb(con_b, "web", [443]).id
+    ports_sim.request_lb(con_a, "api", [443, 8080])
+    peer_data = provider.harness.get_relation_data(peer_rid, provider.name)
+    assert json.loads(peer_data["port_owners_lb-consumers"]) == {"443/tcp": web_id}
+
+    # A new leader doesn't have the old leader's StoredState, but still knows
+    # which request got there first.
+    lb_c.state.port_owners = {}
+    ports_sim.set_leader(False)
+    lb_c.follower_perms(read=True)
+    assert lb_c.port_owner(443).id == web_id
+    ports_sim.set_leader()
+    assert lb_c.port_owner(443).id == web_id
+    (api,) = [req for req in lb_c.all_requests if req.name == "api"]
+    assert lb_c.port_conflicts(api)
+    assert lb_c.state.port_owners == {}
+
+
+def test_tls_material(lb_relation_sim):
+    sim = lb_relation_sim
+    provider = sim.add_app(ProviderCharm, ProviderCharm._meta)
+    consumer = sim.add_app(ConsumerCharm, ConsumerCharm._meta)
+    relation = sim.relate(consumer, "lb-provider", provider, "lb-consumers")
+    sim.flush()
+    lb_p = consumer.charm.lb_provider
+    lb_c = provider.charm.lb_consumers
+    cert, key = "-----CERT-----" * 100, "-----KEY-----" * 100
+
+    for name in ("foo", "bar"):
+        request = lb_p.get_request(name)
+        request.protocol = request.protocols.https
+        request.port_mapping = {443: 443}
+        request.tls_termination = True
+        request.tls_cert = cert
+        request.tls_key = key
+        lb_p.send_request(request)
+    sent = relation.data(consumer, consumer.name)
+    tls_keys = {name for name in sent if name.startswith("tls_")}
+    assert tls_keys == {"tls_" + content_hash(cert), "tls_" + content_hash(key)}
+    assert all(cert not in sent[name] for name in ("request_foo", "request_bar"))
+    assert lb_p.get_request("foo").tls_cert == cert
+
+    sim.flush()
+    foo, bar = sorted(lb_c.all_requests, key=attrgetter("name"), reverse=True)
+    assert (foo.tls_cert, foo.tls_key) == (cert, key)
+    # Each distinct piece of material is only read once.
+    assert foo.tls_cert is bar.tls_cert
+    assert len(lb_c._tls_material) == 2
+    assert consumer.charm.active_lbs == {"foo"}
+
+    # Material is removed once no request refers to it any more.
+    request = lb_p.get_request("foo")
+    request.tls_cert = cert + "new"
+    lb_p.send_request(request)
+    assert "tls_" + content_hash(cert) in sent
+    lb_p.remove_request("bar")
+    assert {name for name in sent if name.startswith("tls_")} == {
+        "tls_" + content_hash(cert + "new"),
+        "tls_" + content_hash(key),
+    }
+    lb_p.remove_request("foo")
+    assert not any(name.startswith("tls_") for name in sent)
+
+    # Requests referring to missing material are rejected.
+    request = lb_p.get_request("foo")
+    request.protocol = request.protocols.https
+    request.port_mapping = {443: 443}
+    request.tls_cert = cert
+    lb_p.send_request(request)
+    del sent["tls_" + content_hash(cert)]
+    lb_c._tls_material.clear()
+    sim.flush()
+    assert lb_c.all_requests == []
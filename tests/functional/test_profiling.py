@@ -0,0 +1,96 @@
+import pstats
+
+import pytest
+
+from loadbalancer_interface import LBConsumers, LBProvider, profiling
+from loadbalancer_interface.soak import SoakConsumerCharm, SoakProviderCharm
+
+
+def setup_apps(sim):
+    consumer = sim.add_app(SoakConsumerCharm, SoakConsumerCharm._meta)
+    provider = sim.add_app(SoakProviderCharm, SoakProviderCharm._meta)
+    sim.relate(consumer, "lb-provider", provider, "lb-consumers")
+    return consumer, provider
+
+
+def request_lb(consumer, name):
+    lb_provider = consumer.charm.lb_provider
+    request = lb_provider.get_request(name)
+    request.protocol = request.protocols.http
+    request.port_mapping = {80: 80}
+    lb_provider.send_request(request)
+
+
+def test_profiling_disabled(lb_relation_sim, monkeypatch):
+    monkeypatch.delenv(profiling.ENV_VAR, raising=False)
+    consumer, provider = setup_apps(lb_relation_sim)
+    assert type(consumer.charm.lb_provider) is LBProvider
+    assert type(provider.charm.lb_consumers) is LBConsumers
+    assert not hasattr(consumer.charm.lb_provider, "_profiler")
+
+
+class ConfigCharm:
+    def __init__(self, value):
+        self.value = value
+        self.reads = 0
+
+    @property
+    def config(self):
+        self.reads += 1
+        return {profiling.CONFIG_OPTION: self.value}
+
+
+@pytest.mark.parametrize(
+    "flag, value, enabled, reads",
+    [
+        (None, True, False, 0),
+        ("false", True, False, 0),
+        ("true", False, True, 0),
+        ("config", False, False, 1),
+        ("config", "true", True, 1),
+    ],
+)
+def test_profiling_flag(monkeypatch, flag, value, enabled, reads):
+    if flag is None:
+        monkeypatch.delenv(profiling.ENV_VAR, raising=False)
+    else:
+        monkeypatch.setenv(profiling.ENV_VAR, flag)
+    charm = ConfigCharm(value)
+    assert profiling.is_enabled(charm) is enabled
+    # The config is only read when the environment leaves it up to the config.
+    assert charm.reads == reads
+
+
+def test_profiling(lb_relation_sim, monkeypatch, tmp_path):
+    monkeypatch.setenv(profiling.ENV_VAR, "true")
+    monkeypatch.setenv(profiling.DIR_ENV_VAR, str(tmp_path))
+    monkeypatch.setenv(profiling.KEEP_ENV_VAR, "2")
+    sim = lb_relation_sim
+    consumer, provider = setup_apps(sim)
+    lb_consumers = provider.charm.lb_consumers
+    assert isinstance(lb_consumers, LBConsumers)
+    assert type(lb_consumers) is not LBConsumers
+    # Both interfaces in a charm share the one profiler.
+    assert lb_consumers._profiler is profiling.HookProfiler.get(provider.charm)
+
+    sim.flush()
+    request_lb(consumer, "foo")
+    sim.flush()
+    assert consumer.charm.lb_provider.get_response("foo").address == "lb-foo"
+
+    provider.harness.framework.commit()
+    (path,) = tmp_path.glob("*.prof")
+    functions = {func[2] for func in pstats.Stats(str(path)).stats}
+    assert "send_response" in functions
+    assert "_load_request" in functions
+
+    # Nothing is written for hooks which didn't use the interface.
+    provider.harness.framework.commit()
+    assert len(list(tmp_path.glob("*.prof"))) == 1
+
+    for name in ("bar", "qux"):
+        request_lb(consumer, name)
+        sim.flush()
+        consumer.harness.framework.commit()
+        provider.harness.framework.commit()
+    assert len(list(tmp_path.glob("*.prof"))) == 2
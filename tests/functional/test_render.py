@@ -0,0 +1,73 @@
+from loadbalancer_interface.render import ConfigRenderer
+from loadbalancer_interface.soak import SoakConsumerCharm, SoakProviderCharm
+
+
+def request_lb(consumer, name, port):
+    lb_provider = consumer.charm.lb_provider
+    request = lb_provider.get_request(name)
+    request.protocol = request.protocols.http
+    request.port_mapping = {port: 8080}
+    lb_provider.send_request(request)
+
+
+def test_config_renderer(lb_relation_sim):
+    sim = lb_relation_sim
+    consumer = sim.add_app(SoakConsumerCharm, SoakConsumerCharm._meta)
+    provider = sim.add_app(SoakProviderCharm, SoakProviderCharm._meta)
+    sim.relate(consumer, "lb-provider", provider, "lb-consumers")
+    sim.flush()
+    lb_c = provider.charm.lb_consumers
+    calls = []
+
+    def render_request(request):
+        calls.append(request.name)
+        if request.name == "skip":
+            return None
+        (port,) = request.port_mapping
+        return "listen {} :{}".format(request.name, port)
+
+    renderer = ConfigRenderer(provider.charm, "config", render_request)
+    result = renderer.render(lb_c.all_requests)
+    assert result == ("", True, [], [])
+    assert not renderer.render(lb_c.all_requests).reload_needed
+
+    for name, port in (("web", 80), ("api", 81), ("skip", 82)):
+        request_lb(consumer, name, port)
+    sim.flush()
+    result = renderer.render(lb_c.all_requests)
+    assert result.config == "listen api :81\nlisten web :80"
+    assert result.reload_needed
+    assert sorted(request.name for request in result.rendered) == sorted(calls)
+    assert sorted(calls) == ["api", "skip", "web"]
+
+    # Only changed requests are re-rendered.
+    calls.clear()
+    request_lb(consumer, "web", 8000)
+    sim.flush()
+    result = renderer.render(lb_c.all_requests)
+    assert calls == ["web"]
+    assert result.config == "listen api :81\nlisten web :8000"
+    assert result.reload_needed
+    calls.clear()
+    assert not renderer.render(lb_c.all_requests).reload_needed
+    assert calls == []
+
+    # Re-rendering with the same output doesn't need a reload.
+    api = next(request for request in lb_c.all_requests if request.name == "api")
+    consumer.charm.lb_provider.remove_request("skip")
+    sim.flush()
+    result = renderer.render(lb_c.all_requests)
+    assert result.removed and not result.reload_needed
+    assert set(renderer.state.fragments.keys()) == {
+        request.id for request in lb_c.all_requests
+    }
+
+    # A new version re-renders everything, and other outputs can be assembled.
+    renderer.version = 2
+    renderer.assemble = sorted
+    calls.clear()
+    result = renderer.render(lb_c.all_requests)
+    assert sorted(calls) == ["api", "web"]
+    assert result.config == ["listen api :81", "listen web :8000"]
+    assert result.reload_needed
+    assert api.id in renderer.state.fragments
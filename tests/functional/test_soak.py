@@ -0,0 +1,76 @@
+import pytest
+
+from loadbalancer_interface.soak import (
+    OPERATIONS,
+    SoakRunner,
+    format_report,
+    generate_trace,
+)
+
+
+def test_soak():
+    trace = generate_trace(300, seed=1)
+    assert trace == generate_trace(300, seed=1)
+    assert {op for op, _ in trace} == set(OPERATIONS)
+
+    runner = SoakRunner(sample_every=50)
+    try:
+        report = runner.run(trace)
+        steps = [sample["step"] for sample in report["samples"]]
+        # Once both sides are leaders again and everything has settled, the
+        # stored state should only reflect the current requests.
+        for app in (runner.consumer, runner.provider):
+            runner.sim.set_leader(app)
+        runner.sim.flush()
+        runner.sample(len(trace))
+    finally:
+        runner.cleanup()
+
+    assert set(report["latency"]) == set(OPERATIONS)
+    for stats in report["latency"].values():
+        assert stats["p50"] <= stats["p95"] <= stats["p99"]
+    assert steps == list(range(50, 301, 50))
+    final = runner.samples[-1]
+    assert final["requests"] > 0
+    assert final["known_requests"] == final["requests"]
+    assert final["response_hashes"] == final["requests"]
+    assert "request_add" in format_report(report)
+
+
+def test_provider_restart():
+    runner = SoakRunner()
+    try:
+        runner._request_add("foo")
+        runner.sim.flush()
+        before = runner.provider.charm
+        known = dict(before.lb_consumers.state.known_requests)
+        runner.sim.restart(runner.provider)
+        # Only the StoredState survives, in a brand new charm.
+        after = runner.provider.charm
+        assert after is not before
+        assert after.lb_consumers._cache is not before.lb_consumers._cache
+        assert dict(after.lb_consumers.state.known_requests) == known
+        runner._provider_restart(None)
+        runner.sim.flush()
+        runner._request_add("bar")
+        runner.sim.flush()
+        after = runner.provider.charm
+        assert len(after.lb_consumers.state.known_requests) == 2
+        assert runner.consumer.charm.lb_provider.get_response("bar").address
+    finally:
+        runner.cleanup()
+
+
+def test_restart_unsupported():
+    runner = SoakRunner()
+    try:
+        # A Harness which isn't put together the way restarting expects fails
+        # clearly, rather than leaving the charm half restarted.
+        harness = runner.provider.harness
+        storage = harness._storage
+        del harness._storage
+        with pytest.raises(NotImplementedError):
+            runner.sim.restart(runner.provider)
+        harness._storage = storage
+    finally:
+        runner.cleanup()
@@ -0,0 +1,52 @@
+from unittest.mock import Mock
+
+from loadbalancer_interface.base import ViewCache
+
+
+def test_view_cache():
+    rel1, rel2 = Mock(id=1), Mock(id=2)
+    cache = ViewCache()
+    builds = []
+
+    def build(value):
+        def _build():
+            builds.append(value)
+            return value
+
+        return _build
+
+    # Repeated reads are served from the cache.
+    assert cache.view("all", [rel1, rel2], build("a")) == "a"
+    assert cache.view("all", [rel1, rel2], build("b")) == "a"
+    assert cache.entry(rel1, "foo", build("foo")) == "foo"
+    assert cache.entry(rel1, "foo", build("foo2")) == "foo"
+    assert cache.entry(rel1, "bar", build("bar")) == "bar"
+    assert builds == ["a", "foo", "bar"]
+
+    # Extra key values are part of the key.
+    assert cache.view("all", [rel1, rel2], build("c"), True) == "c"
+    assert cache.entry(rel1, "foo", build("foo3"), True) == "foo3"
+
+    assert cache.has_entry(rel1, "foo", True)
+    assert not cache.has_entry(rel2, "foo", True)
+
+    # A write drops only the entry written, but rebuilds views.
+    cache.invalidate(rel1, "foo")
+    assert not cache.has_entry(rel1, "foo", True)
+    assert cache.view("all", [rel1, rel2], build("d"), True) == "d"
+    assert cache.entry(rel1, "foo", build("foo4")) == "foo4"
+    assert cache.entry(rel1, "bar", build("bar2")) == "bar"
+
+    # Views not built from the relation are unaffected.
+    assert cache.view("rel2", [rel2], build("e")) == "e"
+    cache.invalidate(rel1, "foo")
+    assert cache.view("rel2", [rel2], build("f")) == "e"
+
+    # A relation change drops all entries for that relation.
+    cache.invalidate(rel1)
+    assert cache.entry(rel1, "bar", build("bar3")) == "bar3"
+    assert cache.view("rel2", [rel2], build("g")) == "e"
+
+    # Invalidating everything drops everything.
+    cache.invalidate()
+    assert cache.view("rel2", [rel2], build("h")) == "h"
@@ -0,0 +1,213 @@
+import json
+import random
+from copy import deepcopy
+
+import pytest
+from marshmallow import ValidationError
+
+from loadbalancer_interface import schemas
+
+v1 = schemas.versions[1]
+v2 = schemas.versions[2]
+
+VALUES = [
+    None,
+    True,
+    False,
+    0,
+    1,
+    -1,
+    443,
+    2**70,
+    1.0,
+    443.5,
+    float("inf"),
+    float("nan"),
+    "",
+    "443",
+    " 80 ",
+    "abc",
+    "true",
+    "off",
+    "tcp",
+    "https",
+    "HTTPS",
+    "unsupported",
+    "provider error",
+    "provider_error",
+    "least-conn",
+    [],
+    [1],
+    ["a", "b"],
+    [None],
+    {},
+    {"a": 1},
+    {"80": 80},
+    {"80": "8080"},
+    {"x": "y"},
+]
+
+REQUEST = {
+    "id": "id",
+    "name": "name",
+    "protocol": "https",
+    "backends": ["10.0.0.1", "10.0.0.2"],
+    "port_mapping": {"443": 443, "80": 8080},
+    "algorithm": ["least-conn"],
+    "sticky": True,
+    "health_checks": [
+        {"protocol": "http", "port": 80, "path": "/", "interval": 5, "retries": 1},
+        {"protocol": "tcp", "port": 443},
+    ],
+    "public": False,
+    "tls_termination": True,
+    "tls_cert": "cert",
+    "tls_key": "key",
+    "ingress_address": "10.0.0.3",
+    "sent_hash": "hash",
+}
+
+REQUESTS = {
+    1: REQUEST,
+    2: dict(
+        REQUEST,
+        weights={"10.0.0.1": 2, "10.0.0.2": 0},
+        idle_timeout=60,
+        max_connections=1,
+        keepalive=True,
+        tls_cert_ref="0123",
+        port_ranges=[{"front_start": 1000, "front_end": 1999, "back_start": 2000}],
+        health_checks=[
+            dict(
+                REQUEST["health_checks"][0],
+                timeout=2,
+                healthy_threshold=2,
+                unhealthy_threshold=3,
+                expected_status=204,
+            ),
+            REQUEST["health_checks"][1],
+        ],
+    ),
+}
+
+RESPONSE = {
+    "error": "unsupported",
+    "error_message": "no",
+    "error_fields": {"public": "public only"},
+    "address": "lb",
+    "received_hash": "hash",
+}
+
+RESPONSES = {
+    1: RESPONSE,
+    2: dict(RESPONSE, backend_health={"10.0.0.1": "healthy", "10.0.0.2": "unknown"}),
+}
+
+
+def mutate(rng, data):
+    """Randomly drop, replace, or add values in a copy of the data."""
+    data = deepcopy(data)
+    for _ in range(rng.randint(1, 3)):
+        target = data
+        if isinstance(target.get("health_checks"), list) and rng.random() < 0.3:
+            if target["health_checks"] and isinstance(target["health_checks"][0], dict):
+                target = target["health_checks"][0]
+        choice = rng.random()
+        key = rng.choice(sorted(target.keys()) or ["foo"])
+        if choice < 0.2:
+            target.pop(key, None)
+        elif choice < 0.9:
+            target[key] = deepcopy(rng.choice(VALUES))
+        else:
+            target[rng.choice(["foo", "bar"])] = deepcopy(rng.choice(VALUES))
+    return data
+
+
+def as_values(obj):
+    """Get the field values of a loaded object, recursively."""
+    if isinstance(obj, list):
+        return [as_values(item) for item in obj]
+    if isinstance(obj, dict):
+        return {key: as_values(value) for key, value in obj.items()}
+    if hasattr(obj, "_schema"):
+        return {name: as_values(getattr(obj, name)) for name in obj._schema.fields}
+    if isinstance(obj, float) and obj != obj:
+        return "nan"
+    return obj
+
+
+def load(method, make, data):
+    try:
+        return "ok", as_values(getattr(make(), method)(deepcopy(data)))
+    except ValidationError as e:
+        return "error", e.messages
+
+
+def differential(make, template, seed, count):
+    rng = random.Random(seed)
+    results = set()
+    for _ in range(count):
+        data = mutate(rng, template)
+        expected = load("_update", make, data)
+        actual = load("_load", make, data)
+        assert actual == expected, data
+        results.add(expected[0])
+    return results
+
+
+@pytest.mark.parametrize("version", schemas.versions)
+@pytest.mark.parametrize("seed", range(5))
+def test_request_decoder(version, seed):
+    schema = schemas.versions[version]
+    results = differential(schema.Request, REQUESTS[version], seed, 500)
+    # Ensure that the fuzzing actually covers both outcomes.
+    assert results == {"ok", "error"}
+
+
+@pytest.mark.parametrize("version", schemas.versions)
+@pytest.mark.parametrize("seed", range(5))
+def test_response_decoder(version, seed):
+    schema = schemas.versions[version]
+    request = schema.Request()
+    request.name = "name"
+    make = lambda: schema.Response(request)  # noqa: E731
+    results = differential(make, RESPONSES[version], seed, 500)
+    assert results == {"ok", "error"}
+
+
+@pytest.mark.parametrize("version", schemas.versions)
+def test_health_check_decoder(version):
+    for template in REQUESTS[version]["health_checks"]:
+        differential(schemas.versions[version].HealthCheck, template, 0, 200)
+
+
+def test_decoder_errors():
+    with pytest.raises(ValidationError) as e:
+        v1.Request()._load(["foo"])
+    assert e.value.messages == {"_schema": ["Invalid input type."]}
+
+    data = dict(REQUEST, port_mapping={"none": "none"}, foo="bar")
+    with pytest.raises(ValidationError) as e:
+        v1.Request()._load(data)
+    assert e.value.messages == {
+        "port_mapping": {
+            "none": {"key": ["Not a valid integer."], "value": ["Not a valid integer."]}
+        },
+        "foo": ["Unknown field."],
+    }
+
+    with pytest.raises(ValidationError) as e:
+        v1.Request.loads(json.dumps(REQUEST), json.dumps({"error": "unsupported"}))
+    assert e.value.messages == {
+        "_schema": ["error_message or error_fields required on failure"]
+    }
+
+
+def test_decoder_loads():
+    request = v1.Request.loads(json.dumps(REQUEST), json.dumps(RESPONSE))
+    assert request.protocol == v1.Protocols.https
+    assert request.port_mapping == {443: 443, 80: 8080}
+    assert request.health_checks[0].protocol == v1.Protocols.http
+    assert request.health_checks[1].interval == 30
+    assert request.response.error == v1.ErrorTypes.unsupported
+    assert request.hash == v1.Request()._update(deepcopy(REQUEST)).hash
@@ -0,0 +1,269 @@
+import pytest
+from marshmallow import ValidationError
+
+from loadbalancer_interface import schemas
+
+v1 = schemas.versions[1]
+v2 = schemas.versions[2]
+Request = v2.Request
+Response = v2.Response
+
+
+def make_request():
+    req = Request()
+    req.name = "name"
+    req.id = "id"
+    req.protocol = req.protocols.https
+    req.port_mapping = {443: 443}
+    return req
+
+
+def test_request():
+    req = make_request()
+    assert req.version == 2
+    assert req.algorithm == []
+    assert req.weights == {}
+    assert req.dump()
+
+    req.algorithm = [req.algorithms.weighted, req.algorithms.least_conn]
+    req.backends = ["10.0.0.1", "10.0.0.2"]
+    req.weights = {"10.0.0.1": 3, "10.0.0.2": 1}
+    assert req.dump()["algorithm"] == ["weighted", "least-conn"]
+    req2 = Request.loads(req.dumps())
+    assert req2.algorithm == [req.algorithms.weighted, req.algorithms.least_conn]
+    assert req2.weights == {"10.0.0.1": 3, "10.0.0.2": 1}
+    assert req2.hash == req.hash
+
+    # Algorithms can be given as strings, as in v1.
+    req.algorithm = ["weighted", "least_conn"]
+    assert req2.hash == req.hash
+    assert schemas.convert(req, 1).algorithm == ["weighted", "least-conn"]
+    req.algorithm = ["fastest"]
+    assert req.hash is None
+    with pytest.raises(ValidationError) as e:
+        req.dump()
+    assert e.value.messages == {"algorithm": ["Unknown algorithm: fastest"]}
+    # But v1 still allows free-form algorithms, so they're sent to v1 as is.
+    assert schemas.convert(req, 1).algorithm == ["fastest"]
+    req.algorithm = []
+
+    req.weights = {"10.0.0.1": -1}
+    with pytest.raises(ValidationError):
+        req.dump()
+    with pytest.raises(ValidationError):
+        Request()._update(make_request().dump(), algorithm=["fastest"])
+
+
+def test_tuning_fields():
+    req = make_request()
+    assert all(getattr(req, field) is None for field in req.tuning_fields)
+    req.connect_timeout = 5
+    req.idle_timeout = 60
+    req.max_connections = 100
+    req.keepalive = True
+    req.drain_timeout = 30
+    req2 = Request.loads(req.dumps())
+    assert {field: getattr(req2, field) for field in req.tuning_fields} == {
+        "connect_timeout": 5,
+        "idle_timeout": 60,
+        "max_connections": 100,
+        "keepalive": True,
+        "drain_timeout": 30,
+    }
+
+    req.max_connections = 0
+    with pytest.raises(ValidationError):
+        req.dump()
+    req.max_connections = None
+    req.idle_timeout = -1
+    with pytest.raises(ValidationError):
+        req.dump()
+
+    # Unsupported knobs can be reported by the provider.
+    resp = req.response
+    resp.error = resp.error_types.unsupported
+    resp.error_fields = {"keepalive": "not supported", "drain_timeout": "max 10"}
+    assert resp.dump()
+    old = schemas.convert(req, 1)
+    assert not hasattr(old, "keepalive")
+    assert old.response.error_message == (
+        "drain_timeout: max 10; keepalive: not supported"
+    )
+
+
+def test_convert():
+    req = make_request()
+    req.algorithm = [req.algorithms.weighted, req.algorithms.least_conn]
+    req.weights = {"10.0.0.1": 3}
+    req.add_health_check(protocol=req.protocols.http, port=80)
+    req.response.address = "lb"
+
+    old = schemas.convert(req, 1)
+    assert isinstance(old, v1.Request)
+    assert old.algorithm == ["weighted", "least-conn"]
+    assert not hasattr(old, "weights")
+    assert isinstance(old.health_checks[0], v1.HealthCheck)
+    assert old.response.address == "lb"
+    assert old.dump()
+
+    new = schemas.convert(old, 2)
+    assert isinstance(new, Request)
+    assert new.algorithm == req.algorithm
+    assert new.weights == {}
+    assert isinstance(new.health_checks[0], v2.HealthCheck)
+    assert new.response.address == "lb"
+    assert schemas.convert(new, 2) is new
+
+    # Unknown free-form algorithms are kept, both ways.
+    old.algorithm = ["least_conn", "fastest", "round-robin"]
+    new = schemas.convert(old, 2)
+    assert new.algorithm == ["least-conn", "fastest", "round-robin"]
+    assert new.algorithm[0] is req.algorithms.least_conn
+    assert new.dump()["algorithm"] == ["least-conn", "fastest", "round-robin"]
+    assert new.hash is not None
+    assert schemas.convert(new, 1).algorithm == ["least-conn", "fastest", "round-robin"]
+
+
+def test_port_ranges():
+    req = make_request()
+    port_range = req.add_port_range(10000, 10999, 20000)
+    req.add_port_range(80, 81)
+    assert port_range.port_mapping[10500] == 20500
+    req2 = Request.loads(req.dumps())
+    assert [(r.front_start, r.front_end, r.back_start) for r in req2.port_ranges] == [
+        (10000, 10999, 20000),
+        (80, 81, 80),
+    ]
+    assert req2.hash == req.hash
+    # Much smaller than the equivalent mapping of each port.
+    assert len(req.dumps()) * 10 < len(schemas.convert(req, 1).dumps())
+
+    old = schemas.convert(req, 1)
+    assert len(old.port_mapping) == 1003
+    assert old.port_mapping[443] == 443
+    assert old.port_mapping[10999] == 20999
+    assert old.dump()
+
+    req.add_port_range(400, 500)
+    with pytest.raises(ValidationError) as e:
+        req.dump()
+    assert e.value.messages == {"port_ranges": ["Port 443 is mapped more than once."]}
+    req.port_ranges.pop()
+    port_range.back_start = 65000
+    with pytest.raises(ValidationError):
+        req.dump()
+    port_range.back_start = 20000
+    port_range.front_end = 9999
+    with pytest.raises(ValidationError):
+        req.dump()
+
+
+def test_health_checks():
+    req = make_request()
+    hc = req.add_health_check(
+        protocol=req.protocols.http,
+        port=80,
+        timeout=2,
+        healthy_threshold=2,
+        unhealthy_threshold=5,
+        expected_status=204,
+    )
+    req2 = Request.loads(req.dumps())
+    assert req2.health_checks[0].expected_status == 204
+    assert req2.hash == req.hash
+
+    hc.expected_status = 99
+    with pytest.raises(ValidationError):
+        req.dump()
+    hc.expected_status = None
+
+    old = schemas.convert(req, 1)
+    assert not hasattr(old.health_checks[0], "timeout")
+    assert old.health_checks[0].retries == 5
+    assert old.dump()
+
+
+def test_backend_health():
+    resp = make_request().response
+    resp.address = "lb"
+    resp_hash = resp.hash
+    resp.backend_health = {"10.0.0.1": resp.health_states.healthy}
+    assert resp.dump()["backend_health"] == {"10.0.0.1": "healthy"}
+    # Health isn't considered a change to the response itself.
+    assert resp.hash == resp_hash
+
+    req2 = Request.loads(make_request().dumps(), resp.dumps())
+    assert req2.response.backend_health == {"10.0.0.1": resp.health_states.healthy}
+    with pytest.raises(ValidationError):
+        Request.loads(make_request().dumps(), '{"backend_health": {"x": "sick"}}')
+
+    old = schemas.convert(resp, 1)
+    assert not hasattr(old, "backend_health")
+    assert old.dump()
+
+
+def test_backend_addresses():
+    req = make_request()
+    req.backends = ["10.0.0.10", " 2001:DB8:0:0::1 ", "Backend.Example", "10.0.0.9"]
+    req.backends.append("10.0.0.10")
+    req.weights = {"2001:db8::0001": 2}
+    assert req.dump()["backends"] == [
+        "10.0.0.9",
+        "10.0.0.10",
+        "2001:db8::1",
+        "backend.example",
+    ]
+    assert req.dump()["weights"] == {"2001:db8::1": 2}
+    req2 = Request.loads(req.dumps())
+    assert req2.backends == req.dump()["backends"]
+    assert req2.hash == req.hash
+
+    # Equal sets of backends are the same request, however they're written.
+    req2.backends = ["backend.example", "2001:db8::1", "10.0.0.10", "10.0.0.9"]
+    req2.weights = {"2001:DB8::1": 2}
+    assert req2.hash == req.hash
+    assert Request()._update(req.dump(), backends=["a", "A"]).backends == ["a"]
+
+    old = schemas.convert(make_request(), 1)
+    old.backends = ["10.0.0.2", "10.0.0.1"]
+    assert schemas.convert(old, 2).backends == ["10.0.0.1", "10.0.0.2"]
+
+
+def test_response_view():
+    resp = make_request().response
+    resp.address = "lb"
+    resp.backend_health = {"10.0.0.1": resp.health_states.healthy}
+    view = v2.ResponseView("name", resp.dumps())
+    assert view and view.name == "name"
+    assert view.error is None
+    assert view.address == "lb"
+    assert view.backend_health == {"10.0.0.1": view.health_states.healthy}
+    assert "error_fields" not in vars(view)
+    with pytest.raises(AttributeError):
+        view.address = "other"
+    with pytest.raises(AttributeError):
+        view.foo
+
+    # Only the fields which are read are validated.
+    view = v2.ResponseView("name", '{"address": "lb", "error_fields": 1}')
+    assert view and view.address == "lb"
+    with pytest.raises(ValidationError) as e:
+        view.error_fields
+    assert e.value.messages == {"error_fields": ["Not a valid mapping type."]}
+    assert not v2.ResponseView("name", '{"error": "unsupported"}')
+    assert not v2.ResponseView("name", '{"error": "bad", "address": "lb"}')
+
+
+def test_convert_response():
+    resp = make_request().response
+    resp.error = resp.error_types.unsupported
+    resp.error_fields = {"weights": "not supported", "public": "public only"}
+    old = schemas.convert(resp, 1)
+    assert old.error_fields == {"public": "public only"}
+    assert old.dump()
+
+    resp.error_fields = {"weights": "not supported"}
+    old = schemas.convert(resp, 1)
+    assert old.error_fields == {}
+    assert old.error_message == "weights: not supported"
+    assert old.dump()